@@ -19,12 +19,15 @@ from store.models import ProductImage
 
 @admin.register(models.Collection)
 class CollectionAdmin(admin.ModelAdmin):
-    list_display = ('id', 'title', 'products_count')
+    list_display = ('id', 'title', 'products_count',
+                    'min_unit_price', 'max_unit_price', 'products_updated_at')
+    readonly_fields = ('product_count', 'min_unit_price', 'max_unit_price',
+                       'products_updated_at')
     list_per_page = 50
 
     search_fields = ['title']
 
-    @admin.display(ordering='products_count')
+    @admin.display(ordering='product_count')
     def products_count(self, collection):
         # get url from reverse('admin:app_model_page'), don't hardcode it
         # url = reverse('admin:store_product_changelist')
@@ -32,7 +35,7 @@ class CollectionAdmin(admin.ModelAdmin):
         url_query = urlencode({'collection_id': str(collection.id)})
         url = reverse('admin:store_product_changelist') + '?' + url_query
         html_result = format_html(
-            '<a href="{}">{}</a>',  url, collection.products_count,
+            '<a href="{}">{}</a>',  url, collection.product_count,
         )
 
         # html_result = format_html(
@@ -42,10 +45,11 @@ class CollectionAdmin(admin.ModelAdmin):
 
         return html_result
 
-    def get_queryset(self, request):
-        return super().get_queryset(request).annotate(
-            products_count=Count('product')
-        )
+    # product_count is a column of the collection now
+    # def get_queryset(self, request):
+    #     return super().get_queryset(request).annotate(
+    #         products_count=Count('product')
+    #     )
 
 
 # class ProductAdmin(admin.ModelAdmin):
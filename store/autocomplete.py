@@ -0,0 +1,172 @@
+import threading
+import time
+from bisect import bisect_left
+
+from django.db import transaction
+
+from store import caching
+from store.models import Collection, Product
+from store.search import tokenize
+
+# prefix autocomplete over product names and collection titles
+#
+# ?search= on the product list runs a query per keystroke.
+# the suggestions come from a sorted array in the memory of the process instead:
+# every word of a name is a key, together with the rest of the name after it,
+#   'white bread loaf' -> 'white bread loaf', 'bread loaf', 'loaf'
+# so 'bre' and 'bread lo' are both a bisect into the sorted keys
+# and a scan of the keys that start with the prefix, no database access.
+#
+# the index is built when the worker starts (storefront/wsgi.py).
+# the signal handlers update the index of the worker that saved the change
+# and bump the 'autocomplete' version, the other workers compare the version
+# at most every VERSION_CHECK_INTERVAL seconds and rebuild when it changed.
+
+VERSION = 'autocomplete'
+VERSION_CHECK_INTERVAL = 5
+
+# the default and the largest number of suggestions of each kind
+LIMIT = 10
+MAX_LIMIT = 20
+
+# keys scanned for one prefix, a short prefix like 'a' matches many
+MAX_SCAN = 500
+
+PRODUCT = 'products'
+COLLECTION = 'collections'
+
+
+def index_keys(text):
+    words = tokenize(text)
+    return [' '.join(words[start:]) for start in range(len(words))]
+
+
+class AutocompleteIndex:
+    def __init__(self):
+        self.lock = threading.RLock()
+        # sorted (key, word position, kind, id),
+        # a match at the first word ranks before a match further in the name
+        self.entries = []
+        # the sorted keys alone for bisect
+        self.keys = []
+        # kind -> id -> name or title
+        self.labels = {PRODUCT: {}, COLLECTION: {}}
+        self.version = None
+        self.checked_at = 0
+
+    def build(self):
+        version = caching.get_version(VERSION)
+        labels = {
+            PRODUCT: dict(Product.objects.values_list('id', 'name').iterator(chunk_size=2000)),
+            COLLECTION: dict(Collection.objects.values_list('id', 'title')),
+        }
+        entries = sorted(
+            (key, position, kind, item_id)
+            for kind, items in labels.items()
+            for item_id, label in items.items()
+            for position, key in enumerate(index_keys(label))
+        )
+        with self.lock:
+            self.entries = entries
+            self.keys = [entry[0] for entry in entries]
+            self.labels = labels
+            self.version = version
+            self.checked_at = time.monotonic()
+
+    def refresh(self):
+        # the cache is read at most every VERSION_CHECK_INTERVAL seconds
+        now = time.monotonic()
+        if self.version is not None and now - self.checked_at < VERSION_CHECK_INTERVAL:
+            return
+        self.checked_at = now
+        if self.version is None or caching.get_version(VERSION) != self.version:
+            self.build()
+
+    def put(self, kind, item_id, label):
+        with self.lock:
+            self._remove(kind, item_id)
+            self.labels[kind][item_id] = label
+            for position, key in enumerate(index_keys(label)):
+                entry = (key, position, kind, item_id)
+                index = bisect_left(self.entries, entry)
+                self.entries.insert(index, entry)
+                self.keys.insert(index, key)
+
+    def remove(self, kind, item_id):
+        with self.lock:
+            self._remove(kind, item_id)
+
+    def _remove(self, kind, item_id):
+        label = self.labels[kind].pop(item_id, None)
+        if label is None:
+            return
+        for position, key in enumerate(index_keys(label)):
+            entry = (key, position, kind, item_id)
+            index = bisect_left(self.entries, entry)
+            if index < len(self.entries) and self.entries[index] == entry:
+                del self.entries[index]
+                del self.keys[index]
+
+    def suggest(self, prefix, limit=LIMIT):
+        prefix = ' '.join(tokenize(prefix))
+        results = {PRODUCT: {}, COLLECTION: {}}
+        if not prefix:
+            return {kind: [] for kind in results}
+        self.refresh()
+        with self.lock:
+            start = bisect_left(self.keys, prefix)
+            matches = []
+            for index in range(start, min(start + MAX_SCAN, len(self.keys))):
+                if not self.keys[index].startswith(prefix):
+                    break
+                matches.append(self.entries[index])
+            # the first word first, then alphabetical, each item once
+            matches.sort(key=lambda entry: (entry[1], entry[0]))
+            for key, position, kind, item_id in matches:
+                items = results[kind]
+                if len(items) < limit and item_id not in items:
+                    items[item_id] = self.labels[kind][item_id]
+        return {
+            kind: [{'id': item_id, 'title': label} for item_id, label in items.items()]
+            for kind, items in results.items()
+        }
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = AutocompleteIndex()
+    return _index
+
+
+def index_changed(kind, item_id, label=None):
+    # called by the signal handlers, label None for a deletion
+    index_changed_many([(kind, item_id, label)])
+
+
+def index_changed_many(changes, complete=True):
+    # changes: [(kind, id, label or None for a deletion)]
+    # after the commit: update this worker, bump the version for the others.
+    # when nobody else bumped the version in between, this worker is up to date.
+    # complete=False when some changes are missing (products created without
+    # ids by a bulk insert), this worker rebuilds like the others
+    def apply():
+        version = caching.bump_version(VERSION)
+        index = get_index()
+        with index.lock:
+            if index.version is None:
+                # not built yet, the build reads the changes from the database
+                return
+            for kind, item_id, label in changes:
+                if label is None:
+                    index.remove(kind, item_id)
+                else:
+                    index.put(kind, item_id, label)
+            if complete and version == index.version + 1:
+                index.version = version
+    transaction.on_commit(apply)
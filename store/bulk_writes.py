@@ -0,0 +1,97 @@
+from django.db import transaction
+from django.utils import timezone
+
+from store.models import Collection, Product
+from store.serializers import ProductSerializerForBulk
+from store.signals import products_bulk_saved
+
+# bulk create and update of products: products/bulk/ with POST and PATCH
+#
+# one PATCH per product is a request, a SELECT and an UPDATE for each price.
+# here the rows are validated first, all of them, with the collections read
+# once and the products to update read with one query.
+# when every row is valid, they're written in one transaction, BATCH_SIZE rows
+# per INSERT (bulk_create) or UPDATE ... CASE (bulk_update), the slug is part
+# of the same write. when a row is invalid nothing is written and the errors
+# of each row are returned with the index of the row.
+#
+# bulk_create and bulk_update don't send post_save, the products_bulk_saved
+# signal does what the post_save handlers do, see store/signals/handlers.py
+
+BATCH_SIZE = 500
+
+# the most rows in one request
+MAX_ROWS = 5000
+
+
+class BulkError(Exception):
+    # errors: [{'index': row index, 'errors': serializer errors}]
+    def __init__(self, errors):
+        super().__init__(errors)
+        self.errors = errors
+
+
+def get_context(request):
+    return {
+        'request': request,
+        'collections': Collection.objects.in_bulk(),
+    }
+
+
+def create_products(rows, context):
+    products = []
+    errors = []
+    for index, row in enumerate(rows):
+        serializer = ProductSerializerForBulk(data=row, context=context)
+        if serializer.is_valid():
+            products.append(ProductSerializerForBulk.build(serializer.validated_data))
+        else:
+            errors.append({'index': index, 'errors': serializer.errors})
+    if errors:
+        raise BulkError(errors)
+
+    with transaction.atomic():
+        # the ids are set on PostgreSQL and SQLite, not on MySQL
+        Product.objects.bulk_create(products, batch_size=BATCH_SIZE)
+        products_bulk_saved.send(Product, created=products, updated=[])
+    return products
+
+
+def update_products(rows, context):
+    # an id that isn't an int (a list, a string, json true) is reported
+    # as not found instead of failing the lookups below
+    ids = [row.get('id') if isinstance(row, dict) else None for row in rows]
+    ids = [product_id if type(product_id) is int else None for product_id in ids]
+    instances = Product.objects.in_bulk([product_id for product_id in ids if product_id is not None])
+
+    products = []
+    fields = {'slug', 'last_updated_at'}
+    errors = []
+    seen = set()
+    now = timezone.now()
+    for index, (product_id, row) in enumerate(zip(ids, rows)):
+        instance = instances.get(product_id)
+        if instance is None or product_id in seen:
+            message = 'Duplicate product id.' if product_id in seen else 'No product with the given id was found.'
+            errors.append({'index': index, 'errors': {'id': [message]}})
+            continue
+        seen.add(product_id)
+        serializer = ProductSerializerForBulk(instance, data=row, partial=True, context=context)
+        if not serializer.is_valid():
+            errors.append({'index': index, 'errors': serializer.errors})
+            continue
+        data = dict(serializer.validated_data)
+        data['slug'] = ProductSerializerForBulk.update_slug(instance, data)
+        for attr, value in data.items():
+            setattr(instance, attr, value)
+        # bulk_update doesn't set auto_now fields
+        instance.last_updated_at = now
+        fields.update(data)
+        products.append(instance)
+    if errors:
+        raise BulkError(errors)
+
+    with transaction.atomic():
+        Product.objects.bulk_update(products, sorted(fields), batch_size=BATCH_SIZE)
+        products_bulk_saved.send(Product, created=[], updated=products)
+    return products
@@ -0,0 +1,274 @@
+import hashlib
+import time
+from datetime import datetime, timezone
+
+from django.core.cache import cache
+from django.db import transaction
+from django.views.decorators.http import condition
+
+from store.models import Product
+
+# versioned response cache for the product endpoints
+#
+# instead of deleting cached responses when a product changes
+# (which needs to scan redis for the matching keys),
+# every cache key contains a version number.
+# writes bump the version, the next read builds a new key and misses,
+# the old entries are never read again and expire by themselves.
+#
+# versions:
+#   catalog          any product, image or collection changed
+#   collection:<id>  the collection, a product or image of a product in it changed
+#   product:<id>     the product or one of its images changed
+#   reviews:<id>     a review of the product changed
+#   popularity       the units sold changed, for lists ordered by popularity
+#
+# a response can depend on several versions (a product with ?expand=collection).
+# the versions also give the ETag and Last-Modified headers,
+# see conditional_get below
+
+RESPONSE_TIMEOUT = 10 * 60
+
+# the query parameters which change the result of the product list,
+# everything else (utm_source, _=timestamp) is dropped from the key
+PRODUCT_LIST_PARAMS = (
+    'collection_id', 'min_price', 'max_price',
+    'min_price_with_tax', 'max_price_with_tax',
+    'search', 'ordering', 'page', 'cursor',
+    'fields', 'expand',
+)
+PRODUCT_DETAIL_PARAMS = ('fields', 'expand')
+
+
+# the filters of the product list without the paging and ordering
+PRODUCT_FACET_PARAMS = (
+    'collection_id', 'min_price', 'max_price',
+    'min_price_with_tax', 'max_price_with_tax', 'search',
+)
+
+
+def version_key(name):
+    return f'store:version:{name}'
+
+
+def initial_version():
+    # start from the current time in ms, so a counter that was evicted
+    # from redis never restarts at a version that's still cached
+    return int(time.time() * 1000)
+
+
+# the names come from urls (product:<pk> of any pk), a version created
+# by a read expires after READ_VERSION_TIMEOUT, a bump keeps it forever.
+# an expired version starts again from the current time, the responses
+# cached under the old one are missed once
+READ_VERSION_TIMEOUT = 24 * 60 * 60
+
+
+def get_version(name):
+    key = version_key(name)
+    version = cache.get(key)
+    if version is None:
+        version = initial_version()
+        if not cache.add(key, version, timeout=READ_VERSION_TIMEOUT):
+            # added by another request meanwhile
+            version = cache.get(key, version)
+    return version
+
+
+def version_names(names):
+    # a version function returns a name or a list of names
+    return [names] if isinstance(names, str) else names
+
+
+def get_versions(names):
+    # the versions of several names as one string for a cache key
+    return ':'.join(str(get_version(name)) for name in version_names(names))
+
+
+def modified_key(name):
+    return f'store:modified:{name}'
+
+
+def get_last_modified(name):
+    # the time of the last bump, None if it wasn't bumped since redis started
+    timestamp = cache.get(modified_key(name))
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc)
+
+
+def bump_version(name):
+    # returns the new version
+    key = version_key(name)
+    cache.set(modified_key(name), time.time(), timeout=None)
+    version = initial_version()
+    if cache.add(key, version, timeout=None):
+        return version
+    try:
+        version = cache.incr(key)
+        # a version created by a read has a timeout
+        cache.touch(key, timeout=None)
+        return version
+    except ValueError:
+        # expired between add and incr
+        cache.set(key, version, timeout=None)
+        return version
+
+
+def bump_versions_on_commit(*names):
+    # bump after the transaction commits,
+    # otherwise a read between the bump and the commit would cache
+    # the old rows under the new version
+    def do_bump():
+        for name in names:
+            bump_version(name)
+    transaction.on_commit(do_bump)
+
+
+def redis_or_local(redis_class, local_class):
+    # the stores of trending, recommendations and similarity:
+    # redis_class(the redis connection) with a django_redis cache,
+    # local_class() in the memory of the process with any other cache
+    # (tests, local development)
+    try:
+        from django_redis import get_redis_connection
+        return redis_class(get_redis_connection('default'))
+    except (ImportError, NotImplementedError):
+        # not a django_redis cache
+        return local_class()
+
+
+# negative cache: ids that were not found.
+# products/<id>/ for an id that doesn't exist is a query and a 404 each time,
+# bots and stale links ask for the same missing ids again and again.
+# a miss is remembered for MISSING_TIMEOUT seconds,
+# creating the object deletes the entry, see the signal handlers
+MISSING_TIMEOUT = 60
+
+
+def missing_key(kind, pk):
+    return f'store:missing:{kind}:{pk}'
+
+
+def is_missing(kind, pk):
+    return cache.get(missing_key(kind, pk)) is not None
+
+
+def mark_missing(kind, pk):
+    cache.set(missing_key(kind, pk), 1, MISSING_TIMEOUT)
+
+
+def clear_missing_on_commit(kind, pk):
+    transaction.on_commit(lambda: cache.delete(missing_key(kind, pk)))
+
+
+def make_key(prefix, request, params, version):
+    # normalized query string: known parameters only, sorted, no empty values
+    query = sorted(
+        (name, value)
+        for name in params
+        for value in request.query_params.getlist(name)
+        if value != ''
+    )
+    # the host is part of the key since the responses contain absolute urls
+    raw = f'{request.get_host()}|{query}'
+    digest = hashlib.md5(raw.encode()).hexdigest()
+    return f'store:{prefix}:{version}:{digest}'
+
+
+# the version a response depends on,
+# called with the request and the url kwargs of the view
+def product_list_version(request, **kwargs):
+    # a list filtered by a collection only changes with that collection,
+    # all other lists (search, price range only) change with the catalog
+    collection_id = request.query_params.get('collection_id', '')
+    name = f'collection:{collection_id}' if collection_id.isdigit() else 'catalog'
+    # and a list ordered by popularity with the units sold, see store/popularity.py
+    ordering = request.query_params.get('ordering', '')
+    if 'popularity' in (field.strip().lstrip('-') for field in ordering.split(',')):
+        return [name, 'popularity']
+    return name
+
+
+def product_detail_version(request, pk, **kwargs):
+    # ?expand=collection embeds the collection title,
+    # that response also changes with the collection
+    if not is_expanded(request, 'collection'):
+        return f'product:{pk}'
+    collection_id = product_collection_id(pk)
+    if collection_id is None:
+        return f'product:{pk}'
+    return [f'product:{pk}', f'collection:{collection_id}']
+
+
+def is_expanded(request, name):
+    # the same as SparseFieldsViewMixin: expanded and not left out by ?fields=
+    def param_list(param):
+        value = request.query_params.get(param, '')
+        return [item.strip() for item in value.split(',') if item.strip()]
+    fields = param_list('fields')
+    return name in param_list('expand') and (not fields or name in fields)
+
+
+def product_collection_id(pk):
+    # the collection of a product, cached under the version of the product,
+    # moving the product to another collection bumps it
+    key = f'store:product-collection:{pk}:{get_version(f"product:{pk}")}'
+    collection_id = cache.get(key)
+    if collection_id is None:
+        collection_id = Product.objects\
+            .filter(pk=pk)\
+            .values_list('collection_id', flat=True)\
+            .first()
+        if collection_id is not None:
+            cache.set(key, collection_id, RESPONSE_TIMEOUT)
+    return collection_id
+
+
+def catalog_version(request, **kwargs):
+    return 'catalog'
+
+
+def collection_detail_version(request, pk, **kwargs):
+    return f'collection:{pk}'
+
+
+def review_version(request, product_pk, **kwargs):
+    return f'reviews:{product_pk}'
+
+
+def product_list_key(request):
+    version = get_versions(product_list_version(request))
+    return make_key('products', request, PRODUCT_LIST_PARAMS, version)
+
+
+def product_facets_key(request):
+    version = get_versions(product_list_version(request))
+    return make_key('product-facets', request, PRODUCT_FACET_PARAMS, version)
+
+
+def product_detail_key(request, pk):
+    version = get_versions(product_detail_version(request, pk))
+    return make_key(f'product:{pk}', request, PRODUCT_DETAIL_PARAMS, version)
+
+
+def conditional_get(version_func, params=()):
+    # ETag and Last-Modified from the version counter of the response,
+    # a client sending If-None-Match or If-Modified-Since gets a 304
+    # without the queryset being evaluated or the body being serialized.
+    # https://docs.djangoproject.com/en/3.2/topics/conditional-view-processing/
+    def etag(request, *args, **kwargs):
+        names = version_names(version_func(request, **kwargs))
+        key = make_key(','.join(names), request, params, get_versions(names))
+        # the browsable api and json have different bodies
+        media_type = getattr(request, 'accepted_media_type', '')
+        return hashlib.md5(f'{key}|{media_type}'.encode()).hexdigest()
+
+    def last_modified(request, *args, **kwargs):
+        # the latest of the versions, None when one of them is unknown
+        times = [get_last_modified(name) for name in version_names(version_func(request, **kwargs))]
+        if None in times:
+            return None
+        return max(times)
+
+    return condition(etag_func=etag, last_modified_func=last_modified)
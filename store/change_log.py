@@ -0,0 +1,123 @@
+import time
+from datetime import timedelta
+
+from django.utils import timezone
+
+from store import caching
+from store.models import CatalogChange
+
+# the change feed of the catalog: store/changes/?offset=<n>
+#
+# the signal handlers append a CatalogChange row for every product,
+# collection, product image and review saved or deleted, in the transaction
+# of the change, a rolled back change leaves no row.
+# the offset of a change is its id, a consumer keeps the offset of the last
+# change it handled and asks for the changes after it (WHERE id > n ORDER BY id,
+# a range scan of the primary key). without changes the request waits
+# (long polling) up to timeout seconds: the 'catalog-changes' version is bumped
+# when a change is committed, the waiting request reads it from the cache every
+# POLL_INTERVAL and only reads the table again when it changed.
+#
+# auto increment ids are taken at insert, not at commit: change 8 can be
+# committed after change 9. a gap in the ids is a change that is not committed
+# yet, or was rolled back. the changes after a gap are held back until the gap
+# is GAP_TIMEOUT old, then it's a rollback and the changes after it are returned.
+# changes are kept for RETENTION, an older offset gets a 410,
+# the consumer starts again from a full scan of the catalog.
+#
+# the waiting request holds a worker thread, the web process runs gthread
+# workers with threads (see the Procfile), a sync worker would serve nothing
+# else while a consumer waits. MAX_TIMEOUT stays below the 30 seconds after
+# which the heroku router drops a request without a response.
+
+VERSION = 'catalog-changes'
+
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+DEFAULT_TIMEOUT = 25
+MAX_TIMEOUT = 25
+POLL_INTERVAL = 1
+
+GAP_TIMEOUT = timedelta(seconds=10)
+RETENTION = timedelta(days=7)
+
+
+class OffsetExpired(Exception):
+    def __init__(self, oldest_offset):
+        super().__init__(oldest_offset)
+        # the consumer can continue from here after a full scan
+        self.oldest_offset = oldest_offset
+
+
+def change(kind, action, object_id, product_id=None):
+    return CatalogChange(kind=kind, action=action, object_id=object_id, product_id=product_id)
+
+
+def record(kind, action, object_id, product_id=None):
+    record_many([change(kind, action, object_id, product_id)])
+
+
+def record_many(changes):
+    if not changes:
+        return
+    CatalogChange.objects.bulk_create(changes)
+    caching.bump_versions_on_commit(VERSION)
+
+
+def head_offset():
+    # the offset of the last change, 0 without changes
+    return CatalogChange.objects.order_by('-id').values_list('id', flat=True).first() or 0
+
+
+def check_offset(offset):
+    # offset 0 is the start of the log, whatever is still kept
+    if offset == 0:
+        return
+    oldest = CatalogChange.objects.order_by('id').values_list('id', flat=True).first()
+    if oldest is not None and offset < oldest - 1:
+        raise OffsetExpired(oldest - 1)
+
+
+def read(offset, limit=PAGE_SIZE):
+    # returns the changes after offset, up to the first gap that can still fill,
+    # and whether changes were held back by a gap
+    rows = list(CatalogChange.objects.filter(id__gt=offset).order_by('id')[:limit])
+    settled_before = timezone.now() - GAP_TIMEOUT
+    changes = []
+    expected_id = offset + 1
+    for row in rows:
+        # from offset 0 the first change can follow anything
+        first_of_log = offset == 0 and not changes
+        if row.id != expected_id and not first_of_log and row.created_at > settled_before:
+            return changes, True
+        changes.append(row)
+        expected_id = row.id + 1
+    return changes, False
+
+
+def wait(offset, limit=PAGE_SIZE, timeout=DEFAULT_TIMEOUT):
+    # the changes after offset, waits up to timeout seconds for the first one
+    check_offset(offset)
+    deadline = time.monotonic() + timeout
+    version = caching.get_version(VERSION)
+    while True:
+        changes, held_back = read(offset, limit)
+        if changes:
+            return changes
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return []
+            time.sleep(min(POLL_INTERVAL, remaining))
+            current_version = caching.get_version(VERSION)
+            if held_back or current_version != version:
+                version = current_version
+                break
+
+
+def prune(now=None):
+    # scheduled in CELERY_BEAT_SCHEDULE, returns the number of deleted changes
+    expired_before = (now or timezone.now()) - RETENTION
+    deleted, _ = CatalogChange.objects.filter(created_at__lt=expired_before).delete()
+    return deleted
@@ -0,0 +1,98 @@
+import csv
+from collections import defaultdict
+
+from django.core.files.storage import FileSystemStorage
+from rest_framework.utils.encoders import JSONEncoder
+
+from store.models import Product, ProductImage
+
+# streaming export of the whole catalog as NDJSON or CSV
+#
+# the products are read in batches by id: WHERE id > last_id ORDER BY id LIMIT n.
+# QuerySet.iterator() would be the obvious choice, but MySQLdb fetches the
+# whole result of a query into memory, and iterator() ignores prefetch_related
+# in Django 3.2. with id batches only one batch of products and their images
+# is in memory at a time, for 10k or 10M products.
+#
+# the export has the inventory, products/export/ is for admin users only.
+
+CHUNK_SIZE = 2000
+
+CSV_COLUMNS = [
+    'id', 'name', 'slug', 'description', 'unit_price', 'inventory',
+    'last_updated_at', 'collection_id', 'collection_title', 'images',
+]
+
+
+def image_url_builder(request=None):
+    # absolute urls for the api, the plain storage urls for the command
+    storage = ProductImage._meta.get_field('image').storage
+    if request is None:
+        return storage.url
+    if isinstance(storage, FileSystemStorage):
+        media_url = request.build_absolute_uri(storage.base_url)
+        return lambda name: media_url + storage.url(name)[len(storage.base_url):]
+    return lambda name: request.build_absolute_uri(storage.url(name))
+
+
+def iter_products(request=None, chunk_size=None):
+    chunk_size = chunk_size or CHUNK_SIZE
+    image_url = image_url_builder(request)
+    last_id = 0
+    while True:
+        products = list(
+            Product.objects
+            .filter(id__gt=last_id)
+            .order_by('id')
+            .values_list(
+                'id', 'name', 'slug', 'description', 'unit_price', 'inventory',
+                'last_updated_at', 'collection_id', 'collection__title',
+            )[:chunk_size]
+        )
+        if not products:
+            return
+        last_id = products[-1][0]
+
+        images = defaultdict(list)
+        image_rows = ProductImage.objects\
+            .filter(product_id__gte=products[0][0], product_id__lte=last_id)\
+            .order_by('id')\
+            .values_list('product_id', 'image')
+        for product_id, name in image_rows:
+            if name:
+                images[product_id].append(image_url(name))
+
+        for row in products:
+            product = dict(zip(CSV_COLUMNS, row))
+            product['images'] = images[product['id']]
+            yield product
+
+
+def ndjson_lines(products):
+    # one json object per line
+    encoder = JSONEncoder()
+    for product in products:
+        yield encoder.encode(product) + '\n'
+
+
+class Echo:
+    # csv.writer writes to a file, this file returns the line instead
+    # https://docs.djangoproject.com/en/3.2/howto/outputting-csv/#streaming-large-csv-files
+    def write(self, value):
+        return value
+
+
+def csv_lines(products):
+    writer = csv.writer(Echo())
+    yield writer.writerow(CSV_COLUMNS)
+    for product in products:
+        product['images'] = ' '.join(product['images'])
+        product['last_updated_at'] = product['last_updated_at'].isoformat()
+        yield writer.writerow([product[column] for column in CSV_COLUMNS])
+
+
+FORMATS = {
+    # format: (lines, content type)
+    'ndjson': (ndjson_lines, 'application/x-ndjson'),
+    'csv': (csv_lines, 'text/csv'),
+}
@@ -1,5 +1,8 @@
 import django_filters
 from django_filters import rest_framework as filters
+from rest_framework.filters import SearchFilter
+
+from store import search
 from store.models import Product
 
 
@@ -10,6 +13,14 @@ class ProductFilter(filters.FilterSet):
     max_price = django_filters.NumberFilter(
         field_name='unit_price', lookup_expr='lte'
     )
+    # on the annotations of pricing.annotate_prices,
+    # after the discounts of the promotions and with tax
+    min_price_with_tax = django_filters.NumberFilter(
+        field_name='price_with_tax', lookup_expr='gte'
+    )
+    max_price_with_tax = django_filters.NumberFilter(
+        field_name='price_with_tax', lookup_expr='lte'
+    )
 
     class Meta:
         model = Product
@@ -18,3 +29,14 @@ class ProductFilter(filters.FilterSet):
             'collection_id': ['exact', ],
             # 'unit_price': ['gt', 'lt'],
         }
+
+
+# the same ?search= parameter as SearchFilter,
+# but the query goes to the full text index of store.search
+# instead of icontains on every search field
+class ProductSearchFilter(SearchFilter):
+    def filter_queryset(self, request, queryset, view):
+        search_terms = self.get_search_terms(request)
+        if not search_terms:
+            return queryset
+        return search.get_backend().search(queryset, ' '.join(search_terms))
@@ -0,0 +1,262 @@
+import json
+import threading
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal, InvalidOperation, ROUND_CEILING, ROUND_FLOOR
+
+import numpy as np
+from django.utils.dateparse import parse_datetime
+
+from store import caching
+from store.models import Product
+
+# the product list from arrays in the memory of the worker
+#
+# most product list requests are a collection, a price range and an ordering,
+# products/?collection_id=3&min_price=10&ordering=-unit_price&cursor=...
+# every worker keeps a snapshot of the catalog as NumPy arrays, a row per
+# product in id order:
+#   ids, collection_ids, unit prices in cents, last_updated_at in microseconds
+# and for every ordering field the rows in (field, id) order, the same order
+# as the database (ProductCursorPagination appends id as the tie-breaker,
+# -field is the same order reversed, with -id). the name order is read from the
+# database with ORDER BY name, id, the collation of the database decides.
+#
+# a page is the rows after the cursor position (a bisect of the sorted values
+# and ids, for the name order the row of the position id) that match the
+# filters (a NumPy mask of the rows), only the products of the page are then
+# read from the database, with the annotations and prefetches of the list.
+#
+# the snapshot is never changed, a new one is built when the 'catalog' version
+# changes (the signal handlers bump it on commit for every product change) and
+# replaces the old one with one assignment. the version is read with every
+# request, while one thread builds the new snapshot the other requests use the
+# database, a page is never read from an older snapshot than the version.
+#
+# everything else (search, price_with_tax, popularity, page numbers,
+# several ordering fields) goes to the database, like before.
+
+VERSION = 'catalog'
+
+ORDERING_FIELDS = ('name', 'unit_price', 'last_updated_at')
+
+# the snapshot knows collection_id, min_price and max_price,
+# a request with one of these goes to the database
+OTHER_FILTER_PARAMS = ('search', 'min_price_with_tax', 'max_price_with_tax', 'page')
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def to_cents(value):
+    return int(Decimal(value) * 100)
+
+
+def to_microseconds(value):
+    return (value - EPOCH) // MICROSECOND
+
+
+class ProductListSnapshot:
+    def __init__(self, version, ids, collection_ids, unit_prices, updated_at):
+        # the columns are given in (name, id) order, as read from the database
+        self.version = version
+        by_id = np.argsort(ids, kind='stable')
+        # the columns, a row per product, ids ascending
+        self.ids = ids[by_id]
+        self.collection_ids = collection_ids[by_id]
+        self.unit_prices = unit_prices[by_id]
+        columns = {'unit_price': self.unit_prices, 'last_updated_at': updated_at[by_id]}
+        # field -> the rows in (field, id) order,
+        # a stable sort of rows in id order keeps the ids ascending for equal values
+        self.orders = {
+            field: np.argsort(values, kind='stable')
+            for field, values in columns.items()
+        }
+        # the row -> its index in the name order, and the rows in name order
+        self.name_ranks = by_id
+        self.orders['name'] = np.empty(len(ids), dtype=np.int64)
+        self.orders['name'][by_id] = np.arange(len(ids))
+        # field -> the values in that order, for the bisect of a position
+        self.sorted_values = {
+            field: values[self.orders[field]]
+            for field, values in columns.items()
+        }
+        self.sorted_ids = {
+            field: self.ids[self.orders[field]]
+            for field in columns
+        }
+        for array in (self.ids, self.collection_ids, self.unit_prices, self.name_ranks,
+                      *columns.values(), *self.orders.values(),
+                      *self.sorted_values.values(), *self.sorted_ids.values()):
+            array.flags.writeable = False
+
+    @classmethod
+    def build(cls, version):
+        # one query, the rows in the name order of the database
+        rows = Product.objects\
+            .order_by('name', 'id')\
+            .values_list('id', 'collection_id', 'unit_price', 'last_updated_at')
+        ids, collection_ids, unit_prices, updated_at = [], [], [], []
+        for product_id, collection_id, unit_price, last_updated_at in rows.iterator(chunk_size=5000):
+            ids.append(product_id)
+            collection_ids.append(collection_id)
+            unit_prices.append(to_cents(unit_price))
+            updated_at.append(to_microseconds(last_updated_at))
+        return cls(
+            version,
+            np.array(ids, dtype=np.int64),
+            np.array(collection_ids, dtype=np.int64),
+            np.array(unit_prices, dtype=np.int64),
+            np.array(updated_at, dtype=np.int64),
+        )
+
+    def row_of(self, product_id):
+        row = int(np.searchsorted(self.ids, product_id))
+        if row < len(self.ids) and self.ids[row] == product_id:
+            return row
+        return None
+
+    def mask(self, collection_id=None, min_cents=None, max_cents=None):
+        # the rows that match the filters, None for all rows
+        mask = None
+        for condition in (
+            None if collection_id is None else self.collection_ids == collection_id,
+            None if min_cents is None else self.unit_prices >= min_cents,
+            None if max_cents is None else self.unit_prices <= max_cents,
+        ):
+            if condition is not None:
+                mask = condition if mask is None else mask & condition
+        return mask
+
+    def bounds(self, field, value, product_id):
+        # in the (field, id) order: the number of rows before the position,
+        # and before or at the position. None when the position can't be found
+        if field == 'name':
+            # the names are not in the snapshot, the position id is
+            row = self.row_of(product_id)
+            if row is None:
+                return None
+            rank = int(self.name_ranks[row])
+            return rank, rank + 1
+        values = self.sorted_values[field]
+        start = int(np.searchsorted(values, value, side='left'))
+        end = int(np.searchsorted(values, value, side='right'))
+        # the rows with the same value are in id order
+        ids = self.sorted_ids[field][start:end]
+        return (
+            start + int(np.searchsorted(ids, product_id, side='left')),
+            start + int(np.searchsorted(ids, product_id, side='right')),
+        )
+
+    def page_ids(self, field, ascending, mask, position, limit):
+        # the ids of up to limit rows after the position in the order of
+        # field (ascending or not) that match the mask, position is
+        # (value, id) or None for the first page
+        order = self.orders[field]
+        if position is not None:
+            bounds = self.bounds(field, *position)
+            if bounds is None:
+                return None
+            before, before_or_at = bounds
+            order = order[before_or_at:] if ascending else order[:before][::-1]
+        elif not ascending:
+            order = order[::-1]
+        if mask is not None:
+            order = order[mask[order]]
+        return self.ids[order[:limit]].tolist()
+
+
+_snapshot = None
+_build_lock = threading.Lock()
+
+
+def get_snapshot():
+    # the snapshot of the current version,
+    # None while another thread builds it
+    global _snapshot
+    version = caching.get_version(VERSION)
+    snapshot = _snapshot
+    if snapshot is not None and snapshot.version == version:
+        return snapshot
+    if not _build_lock.acquire(blocking=False):
+        return None
+    try:
+        snapshot = _snapshot
+        if snapshot is None or snapshot.version != version:
+            # the version is read before the products,
+            # a change committed meanwhile bumps it again
+            snapshot = ProductListSnapshot.build(version)
+            _snapshot = snapshot
+        return snapshot
+    finally:
+        _build_lock.release()
+
+
+def parse_filters(query_params):
+    # the filters of ProductFilter as snapshot.mask() arguments,
+    # None when the request needs the database
+    if any(query_params.get(name) for name in OTHER_FILTER_PARAMS):
+        return None
+    filters = {}
+    collection_id = query_params.get('collection_id')
+    if collection_id:
+        if not collection_id.isdigit():
+            return None
+        filters['collection_id'] = int(collection_id)
+    # unit_price >= min_price, unit_price <= max_price, in whole cents
+    for name, argument, rounding in (('min_price', 'min_cents', ROUND_CEILING),
+                                     ('max_price', 'max_cents', ROUND_FLOOR)):
+        value = query_params.get(name)
+        if not value:
+            continue
+        try:
+            cents = (Decimal(value) * 100).to_integral_value(rounding=rounding)
+        except InvalidOperation:
+            return None
+        if not cents.is_finite():
+            return None
+        filters[argument] = int(cents)
+    return filters
+
+
+def parse_position(field, position):
+    # the json position of a cursor of ProductCursorPagination
+    # as (value, id), None when it's not a position of this ordering
+    try:
+        position = json.loads(position)
+    except ValueError:
+        return None
+    if not isinstance(position, list) or len(position) != 2:
+        return None
+    value, product_id = position
+    if not isinstance(product_id, str) or not product_id.isdigit():
+        return None
+    try:
+        if field == 'unit_price':
+            value = to_cents(value)
+        elif field == 'last_updated_at':
+            value = to_microseconds(parse_datetime(value))
+    except (InvalidOperation, TypeError, ValueError):
+        return None
+    return value, int(product_id)
+
+
+def get_page_ids(request, ordering, position, reverse, limit):
+    # the ids of the products of a product list page in order, with
+    # the ordering and the decoded cursor of ProductCursorPagination,
+    # None when the page has to be read from the database
+    field = ordering[0].lstrip('-')
+    if len(ordering) != 2 or field not in ORDERING_FIELDS:
+        return None
+    filters = parse_filters(request.query_params)
+    if filters is None:
+        return None
+    if position is not None:
+        position = parse_position(field, position)
+        if position is None:
+            return None
+    snapshot = get_snapshot()
+    if snapshot is None:
+        return None
+    # reverse: the previous page, the rows before the position backwards
+    ascending = ordering[0].startswith('-') == reverse
+    return snapshot.page_ids(field, ascending, snapshot.mask(**filters), position, limit)
@@ -0,0 +1,137 @@
+import random
+import statistics
+import time
+from decimal import Decimal
+
+from django.core.management import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from store import stats
+from store.models import Collection, Product
+
+# the filter + ordering combinations of the product list,
+# ordered like ProductCursorPagination orders them (id as the tie-breaker)
+QUERIES = [
+    ('all, by name', {}, ('name', 'id')),
+    ('collection, by name', {'collection_id': 'collection'}, ('name', 'id')),
+    ('collection, by price', {'collection_id': 'collection'}, ('unit_price', 'id')),
+    ('collection, by -price', {'collection_id': 'collection'}, ('-unit_price', '-id')),
+    ('collection + price range, by price',
+     {'collection_id': 'collection', 'unit_price__gte': 10, 'unit_price__lte': 50},
+     ('unit_price', 'id')),
+    ('price range, by price', {'unit_price__gte': 10, 'unit_price__lte': 50}, ('unit_price', 'id')),
+    ('all, by -last_updated_at', {}, ('-last_updated_at', '-id')),
+    ('all, by -popularity', {}, ('-popularity', '-id')),
+]
+
+
+class Command(BaseCommand):
+    help = "Times the product list queries and prints their query plans"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--seed', type=int, default=0,
+            help='first add this many products in bench collections',
+        )
+        parser.add_argument('--collections', type=int, default=20)
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--page-size', type=int, default=20)
+        parser.add_argument(
+            '--compare', action='store_true',
+            help='run without the Product.Meta indexes first, then with them',
+        )
+        parser.add_argument(
+            '--i-know', action='store_true',
+            help='allow --compare without --seed, on a database that is not a bench database',
+        )
+        parser.add_argument('--no-plans', action='store_true')
+
+    def handle(self, *args, **options):
+        # --compare drops the product indexes of the database in the settings,
+        # every product query of the site is a table scan until they're back
+        if options['compare'] and not options['seed'] and not options['i_know']:
+            raise CommandError(
+                '--compare drops the product indexes, '
+                'run it with --seed on a bench database, or pass --i-know'
+            )
+        if options['seed']:
+            self.seed(options['seed'], options['collections'])
+
+        # the biggest collection
+        collection_id = Collection.objects\
+            .filter(product_count__gt=0)\
+            .order_by('-product_count')\
+            .values_list('id', flat=True)\
+            .first()
+        if collection_id is None:
+            self.stdout.write('No products, run with --seed 100000')
+            return
+
+        if options['compare']:
+            indexes = Product._meta.indexes
+            with connection.schema_editor() as schema_editor:
+                for index in indexes:
+                    schema_editor.remove_index(Product, index)
+            try:
+                self.stdout.write(self.style.MIGRATE_HEADING('Without indexes'))
+                self.run(collection_id, options)
+            finally:
+                with connection.schema_editor() as schema_editor:
+                    for index in indexes:
+                        schema_editor.add_index(Product, index)
+            self.stdout.write(self.style.MIGRATE_HEADING('With indexes'))
+        self.run(collection_id, options)
+
+    def run(self, collection_id, options):
+        for label, filters, ordering in QUERIES:
+            filters = {
+                name: collection_id if value == 'collection' else value
+                for name, value in filters.items()
+            }
+            queryset = Product.objects\
+                .filter(**filters)\
+                .order_by(*ordering)[:options['page_size']]
+
+            timings = []
+            for _ in range(options['repeat']):
+                start = time.perf_counter()
+                # all() clones the queryset, otherwise the result cache is reused
+                list(queryset.all())
+                timings.append((time.perf_counter() - start) * 1000)
+
+            self.stdout.write(
+                f'{label:<40} median {statistics.median(timings):8.2f} ms'
+                f'   max {max(timings):8.2f} ms'
+            )
+            if not options['no_plans']:
+                self.stdout.write(queryset.explain())
+                self.stdout.write('')
+
+    def seed(self, count, collection_count):
+        self.stdout.write(f'Adding {count} products...')
+        with transaction.atomic():
+            collections = Collection.objects.bulk_create([
+                Collection(title=f'bench-{index}') for index in range(collection_count)
+            ])
+            # bulk_create doesn't return ids on MySQL
+            collection_ids = list(
+                Collection.objects
+                .filter(title__startswith='bench-')
+                .values_list('id', flat=True)
+            )
+            batch = []
+            for index in range(count):
+                batch.append(Product(
+                    name=f'bench product {random.randrange(10 ** 9):09d}',
+                    slug=f'bench-product-{index}',
+                    inventory=random.randint(1, 100),
+                    unit_price=Decimal(random.randint(100, 99999)) / 100,
+                    collection_id=random.choice(collection_ids),
+                ))
+                if len(batch) == 5000:
+                    Product.objects.bulk_create(batch)
+                    batch = []
+            Product.objects.bulk_create(batch)
+            # bulk_create doesn't send the signals the statistics depend on
+            stats.rebuild(collection_ids)
+        self.stdout.write(f'Added {len(collections)} collections and {count} products')
@@ -0,0 +1,30 @@
+import time
+
+from django.core.management import BaseCommand
+
+from store import snapshots
+
+
+class Command(BaseCommand):
+    help = "Renders the catalog json under SNAPSHOT_ROOT, served as store/catalog/, " \
+           "only what changed since the last build"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--base-url', required=True,
+            help='the scheme and host of the absolute urls, https://shop.example.com',
+        )
+        parser.add_argument('--root', help='SNAPSHOT_ROOT by default')
+        parser.add_argument('--full', action='store_true', help='render everything again')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        builder = snapshots.SnapshotBuilder(
+            options['base_url'], root=options['root'], stdout=self.stdout,
+        )
+        files = builder.build(full=options['full'])
+        if snapshots.brotli is None:
+            self.stderr.write('brotli is not installed, only .gz files were written')
+        self.stdout.write(self.style.SUCCESS(
+            f'Wrote {files} files to {builder.root} in {time.perf_counter() - start:.1f}s'
+        ))
@@ -0,0 +1,17 @@
+import time
+
+from django.core.management import BaseCommand
+
+from store import similarity
+
+
+class Command(BaseCommand):
+    help = "Finds the products with the most similar names and descriptions " \
+           "for products/<id>/similar/"
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        count = similarity.build_similar()
+        self.stdout.write(self.style.SUCCESS(
+            f'Found the similar products of {count} products in {time.perf_counter() - start:.1f}s'
+        ))
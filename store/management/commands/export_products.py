@@ -0,0 +1,24 @@
+import sys
+
+from django.core.management import BaseCommand
+
+from store import exports
+
+
+class Command(BaseCommand):
+    help = "Writes all products with their collection and image urls as NDJSON or CSV"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=list(exports.FORMATS), default='ndjson')
+        parser.add_argument('--output', help='the file to write, stdout by default')
+        parser.add_argument('--chunk-size', type=int, default=exports.CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        lines, content_type = exports.FORMATS[options['format']]
+        products = exports.iter_products(chunk_size=options['chunk_size'])
+        if options['output'] is None:
+            sys.stdout.writelines(lines(products))
+            return
+        with open(options['output'], 'w', newline='') as file:
+            file.writelines(lines(products))
+        self.stderr.write(f'Exported the products to {options["output"]}')
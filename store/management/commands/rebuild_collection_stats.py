@@ -0,0 +1,18 @@
+from django.core.management import BaseCommand
+
+from store import stats
+
+
+class Command(BaseCommand):
+    help = "Recomputes the product count and price statistics of collections"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'collection_ids', nargs='*', type=int,
+            help='only rebuild these collections',
+        )
+
+    def handle(self, *args, **options):
+        collection_ids = options['collection_ids'] or None
+        count = stats.rebuild(collection_ids)
+        self.stdout.write(f'Rebuilt the statistics of {count} collections')
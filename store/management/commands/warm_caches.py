@@ -0,0 +1,157 @@
+import statistics
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.management import BaseCommand
+from django.db import connections
+from django.test import Client
+
+from store import trending
+from store.models import Collection, Product
+
+# fills the response caches after a deploy, before the first users arrive:
+#   the product list and facets of all products,
+#   the first pages of the product list of the largest collections,
+#   the facets (product counts by collection and price) of these collections,
+#   the details of the most viewed products (most sold without view counts).
+# the requests go through the views with the test client, so the cache keys
+# are exactly the keys of real requests, the host is part of the keys.
+# the details it requests don't add to the trending view counts.
+#
+# the release phase runs it after the migrations, warming is best effort:
+# every error (redis or the database unavailable) is written to stderr and
+# the command still exits with 0, the deploy goes on with cold caches.
+
+
+def default_base_url():
+    hosts = [host for host in settings.ALLOWED_HOSTS if host not in ('*', '') and not host.startswith('.')]
+    if hosts:
+        return f'https://{hosts[0]}'
+    return 'http://localhost'
+
+
+class Command(BaseCommand):
+    help = "Fills the product response caches, run after the migrations of a deploy"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--base-url', default=None,
+            help='the scheme and host of the site, https://<first of ALLOWED_HOSTS> by default',
+        )
+        parser.add_argument('--collections', type=int, default=20,
+                            help='the largest collections to warm')
+        parser.add_argument('--pages', type=int, default=3,
+                            help='product list pages per collection')
+        parser.add_argument('--products', type=int, default=100,
+                            help='product details to warm')
+        parser.add_argument('--concurrency', type=int, default=8)
+
+    def handle(self, *args, **options):
+        try:
+            self.warm(options)
+        except Exception as error:
+            self.stderr.write(self.style.WARNING(f'Cache warm-up skipped: {error!r}'))
+
+    def warm(self, options):
+        base_url = urlsplit(options['base_url'] or default_base_url())
+        self.host = base_url.netloc
+        self.secure = base_url.scheme == 'https'
+
+        jobs = [
+            ('products', self.warm_pages, '/store/products/', options['pages']),
+            ('facets', self.warm_url, '/store/products/facets/'),
+        ]
+        collection_ids = Collection.objects\
+            .order_by('-product_count')\
+            .values_list('id', flat=True)[:options['collections']]
+        for collection_id in collection_ids:
+            jobs.append((
+                'collection pages', self.warm_pages,
+                f'/store/products/?collection_id={collection_id}', options['pages'],
+            ))
+            jobs.append((
+                'collection facets', self.warm_url,
+                f'/store/products/facets/?collection_id={collection_id}',
+            ))
+        for product_id in self.most_viewed(options['products']):
+            jobs.append(('product details', self.warm_url, f'/store/products/{product_id}/'))
+
+        timings = defaultdict(list)
+        failures = 0
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+            futures = {
+                executor.submit(self.run_job, function, *args): label
+                for label, function, *args in jobs
+            }
+            for future in as_completed(futures):
+                try:
+                    timings[futures[future]] += future.result()
+                except Exception as error:
+                    failures += 1
+                    self.stderr.write(f'{futures[future]}: {error}')
+        elapsed = time.perf_counter() - start
+
+        for label, values in timings.items():
+            self.stdout.write(
+                f'{label:<20} {len(values):5} requests'
+                f'   median {statistics.median(values):8.2f} ms'
+                f'   max {max(values):8.2f} ms'
+            )
+        style = self.style.SUCCESS if not failures else self.style.WARNING
+        self.stdout.write(style(
+            f'Warmed {sum(len(values) for values in timings.values())} responses '
+            f'in {elapsed:.1f}s with {options["concurrency"]} threads, {failures} failed'
+        ))
+
+    def most_viewed(self, count):
+        if count <= 0:
+            return []
+        try:
+            ids = [product_id for product_id, _ in trending.top(trending.VIEWS, '24h', count)]
+        except Exception as error:
+            self.stderr.write(f'view counts: {error!r}')
+            ids = []
+        # without the deleted products
+        ids = list(Product.objects.filter(id__in=ids).values_list('id', flat=True))
+        if len(ids) < count:
+            # no view counts yet after a redis restart, or redis is down
+            ids += Product.objects\
+                .exclude(id__in=ids)\
+                .order_by('-popularity')\
+                .values_list('id', flat=True)[:count - len(ids)]
+        return ids
+
+    def run_job(self, function, *args):
+        # every thread has its own database connection,
+        # the product details it requests aren't counted as views
+        try:
+            return function(Client(HTTP_HOST=self.host, **{trending.NOT_COUNTED: True}), *args)
+        finally:
+            connections.close_all()
+
+    def get(self, client, url):
+        # returns the response and the time it took in ms
+        start = time.perf_counter()
+        response = client.get(url, secure=self.secure)
+        elapsed = (time.perf_counter() - start) * 1000
+        if response.status_code != 200:
+            raise ValueError(f'{url} returned {response.status_code}')
+        return response, elapsed
+
+    def warm_url(self, client, url):
+        _, elapsed = self.get(client, url)
+        return [elapsed]
+
+    def warm_pages(self, client, url, pages):
+        # the first page and the next links after it
+        timings = []
+        while url is not None and len(timings) < pages:
+            response, elapsed = self.get(client, url)
+            timings.append(elapsed)
+            next_url = response.json().get('next')
+            url = urlsplit(next_url)._replace(scheme='', netloc='').geturl() if next_url else None
+        return timings
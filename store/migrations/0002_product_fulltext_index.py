@@ -0,0 +1,47 @@
+from django.db import migrations
+
+# full text indexes for store.search, the other databases
+# (SQLite in tests) use the in-memory index and need nothing here
+
+FORWARD_SQL = {
+    'mysql': [
+        'ALTER TABLE `store_product` '
+        'ADD FULLTEXT INDEX `store_product_fulltext` (`name`, `description`)',
+    ],
+    'postgresql': [
+        'CREATE INDEX "store_product_fulltext" ON "store_product" '
+        'USING GIN (to_tsvector(\'english\', '
+        'coalesce("store_product"."name", \'\') || \' \' || '
+        'coalesce("store_product"."description", \'\')))',
+    ],
+}
+
+REVERSE_SQL = {
+    'mysql': [
+        'ALTER TABLE `store_product` DROP INDEX `store_product_fulltext`',
+    ],
+    'postgresql': [
+        'DROP INDEX "store_product_fulltext"',
+    ],
+}
+
+
+def create_fulltext_index(apps, schema_editor):
+    for sql in FORWARD_SQL.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(sql)
+
+
+def drop_fulltext_index(apps, schema_editor):
+    for sql in REVERSE_SQL.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fulltext_index, drop_fulltext_index),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 3.2.11 on 2026-10-18 17:25
+
+from django.db import migrations, models
+from django.db.models import Count, Min, Max
+
+
+def populate_product_stats(apps, schema_editor):
+    Collection = apps.get_model('store', 'Collection')
+    Product = apps.get_model('store', 'Product')
+    stats = Product.objects.order_by().values('collection_id').annotate(
+        count=Count('id'),
+        min_unit_price=Min('unit_price'),
+        max_unit_price=Max('unit_price'),
+        updated_at=Max('last_updated_at'),
+    )
+    for row in stats:
+        Collection.objects.filter(id=row['collection_id']).update(
+            product_count=row['count'],
+            min_unit_price=row['min_unit_price'],
+            max_unit_price=row['max_unit_price'],
+            products_updated_at=row['updated_at'],
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0002_product_fulltext_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='collection',
+            name='max_unit_price',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=6, null=True),
+        ),
+        migrations.AddField(
+            model_name='collection',
+            name='min_unit_price',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=6, null=True),
+        ),
+        migrations.AddField(
+            model_name='collection',
+            name='product_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='collection',
+            name='products_updated_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(populate_product_stats, migrations.RunPython.noop),
+    ]
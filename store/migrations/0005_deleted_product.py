@@ -0,0 +1,26 @@
+# Generated by Django 3.2.11 on 2026-10-18 17:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0004_product_list_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeletedProduct',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('product_id', models.PositiveIntegerField()),
+                ('collection_id', models.PositiveIntegerField()),
+                ('deleted_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='deletedproduct',
+            index=models.Index(fields=['deleted_at'], name='store_delprod_deleted_idx'),
+        ),
+    ]
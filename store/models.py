@@ -23,6 +23,18 @@ class Collection(models.Model):
         related_query_name='featured_collection',
     )
 
+    # statistics of the products in the collection,
+    # stored here so the collection pages don't need COUNT and GROUP BY
+    # over the product table, maintained by store/stats.py
+    product_count = models.PositiveIntegerField(default=0)
+    min_unit_price = models.DecimalField(
+        max_digits=6, decimal_places=2, null=True, blank=True,
+    )
+    max_unit_price = models.DecimalField(
+        max_digits=6, decimal_places=2, null=True, blank=True,
+    )
+    products_updated_at = models.DateTimeField(null=True, blank=True)
+
     # type annotation
     def __str__(self) -> str:
         # return super().__str__()
@@ -39,6 +51,11 @@ class Promotion(models.Model):
     # https://www.sankalpjonna.com/learn-django/the-right-way-to-use-a-manytomanyfield-in-django
 
 
+# Decimal(1.2) is built from a float,
+# built once here instead of for every product
+PRICE_WITH_TAX2_FACTOR = Decimal(1.2)
+
+
 class Product(models.Model):
     name = models.CharField(max_length=255)
     slug = models.SlugField(max_length=255, null=True)
@@ -57,18 +74,114 @@ class Product(models.Model):
 
     collection = models.ForeignKey(Collection, on_delete=models.PROTECT)
 
+    # the number of units sold, for ?ordering=-popularity,
+    # added up from the new order items by store/popularity.py
+    popularity = models.PositiveIntegerField(default=0)
+
     # ManyToManyField
     # optional when creating a record, it would be an empty list if it's not set
     promotions = models.ManyToManyField(Promotion)
 
     def get_price_with_tax2(self):
-        return self.unit_price * Decimal(1.2)
+        return self.unit_price * PRICE_WITH_TAX2_FACTOR
+
+    # keep the values loaded from the database,
+    # the signal handlers compare them with the saved values
+    # to find out whether the product moved to another collection
+    # https://docs.djangoproject.com/en/3.2/ref/models/instances/#customizing-model-loading
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def get_loaded_value(self, attname):
+        # the value before the current change,
+        # the current value if the product was never loaded or saved
+        loaded_values = getattr(self, '_loaded_values', {})
+        return loaded_values.get(attname, getattr(self, attname))
+
+    def save(self, *args, **kwargs):
+        # the post_save handlers still see the values loaded before,
+        # afterwards the saved values are the loaded values for the next save
+        super().save(*args, **kwargs)
+        self._loaded_values = {
+            field.attname: getattr(self, field.attname)
+            for field in self._meta.concrete_fields
+        }
 
     def __str__(self) -> str:
         return self.name + ', ' + str(self.inventory)
 
     class Meta:
         ordering = ['name']
+        # the access patterns of the product list:
+        # ProductFilter filters by collection_id and a unit_price range,
+        # the list is ordered by name (default), unit_price or last_updated_at.
+        # the composite indexes serve the filter and the ordering together,
+        # a page of a collection ordered by price is a range scan of 20 rows.
+        # compare the query plans with `manage.py benchmark_product_queries`
+        indexes = [
+            models.Index(fields=['collection', 'unit_price'], name='store_prod_coll_price_idx'),
+            models.Index(fields=['collection', 'name'], name='store_prod_coll_name_idx'),
+            models.Index(fields=['name'], name='store_prod_name_idx'),
+            models.Index(fields=['unit_price'], name='store_prod_price_idx'),
+            models.Index(fields=['last_updated_at'], name='store_prod_updated_idx'),
+            models.Index(fields=['popularity'], name='store_prod_popularity_idx'),
+        ]
+
+
+# a row for every deleted product, the product changes endpoint
+# (products/changes/?updated_since=) returns the ids deleted since then,
+# see store/sync.py
+class DeletedProduct(models.Model):
+    # not a foreign key, the product is gone
+    product_id = models.PositiveIntegerField()
+    collection_id = models.PositiveIntegerField()
+    deleted_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['deleted_at'], name='store_delprod_deleted_idx'),
+        ]
+
+
+# the append-only change log of the catalog, written by the signal handlers,
+# read by the consumers from an offset (the id) with store/changes/,
+# see store/change_log.py
+class CatalogChange(models.Model):
+    KIND_PRODUCT = 'product'
+    KIND_COLLECTION = 'collection'
+    KIND_PRODUCT_IMAGE = 'product_image'
+    KIND_REVIEW = 'review'
+    KIND_CHOICES = [
+        (KIND_PRODUCT, 'Product'),
+        (KIND_COLLECTION, 'Collection'),
+        (KIND_PRODUCT_IMAGE, 'Product image'),
+        (KIND_REVIEW, 'Review'),
+    ]
+
+    ACTION_CREATED = 'created'
+    ACTION_UPDATED = 'updated'
+    ACTION_DELETED = 'deleted'
+    ACTION_CHOICES = [
+        (ACTION_CREATED, 'Created'),
+        (ACTION_UPDATED, 'Updated'),
+        (ACTION_DELETED, 'Deleted'),
+    ]
+
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    action = models.CharField(max_length=10, choices=ACTION_CHOICES)
+    # not foreign keys, the objects can be gone
+    object_id = models.PositiveIntegerField()
+    # the product of a product, an image or a review, null for a collection
+    product_id = models.PositiveIntegerField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at'], name='store_catchange_created_idx'),
+        ]
 
 
 # product and image: one to many
@@ -196,6 +309,13 @@ class OrderItem(models.Model):
     unit_price = models.DecimalField(max_digits=6, decimal_places=2)
 
 
+# the order items already counted in Product.popularity,
+# a single row, see store/popularity.py
+class PopularityState(models.Model):
+    last_order_item_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
 class Cart(models.Model):
     # anonymous user can place cart
     # the primary id is an integer, easy to hack
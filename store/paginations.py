@@ -1,4 +1,147 @@
-from rest_framework.pagination import PageNumberPagination
+import json
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.filters import OrderingFilter
+from rest_framework.pagination import PageNumberPagination, CursorPagination, _reverse_ordering
+
+from store import list_snapshot, search
+
 
 class ProductPageNumberPagination(PageNumberPagination):
-    page_size = 20
\ No newline at end of file
+    page_size = 20
+
+
+# keyset (cursor) pagination
+# page number pagination runs COUNT(*) and OFFSET n for every page,
+# the deeper the page, the more rows the database has to skip.
+# cursor pagination remembers the position of the last row on the page
+# and asks for the rows after it: WHERE (name, id) > (last_name, last_id)
+# so page 500 costs the same as page 1.
+#
+# the cursor pagination in DRF only filters on the first ordering field and
+# counts duplicates with an offset, here every ordering field is part of the
+# position and id is always appended as the tie-breaker,
+# positions are unique and the offset is always 0.
+class ProductCursorPagination(CursorPagination):
+    page_size = 20
+    # the same default ordering as Product.Meta.ordering
+    ordering = ('name', 'id')
+
+    def get_ordering(self, request, queryset, view):
+        # the ordering from OrderingFilter (?ordering=-unit_price) if it's valid,
+        # otherwise the default ordering above,
+        # CursorPagination.get_ordering asserts the view has a default ordering
+        ordering = OrderingFilter().get_ordering(request, queryset, view)
+        if not ordering and search.RANK_FIELD in queryset.query.annotations:
+            # search results are ordered by relevance by default
+            ordering = ('-' + search.RANK_FIELD,)
+        ordering = ordering or self.ordering
+        ordering = [
+            field for field in ordering
+            if field.lstrip('-') not in ('id', 'pk')
+        ]
+        # the tie-breaker follows the direction of the first field
+        tie_breaker = '-id' if ordering and ordering[0].startswith('-') else 'id'
+        return tuple(ordering) + (tie_breaker,)
+
+    def _get_position_from_instance(self, instance, ordering):
+        # a json list with one value per ordering field
+        # ["Bread", "1"], ["12.50", "2022-01-25 23:36:23+00:00", "7"]
+        values = [str(getattr(instance, field.lstrip('-'))) for field in ordering]
+        return json.dumps(values)
+
+    def get_keyset_filter(self, position, reverse):
+        # lexicographic comparison over all ordering fields:
+        # (a > x) OR (a = x AND b > y) OR (a = x AND b = y AND id > z)
+        try:
+            values = json.loads(position)
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(values, list) or len(values) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+
+        condition = Q()
+        equal = Q()
+        for field, value in zip(self.ordering, values):
+            attr = field.lstrip('-')
+            # Test for: (cursor reversed) XOR (field reversed)
+            lookup = 'lt' if reverse != field.startswith('-') else 'gt'
+            condition |= equal & Q(**{f'{attr}__{lookup}': value})
+            equal &= Q(**{attr: value})
+        return condition
+
+    def get_snapshot_results(self, queryset, request, position, reverse):
+        # the ids of the page from the snapshot of the worker,
+        # only these products from the database, see store/list_snapshot.py
+        ids = list_snapshot.get_page_ids(
+            request, self.ordering, position, reverse, self.page_size + 1,
+        )
+        if ids is None:
+            return None
+        products = {product.id: product for product in queryset.filter(id__in=ids)}
+        return [products[product_id] for product_id in ids if product_id in products]
+
+    def paginate_queryset(self, queryset, request, view=None):
+        # the same flow as CursorPagination.paginate_queryset,
+        # only the filtering by the position is replaced by the keyset filter
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+
+        self.cursor = self.decode_cursor(request)
+        if self.cursor is None:
+            (offset, reverse, current_position) = (0, False, None)
+        else:
+            (offset, reverse, current_position) = self.cursor
+
+        # fetch an extra item to know if there is a following page
+        results = None
+        if getattr(view, 'list_snapshot', False) and offset == 0:
+            results = self.get_snapshot_results(queryset, request, current_position, reverse)
+        if results is None:
+            if reverse:
+                queryset = queryset.order_by(*_reverse_ordering(self.ordering))
+            else:
+                queryset = queryset.order_by(*self.ordering)
+
+            if current_position is not None:
+                queryset = queryset.filter(
+                    self.get_keyset_filter(current_position, reverse)
+                )
+
+            results = list(queryset[offset:offset + self.page_size + 1])
+        self.page = list(results[:self.page_size])
+
+        if len(results) > len(self.page):
+            has_following_position = True
+            following_position = self._get_position_from_instance(
+                results[-1], self.ordering
+            )
+        else:
+            has_following_position = False
+            following_position = None
+
+        if reverse:
+            self.page = list(reversed(self.page))
+            self.has_next = (current_position is not None) or (offset > 0)
+            self.has_previous = has_following_position
+            if self.has_next:
+                self.next_position = current_position
+            if self.has_previous:
+                self.previous_position = following_position
+        else:
+            self.has_next = has_following_position
+            self.has_previous = (current_position is not None) or (offset > 0)
+            if self.has_next:
+                self.next_position = following_position
+            if self.has_previous:
+                self.previous_position = current_position
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+
+        return self.page
@@ -0,0 +1,70 @@
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import F, Sum, Case, When, Value, Max, IntegerField
+from django.utils import timezone
+
+from store import caching
+from store.models import OrderItem, PopularityState, Product
+
+# Product.popularity: the units sold of each product, for ?ordering=-popularity
+#
+# summing the order items for every product list request is a GROUP BY over
+# all order items. the sums are stored on the product instead,
+# update_popularity (a periodic celery task, store/tasks.py) adds the
+# order items created since the last run, the last counted order item id
+# is kept in PopularityState.
+#
+# an order item id is taken when the row is inserted, an order which commits
+# late can have lower ids than items that were already counted.
+# only the items of orders placed SETTLE_SECONDS ago are counted,
+# by then the transaction that placed the order has committed.
+
+# the cache key of a product list ordered by popularity has this version too,
+# see caching.product_list_version
+VERSION = 'popularity'
+
+SETTLE_SECONDS = 60
+
+# products updated by one UPDATE ... CASE
+BATCH_SIZE = 500
+
+
+def update_popularity():
+    # returns the number of products that changed
+    with transaction.atomic():
+        # the row lock keeps two runs from counting the same items
+        PopularityState.objects.get_or_create(id=1)
+        state = PopularityState.objects.select_for_update().get(id=1)
+
+        settled = timezone.now() - timedelta(seconds=SETTLE_SECONDS)
+        last_id = OrderItem.objects\
+            .filter(id__gt=state.last_order_item_id, order__placed_at__lte=settled)\
+            .aggregate(last_id=Max('id'))['last_id']
+        if last_id is None:
+            return 0
+
+        sold = dict(
+            OrderItem.objects
+            .filter(id__gt=state.last_order_item_id, id__lte=last_id)
+            .order_by()
+            .values('product_id')
+            .annotate(quantity=Sum('quantity'))
+            .values_list('product_id', 'quantity')
+        )
+        product_ids = sorted(sold)
+        for start in range(0, len(product_ids), BATCH_SIZE):
+            batch = product_ids[start:start + BATCH_SIZE]
+            Product.objects.filter(id__in=batch).update(popularity=F('popularity') + Case(
+                *[When(id=product_id, then=Value(sold[product_id])) for product_id in batch],
+                default=Value(0),
+                output_field=IntegerField(),
+            ))
+
+        state.last_order_item_id = last_id
+        state.save()
+
+        # only the cached product lists ordered by popularity,
+        # the other lists, the facets and the details don't change
+        caching.bump_versions_on_commit(VERSION)
+    return len(product_ids)
@@ -0,0 +1,193 @@
+import threading
+from decimal import Decimal, ROUND_HALF_UP
+from typing import NamedTuple
+
+from django.db.models import DecimalField, F, Func, Max, OuterRef, Subquery, Value
+from django.db.models.functions import Cast, Coalesce, Greatest, Least
+
+from store import caching
+from store.models import Product, Promotion
+
+# the prices of products, cart items and order items in one place
+#
+#   price           the unit price of the product
+#   discount        the best discount of the promotions of the product,
+#                   Promotion.discount is a fraction, 0.2 is 20% off.
+#                   promotions don't stack, the largest discount wins
+#   effective       price - discount, what the customer pays before tax
+#   tax             TAX_RATE of the effective price
+#   with tax        effective + tax
+# every amount is rounded to cents, half up, with Decimal arithmetic
+# (not the old unit_price * Decimal(1.1), a factor built from a float).
+#
+# the discount of every product with a promotion is read with one GROUP BY
+# and kept in the memory of the process as a PriceBook,
+# a page, a cart or an order is then priced without any query.
+# the 'promotions' version is bumped by the signal handlers when a promotion
+# or the promotions of a product change, get_price_book() reads the version
+# (one cache read) and loads the discounts again when it changed.
+# Promotion has no start or end date, every promotion is active.
+
+TAX_RATE = Decimal('0.1')
+CENT = Decimal('0.01')
+
+VERSION = 'promotions'
+
+
+def to_cents(value):
+    return value.quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+class Price(NamedTuple):
+    unit_price: Decimal
+    discount: Decimal
+    effective_price: Decimal
+    tax: Decimal
+    price_with_tax: Decimal
+
+
+class Line(NamedTuple):
+    product_id: int
+    quantity: int
+    price: Price
+    total_price: Decimal
+    total_discount: Decimal
+    total_tax: Decimal
+
+
+class Quote(NamedTuple):
+    lines: list
+    # before the discounts
+    subtotal: Decimal
+    discount: Decimal
+    # after the discounts, before tax
+    total_price: Decimal
+    tax: Decimal
+    total_price_with_tax: Decimal
+
+
+class PriceBook:
+    def __init__(self, discounts):
+        # product id -> discount rate, products without promotions are missing
+        self.discounts = discounts
+
+    def price(self, product_id, unit_price):
+        discount = to_cents(unit_price * self.discounts.get(product_id, 0))
+        effective_price = unit_price - discount
+        tax = to_cents(effective_price * TAX_RATE)
+        return Price(unit_price, discount, effective_price, tax, effective_price + tax)
+
+    def line(self, product_id, unit_price, quantity):
+        price = self.price(product_id, unit_price)
+        return Line(
+            product_id,
+            quantity,
+            price,
+            price.effective_price * quantity,
+            price.discount * quantity,
+            price.tax * quantity,
+        )
+
+    def quote(self, items):
+        # items: cart items or order items with their products,
+        # priced from the current unit price of the product
+        lines = [
+            self.line(item.product_id, item.product.unit_price, item.quantity)
+            for item in items
+        ]
+        subtotal = sum((line.price.unit_price * line.quantity for line in lines), Decimal(0))
+        discount = sum((line.total_discount for line in lines), Decimal(0))
+        total_price = subtotal - discount
+        tax = sum((line.total_tax for line in lines), Decimal(0))
+        return Quote(lines, subtotal, discount, total_price, tax, total_price + tax)
+
+
+def load_discounts():
+    rows = Product.promotions.through.objects\
+        .values('product_id')\
+        .annotate(discount=Max('promotion__discount'))\
+        .values_list('product_id', 'discount')
+    # the float of the promotion as a decimal, between 0 and 1
+    return {
+        product_id: min(max(Decimal(str(discount)), Decimal(0)), Decimal(1))
+        for product_id, discount in rows
+    }
+
+
+# the same prices as annotations, for filtering and ordering in the database:
+# ?min_price_with_tax=10 and ?ordering=price_with_tax on the product list.
+# the serializers read the annotations when they are there.
+
+class Cents(Cast):
+    # CAST(ROUND(expression, 2) AS DECIMAL(8, 2)), read back as a Decimal in cents.
+    # the cursor of ProductCursorPagination keeps str() of the value and finds
+    # the ties with =. SQLite computes with floats (12.37 + 1.24 is
+    # 13.609999999999999) and only compares a CAST with the '13.61' of the
+    # cursor as a number, every step is rounded and cast
+    def __init__(self, expression):
+        # Round() has no precision argument in Django 3.2
+        super().__init__(
+            Func(expression, Value(2), function='ROUND'),
+            DecimalField(max_digits=8, decimal_places=2),
+        )
+
+    def get_db_converters(self, connection):
+        return super().get_db_converters(connection) + [self.quantize_cents]
+
+    @staticmethod
+    def quantize_cents(value, expression, connection):
+        # 15.1300000000000 from the float of SQLite
+        return None if value is None else to_cents(value)
+
+
+def annotate_prices(queryset):
+    # the best discount of the promotions of the product, 0 without promotions
+    best_discount = Subquery(
+        Promotion.objects
+        .filter(product=OuterRef('pk'))
+        .order_by('-discount')
+        .values('discount')[:1]
+    )
+    # the float as an exact decimal, like Decimal(str(discount)) above
+    discount_rate = Cast(
+        Greatest(Least(Coalesce(best_discount, Value(0.0)), Value(1.0)), Value(0.0)),
+        DecimalField(max_digits=5, decimal_places=4),
+    )
+    return queryset.annotate(
+        discount=Cents(F('unit_price') * discount_rate),
+    ).annotate(
+        effective_price=Cents(F('unit_price') - F('discount')),
+    ).annotate(
+        price_with_tax=Cents(
+            F('effective_price') + Cents(F('effective_price') * Value(TAX_RATE)),
+        ),
+    )
+
+
+def price_from_annotations(product):
+    # the Price of a product from annotate_prices, None without the annotations
+    if not hasattr(product, 'price_with_tax'):
+        return None
+    return Price(
+        product.unit_price,
+        product.discount,
+        product.effective_price,
+        product.price_with_tax - product.effective_price,
+        product.price_with_tax,
+    )
+
+
+_book = None
+_book_version = None
+_book_lock = threading.Lock()
+
+
+def get_price_book():
+    global _book, _book_version
+    version = caching.get_version(VERSION)
+    if _book is None or version != _book_version:
+        with _book_lock:
+            if _book is None or version != _book_version:
+                _book = PriceBook(load_discounts())
+                _book_version = version
+    return _book
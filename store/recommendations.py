@@ -0,0 +1,175 @@
+import json
+import threading
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+import numpy as np
+from django.db.models import Max
+from django.utils import timezone
+from scipy import sparse
+
+from store import caching
+from store.models import Order, OrderItem
+
+# frequently bought together: products/<id>/related/
+#
+# two products are bought together when they are in the same order.
+# update_related (a periodic celery task, store/tasks.py) reads the
+# (order_id, product_id) pairs of the orders placed since the last run as
+# NumPy arrays, builds the sparse order x product matrix A (1 when the product
+# is in the order) and counts every pair at once: A.T @ A is the
+# product x product co-occurrence matrix of these orders, the diagonal is
+# dropped. the counts are added to redis sorted sets, one per product,
+#   store:related:counts:42     other product id -> orders with both
+# and the TOP_K products with the highest counts of every product that changed
+# are written to one key, the related action reads only that key:
+#   store:related:42            [17, 5, 8, ...]
+# the last counted order id is kept in redis too, the counts and the
+# position are lost together, a run after a redis flush counts all orders.
+#
+# order ids are taken at insert, like store/popularity.py only the orders
+# placed SETTLE_SECONDS ago decide how far a run goes.
+#
+# with a cache that is not django_redis (tests, local development)
+# everything is kept in the memory of the process instead.
+
+TOP_K = 20
+
+SETTLE_SECONDS = 60
+
+# orders counted with one matrix, bounds the memory of a run
+BATCH_SIZE = 10000
+
+COUNTS_KEY = 'store:related:counts:{}'
+NEIGHBORS_KEY = 'store:related:{}'
+LAST_ORDER_KEY = 'store:related:last_order_id'
+LOCK_KEY = 'store:related:lock'
+# a run that takes longer than this lets the next one start
+LOCK_TIMEOUT = 60 * 60
+
+
+def co_occurrences(order_ids, product_ids):
+    # order_ids, product_ids: the order items as two arrays of the same length
+    # returns three arrays: product id, other product id, orders with both
+    if len(order_ids) == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+    products, columns = np.unique(product_ids, return_inverse=True)
+    _, rows = np.unique(order_ids, return_inverse=True)
+    matrix = sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.int32), (rows, columns)),
+        shape=(rows.max() + 1, len(products)),
+    )
+    # the same product twice in an order is one order
+    matrix.data[:] = 1
+    counts = (matrix.T @ matrix).tocoo()
+    pairs = counts.row != counts.col
+    return products[counts.row[pairs]], products[counts.col[pairs]], counts.data[pairs]
+
+
+class RedisStore:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def lock(self):
+        return self.connection.lock(LOCK_KEY, timeout=LOCK_TIMEOUT, blocking_timeout=0)
+
+    def get_last_order_id(self):
+        return int(self.connection.get(LAST_ORDER_KEY) or 0)
+
+    def add_counts(self, product_ids, other_ids, counts, last_order_id):
+        pipeline = self.connection.pipeline(transaction=False)
+        for product_id, other_id, count in zip(product_ids.tolist(), other_ids.tolist(), counts.tolist()):
+            pipeline.zincrby(COUNTS_KEY.format(product_id), count, other_id)
+        pipeline.set(LAST_ORDER_KEY, last_order_id)
+        pipeline.execute()
+
+    def update_neighbors(self, product_ids):
+        pipeline = self.connection.pipeline(transaction=False)
+        for product_id in product_ids:
+            pipeline.zrevrange(COUNTS_KEY.format(product_id), 0, TOP_K - 1)
+        tops = pipeline.execute()
+        for product_id, top in zip(product_ids, tops):
+            pipeline.set(NEIGHBORS_KEY.format(product_id), json.dumps([int(member) for member in top]))
+        pipeline.execute()
+
+    def neighbors(self, product_id):
+        value = self.connection.get(NEIGHBORS_KEY.format(product_id))
+        return json.loads(value) if value else []
+
+
+class LocalStore:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.last_order_id = 0
+        self.counts = defaultdict(Counter)
+        self.top = {}
+
+    def lock(self):
+        return self._lock
+
+    def get_last_order_id(self):
+        return self.last_order_id
+
+    def add_counts(self, product_ids, other_ids, counts, last_order_id):
+        for product_id, other_id, count in zip(product_ids.tolist(), other_ids.tolist(), counts.tolist()):
+            self.counts[product_id][other_id] += count
+        self.last_order_id = last_order_id
+
+    def update_neighbors(self, product_ids):
+        for product_id in product_ids:
+            # the highest count first, the lower id first for the same count
+            ranked = sorted(self.counts[product_id].items(), key=lambda item: (-item[1], item[0]))
+            self.top[product_id] = [other_id for other_id, _ in ranked[:TOP_K]]
+
+    def neighbors(self, product_id):
+        return self.top.get(product_id, [])
+
+
+_store = None
+
+
+def get_store():
+    global _store
+    if _store is None:
+        _store = caching.redis_or_local(RedisStore, LocalStore)
+    return _store
+
+
+def related(product_id, limit=TOP_K):
+    # the ids of the products bought together with this product, the most first
+    return get_store().neighbors(product_id)[:limit]
+
+
+def update_related():
+    # returns the number of products with new neighbors,
+    # None when another run holds the lock
+    store = get_store()
+    lock = store.lock()
+    if not lock.acquire(blocking=False):
+        return None
+    try:
+        last_order_id = store.get_last_order_id()
+        settled = timezone.now() - timedelta(seconds=SETTLE_SECONDS)
+        end_order_id = Order.objects\
+            .filter(id__gt=last_order_id, placed_at__lte=settled)\
+            .aggregate(last_id=Max('id'))['last_id']
+        if end_order_id is None:
+            return 0
+
+        changed = set()
+        while last_order_id < end_order_id:
+            batch_end = min(last_order_id + BATCH_SIZE, end_order_id)
+            rows = OrderItem.objects\
+                .filter(order_id__gt=last_order_id, order_id__lte=batch_end)\
+                .values_list('order_id', 'product_id')
+            items = np.array(list(rows), dtype=np.int64).reshape(-1, 2)
+            product_ids, other_ids, counts = co_occurrences(items[:, 0], items[:, 1])
+            store.add_counts(product_ids, other_ids, counts, batch_end)
+            batch_changed = sorted(set(product_ids.tolist()))
+            store.update_neighbors(batch_changed)
+            changed.update(batch_changed)
+            last_order_id = batch_end
+        return len(changed)
+    finally:
+        lock.release()
@@ -0,0 +1,303 @@
+import heapq
+import math
+import re
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Case, When, Value, FloatField, BooleanField, Q
+from django.db.models.expressions import RawSQL
+from django.utils.module_loading import import_string
+
+from store import caching
+from store.models import Product
+
+# full text search over product name and description
+#
+# SearchFilter compiles ?search=bread to
+#   name LIKE '%bread%' OR description LIKE '%bread%'
+# a leading wildcard can't use an index, every keystroke scans the table.
+# the backends here use an inverted index instead:
+#   MySQL       FULLTEXT index on (name, description), MATCH ... AGAINST
+#   PostgreSQL  GIN index on to_tsvector(name || description), @@ to_tsquery
+#   others      an inverted index kept in the memory of the process,
+#               for SQLite and tests
+# the database indexes are created in migration 0002_product_fulltext_index.
+#
+# every backend filters the queryset and annotates search_rank,
+# so the result still works with ProductFilter, ordering and pagination.
+#
+# the in-memory index is updated like store/autocomplete.py: after the commit
+# the worker that saved the product updates its index and bumps the 'search'
+# version, the other workers compare the version at most every
+# VERSION_CHECK_INTERVAL seconds and rebuild when it changed.
+
+# the relevance annotation, ProductCursorPagination orders by it by default
+RANK_FIELD = 'search_rank'
+
+# the longest a word can be, longer words are cut
+MAX_TERM_LENGTH = 40
+
+VERSION = 'search'
+VERSION_CHECK_INTERVAL = 5
+
+
+def tokenize(text):
+    # lower case words, letters and digits only,
+    # the operators of the boolean search syntax (+-*"~<>) are dropped
+    return [word[:MAX_TERM_LENGTH] for word in re.findall(r'\w+', (text or '').lower())]
+
+
+class SearchBackend:
+    # the index of the database backends is maintained by the database,
+    # the in-memory backend overrides the indexing methods
+    def search(self, queryset, query):
+        raise NotImplementedError
+
+    def index_product(self, product):
+        self.index_products([product])
+
+    def index_products(self, products, complete=True):
+        # complete=False when some products have no id (a bulk insert on MySQL)
+        pass
+
+    def remove_product(self, product_id):
+        pass
+
+
+class MySQLFullTextBackend(SearchBackend):
+    # boolean mode, +word* means the word is required and may be a prefix,
+    # so 'brea' already finds 'bread' while typing.
+    # InnoDB doesn't index words shorter than innodb_ft_min_token_size or
+    # stopwords, +tv* or +the* would never match. these words are required
+    # with LIKE instead, on the rows the other words matched
+    min_token_size = 3
+    # the default of innodb_ft_server_stopword_table
+    stopwords = frozenset([
+        'a', 'about', 'an', 'are', 'as', 'at', 'be', 'by', 'com', 'de', 'en',
+        'for', 'from', 'how', 'i', 'in', 'is', 'it', 'la', 'of', 'on', 'or',
+        'that', 'the', 'this', 'to', 'was', 'what', 'when', 'where', 'who',
+        'will', 'with', 'und', 'www',
+    ])
+
+    def is_indexed(self, term):
+        return len(term) >= self.min_token_size and term not in self.stopwords
+
+    def search(self, queryset, query):
+        terms = tokenize(query)
+        if not terms:
+            return queryset.none()
+        for term in terms:
+            if not self.is_indexed(term):
+                queryset = queryset.filter(Q(name__icontains=term) | Q(description__icontains=term))
+        indexed = [term for term in terms if self.is_indexed(term)]
+        if not indexed:
+            # no relevance without the full text index
+            return queryset.annotate(**{RANK_FIELD: Value(0.0, output_field=FloatField())})
+        against = ' '.join(f'+{term}*' for term in indexed)
+        table = connection.ops.quote_name(Product._meta.db_table)
+        match = f'MATCH ({table}.`name`, {table}.`description`) ' \
+                f'AGAINST (%s IN BOOLEAN MODE)'
+        return queryset\
+            .annotate(**{RANK_FIELD: RawSQL(match, (against,), output_field=FloatField())})\
+            .filter(RawSQL(match, (against,), output_field=BooleanField()))
+
+
+class PostgreSQLFullTextBackend(SearchBackend):
+    # the expression must be the same as the expression of the GIN index,
+    # otherwise the index is not used
+    vector = "to_tsvector('english', " \
+             "coalesce({table}.\"name\", '') || ' ' || " \
+             "coalesce({table}.\"description\", ''))"
+
+    def search(self, queryset, query):
+        terms = tokenize(query)
+        if not terms:
+            return queryset.none()
+        tsquery = ' & '.join(f'{term}:*' for term in terms)
+        table = connection.ops.quote_name(Product._meta.db_table)
+        vector = self.vector.format(table=table)
+        rank = f"ts_rank({vector}, to_tsquery('english', %s))"
+        match = f"{vector} @@ to_tsquery('english', %s)"
+        return queryset\
+            .annotate(**{RANK_FIELD: RawSQL(rank, (tsquery,), output_field=FloatField())})\
+            .filter(RawSQL(match, (tsquery,), output_field=BooleanField()))
+
+
+class InMemoryBackend(SearchBackend):
+    # token -> {product_id: weight}
+    # the weight of a word is the number of times it appears,
+    # a word in the name counts NAME_WEIGHT times.
+    # the relevance of a product is the sum of weight * idf over the query words,
+    # a product has to match every query word (prefix match for each word).
+    NAME_WEIGHT = 3
+    # the products with the highest relevance,
+    # the ids end up in a WHERE id IN (...) and a CASE for the rank
+    MAX_RESULTS = 1000
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.postings = defaultdict(dict)
+        # product_id -> tokens, to remove the old postings on updates
+        self.documents = {}
+        # sorted tokens for the prefix lookups, None when it needs a rebuild
+        self.sorted_tokens = None
+        # the 'search' version of the index, None before the first build
+        self.version = None
+        self.checked_at = 0
+
+    def build(self):
+        # the version is read before the products,
+        # a change committed meanwhile bumps it again
+        with self.lock:
+            version = caching.get_version(VERSION)
+            self.postings = defaultdict(dict)
+            self.documents = {}
+            self.sorted_tokens = None
+            products = Product.objects\
+                .values_list('id', 'name', 'description')\
+                .iterator(chunk_size=2000)
+            for product_id, name, description in products:
+                self._add(product_id, name, description)
+            self.version = version
+            self.checked_at = time.monotonic()
+
+    def refresh(self):
+        # built the first time it's used, the cache is read at most
+        # every VERSION_CHECK_INTERVAL seconds
+        now = time.monotonic()
+        if self.version is not None and now - self.checked_at < VERSION_CHECK_INTERVAL:
+            return
+        self.checked_at = now
+        if self.version is None or caching.get_version(VERSION) != self.version:
+            self.build()
+
+    def index_products(self, products, complete=True):
+        added = [(product.id, product.name, product.description) for product in products]
+        self.changed_on_commit(added, [], complete)
+
+    def remove_product(self, product_id):
+        self.changed_on_commit([], [product_id])
+
+    def changed_on_commit(self, added, removed, complete=True):
+        # after the commit: update this worker, bump the version for the others.
+        # when nobody else bumped the version in between, this worker is up to date
+        def apply():
+            version = caching.bump_version(VERSION)
+            with self.lock:
+                if self.version is None:
+                    # not built yet, the build reads the changes from the database
+                    return
+                for product_id in removed:
+                    self._remove(product_id)
+                for product_id, name, description in added:
+                    self._remove(product_id)
+                    self._add(product_id, name, description)
+                if complete and version == self.version + 1:
+                    self.version = version
+        transaction.on_commit(apply)
+
+    def _add(self, product_id, name, description):
+        weights = defaultdict(int)
+        for token in tokenize(name):
+            weights[token] += self.NAME_WEIGHT
+        for token in tokenize(description):
+            weights[token] += 1
+        for token, weight in weights.items():
+            if token not in self.postings:
+                self.sorted_tokens = None
+            self.postings[token][product_id] = weight
+        self.documents[product_id] = list(weights)
+
+    def _remove(self, product_id):
+        for token in self.documents.pop(product_id, []):
+            postings = self.postings[token]
+            postings.pop(product_id, None)
+            if not postings:
+                del self.postings[token]
+                self.sorted_tokens = None
+
+    def _expand(self, term):
+        # all indexed tokens starting with the term
+        if self.sorted_tokens is None:
+            self.sorted_tokens = sorted(self.postings)
+        tokens = []
+        index = bisect_left(self.sorted_tokens, term)
+        while index < len(self.sorted_tokens) \
+                and self.sorted_tokens[index].startswith(term):
+            tokens.append(self.sorted_tokens[index])
+            index += 1
+        return tokens
+
+    def score(self, terms):
+        self.refresh()
+        with self.lock:
+            document_count = len(self.documents) or 1
+            scores = None
+            for term in terms:
+                term_scores = defaultdict(float)
+                for token in self._expand(term):
+                    postings = self.postings[token]
+                    idf = math.log(1 + document_count / len(postings))
+                    for product_id, weight in postings.items():
+                        term_scores[product_id] = max(
+                            term_scores[product_id], weight * idf
+                        )
+                if scores is None:
+                    scores = term_scores
+                else:
+                    # every term is required
+                    scores = {
+                        product_id: score + term_scores[product_id]
+                        for product_id, score in scores.items()
+                        if product_id in term_scores
+                    }
+                if not scores:
+                    return {}
+            return scores or {}
+
+    def search(self, queryset, query):
+        terms = tokenize(query)
+        if not terms:
+            return queryset.none()
+        scores = self.score(terms)
+        if len(scores) > self.MAX_RESULTS:
+            # ProductFilter ran before, rank only the products it kept,
+            # otherwise ?collection_id= loses the matches below the top overall
+            kept = set(queryset.order_by().values_list('id', flat=True))
+            scores = {product_id: score for product_id, score in scores.items() if product_id in kept}
+        top = heapq.nlargest(self.MAX_RESULTS, scores.items(), key=lambda item: item[1])
+        if not top:
+            return queryset.none()
+        rank = Case(
+            *[When(id=product_id, then=Value(score)) for product_id, score in top],
+            output_field=FloatField(),
+        )
+        return queryset\
+            .filter(id__in=[product_id for product_id, score in top])\
+            .annotate(**{RANK_FIELD: rank})
+
+
+VENDOR_BACKENDS = {
+    'mysql': MySQLFullTextBackend,
+    'postgresql': PostgreSQLFullTextBackend,
+}
+
+_backend = None
+
+
+def get_backend():
+    # STORE_SEARCH_BACKEND = 'store.search.InMemoryBackend' in the settings
+    # to choose a backend, otherwise it's chosen by the database vendor
+    global _backend
+    if _backend is None:
+        backend_path = getattr(settings, 'STORE_SEARCH_BACKEND', None)
+        if backend_path:
+            backend_class = import_string(backend_path)
+        else:
+            backend_class = VENDOR_BACKENDS.get(connection.vendor, InMemoryBackend)
+        _backend = backend_class()
+    return _backend
@@ -1,25 +1,65 @@
-from decimal import Decimal
+from collections import defaultdict
+from decimal import Decimal, getcontext
 
+from django.core.files.storage import FileSystemStorage
 from django.db import transaction
 from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.utils.encoding import filepath_to_uri
 from djoser.serializers import UserSerializer
 from rest_framework import serializers
 
 from core.models import User
-from store.models import Product, Collection, Review, Cart, CartItem, Customer, Order, OrderItem, ProductImage
+from store.models import Product, Collection, Review, Cart, CartItem, Customer, Order, OrderItem, ProductImage, \
+    CatalogChange, PRICE_WITH_TAX2_FACTOR
+from store import pricing, trending
 from store.signals import order_created
 
 
+# sparse fieldsets: ?fields=id,title only keeps these fields,
+# ?expand=collection replaces a field with the serializer of the related object.
+# the view puts the requested fields and expansions in the context,
+# see SparseFieldsViewMixin in views.py, which also skips the prefetches
+# of the fields that are not requested
+class SparseFieldsMixin:
+    # field name -> serializer class of the expanded field
+    expandable_fields = {}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for name in self.context.get('expand', ()):
+            if name in self.expandable_fields and name in self.fields:
+                self.fields[name] = self.expandable_fields[name](read_only=True)
+        requested = self.context.get('fields')
+        if requested is not None:
+            for name in set(self.fields) - set(requested):
+                self.fields.pop(name)
+
+
+class CollectionSerializerForItem(serializers.ModelSerializer):
+    class Meta:
+        model = Collection
+        fields = ['id', 'title']
+
+
 class CollectionSerializer(serializers.ModelSerializer):
     class Meta:
         model = Collection
         # id: automatically read-only
-        fields = ['id', 'title', 'product_count', 'featured_product']
-        read_only_fields = []
+        fields = ['id', 'title', 'product_count',
+                  'min_price', 'max_price', 'products_updated_at',
+                  'featured_product']
+        read_only_fields = ['products_updated_at']
         extra_kwargs = {'featured_product': {'required': False,}}
 
     # read_only=True, this field is not for creating and updating
     product_count = serializers.IntegerField(read_only=True)
+    min_price = serializers.DecimalField(
+        max_digits=6, decimal_places=2, source='min_unit_price', read_only=True
+    )
+    max_price = serializers.DecimalField(
+        max_digits=6, decimal_places=2, source='max_unit_price', read_only=True
+    )
     # product_count = serializers.IntegerField(required=False)
 
 
@@ -71,18 +111,51 @@ class ProductSerializerForCreate(serializers.ModelSerializer):
     # it's called by the save() method when trying to create a new product
     # def create(self, validated_data):
     def create(self, data):
+        product = self.build(data)
+        product.save()
+        return product
+
+    # the product of create without saving it, for the bulk create too
+    @staticmethod
+    def build(data):
         product = Product(**data)
         product.slug = f'{product.name}-slug'
         product.description = f'this is a product of {product.name}'
-        product.save()
         return product
 
     # DRF will automatically update the matching fields, primary key won't be updated
     def update(self, instance: Product, validated_data):
-        super().update(instance, validated_data)
-        instance.slug = f'{validated_data["name"]}---slug'
-        instance.save()
-        return instance
+        # super().update(instance, validated_data)
+        # instance.slug = f'{validated_data["name"]}---slug'
+        # instance.save()
+        # the slug is saved by super().update(), one UPDATE instead of two
+        validated_data['slug'] = self.update_slug(instance, validated_data)
+        return super().update(instance, validated_data)
+
+    # for the bulk update too
+    @staticmethod
+    def update_slug(instance: Product, validated_data):
+        return f'{validated_data.get("name", instance.name)}---slug'
+
+
+# the rows of the bulk create and update of products.
+# the collections are looked up in context['collections'], read once
+# for all rows, instead of one query per row
+class CollectionFromContextField(serializers.PrimaryKeyRelatedField):
+    def to_internal_value(self, data):
+        collections = self.context.get('collections')
+        if collections is None:
+            return super().to_internal_value(data)
+        try:
+            return collections[int(data)]
+        except KeyError:
+            self.fail('does_not_exist', pk_value=data)
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+
+
+class ProductSerializerForBulk(ProductSerializerForCreate):
+    collection = CollectionFromContextField(queryset=Collection.objects.all())
 
 
 
@@ -104,7 +177,9 @@ class ProductImageSerializer(serializers.ModelSerializer):
 
 
 
-class ProductSerializer(serializers.ModelSerializer):
+class ProductSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    expandable_fields = {'collection': CollectionSerializerForItem}
+
     images = ProductImageSerializer(
         many=True, read_only=True, source='productimage_set'
     )
@@ -113,6 +188,8 @@ class ProductSerializer(serializers.ModelSerializer):
         fields = ['id',
                   'title',
                   'price',
+                  'discount',
+                  'effective_price',
                   'price_with_tax',
                   'price_with_tax2',
                   'collection',
@@ -124,9 +201,10 @@ class ProductSerializer(serializers.ModelSerializer):
     price = serializers.DecimalField(
         max_digits=6, decimal_places=2, source='unit_price'
     )
-    price_with_tax = serializers.SerializerMethodField(
-        method_name='calculate_tax',
-    )
+    # the discount of the promotions and the tax, see store/pricing.py
+    discount = serializers.SerializerMethodField()
+    effective_price = serializers.SerializerMethodField()
+    price_with_tax = serializers.SerializerMethodField()
     price_with_tax2 = serializers.DecimalField(
         max_digits=6, decimal_places=2,
         source='get_price_with_tax2',
@@ -142,8 +220,173 @@ class ProductSerializer(serializers.ModelSerializer):
         # lookup_url_kwarg='obj_id',
     )
 
-    def calculate_tax(self, product: Product):
-        return product.unit_price * Decimal(1.1)
+    def get_price(self, product: Product):
+        # the price book is read once for all products of a page,
+        # with many=True this serializer is the child of every row.
+        # the product list has the prices as annotations already
+        price = pricing.price_from_annotations(product)
+        if price is not None:
+            return price
+        if not hasattr(self, 'price_book'):
+            self.price_book = pricing.get_price_book()
+        return self.price_book.price(product.id, product.unit_price)
+
+    def get_discount(self, product: Product):
+        return self.get_price(product).discount
+
+    def get_effective_price(self, product: Product):
+        return self.get_price(product).effective_price
+
+    def get_price_with_tax(self, product: Product):
+        return self.get_price(product).price_with_tax
+
+
+# a read-only fast path with the same output as ProductSerializer.
+# ProductSerializer goes through the generic field machinery for every row:
+# reverse() for the collection hyperlink, Decimal(1.1) and Decimal(1.2)
+# from floats, to_representation of seven fields and the nested images.
+# here everything which is the same for every row is computed once
+# in __init__, the url of a collection is the url template + the id.
+# the output is compared with ProductSerializer in test_products.py
+class CompiledProductSerializer:
+    # a collection id nobody has, replaced in the url template
+    PK_PLACEHOLDER = '__pk__'
+
+    # the same fields in the same order as ProductSerializer
+    FIELD_NAMES = ['id', 'title', 'price', 'discount', 'effective_price',
+                   'price_with_tax', 'price_with_tax2', 'collection', 'images']
+
+    def __init__(self, instance=None, many=False, context=None):
+        self.instance = instance
+        self.many = many
+        self.context = context or {}
+        request = self.context['request']
+        self.build_absolute_uri = request.build_absolute_uri
+
+        # sparse fieldsets, see SparseFieldsMixin
+        requested = self.context.get('fields')
+        self.field_names = [
+            name for name in self.FIELD_NAMES
+            if requested is None or name in requested
+        ]
+        # an expanded field left out by ?fields= is not loaded,
+        # the same as prefetch_requested_fields of the views
+        self.expand = set(self.context.get('expand', ())) & set(self.field_names)
+
+        # http://host/store/collections/__pk__/ -> ('http://host/store/collections/', '/')
+        collection_url = request.build_absolute_uri(
+            reverse('collection-detail', kwargs={'pk': self.PK_PLACEHOLDER})
+        )
+        self.collection_url_prefix, self.collection_url_suffix = \
+            collection_url.split(self.PK_PLACEHOLDER)
+
+        # DecimalField(max_digits=6, decimal_places=2).quantize
+        self.price_context = getcontext().copy()
+        self.price_context.prec = 6
+        self.price_exponent = Decimal('.1') ** 2
+
+        # file system storage urls are MEDIA_URL + the quoted file name
+        self.storage = ProductImage._meta.get_field('image').storage
+        if isinstance(self.storage, FileSystemStorage):
+            self.media_url = request.build_absolute_uri(self.storage.base_url)
+        else:
+            self.media_url = None
+
+        # the discounts of the promotions, see store/pricing.py
+        self.price_book = pricing.get_price_book()
+
+        # field name -> function of a row
+        self.getters = {
+            'id': lambda row: row['id'],
+            'title': lambda row: row['name'],
+            'price': lambda row: self.quantize(row['unit_price']),
+            'discount': lambda row: self.get_price(row).discount,
+            'effective_price': lambda row: self.get_price(row).effective_price,
+            'price_with_tax': lambda row: self.get_price(row).price_with_tax,
+            'price_with_tax2': lambda row: self.quantize(row['unit_price'] * PRICE_WITH_TAX2_FACTOR),
+            'collection': self.get_collection,
+            'images': self.get_images,
+        }
+
+    def quantize(self, value):
+        return value.quantize(self.price_exponent, context=self.price_context)
+
+    def image_url(self, name):
+        if not name:
+            return None
+        if self.media_url is not None:
+            return self.media_url + filepath_to_uri(name).lstrip('/')
+        return self.build_absolute_uri(self.storage.url(name))
+
+    # a row has id, name, unit_price, collection_id,
+    # images as (id, file name) pairs if images are requested,
+    # collection_title if the collection is expanded
+    def get_price(self, row):
+        # computed once for the three price fields of a row
+        if 'price' not in row:
+            row['price'] = self.price_book.price(row['id'], row['unit_price'])
+        return row['price']
+
+    def get_collection(self, row):
+        if 'collection' in self.expand:
+            return {'id': row['collection_id'], 'title': row['collection_title']}
+        return f'{self.collection_url_prefix}{row["collection_id"]}{self.collection_url_suffix}'
+
+    def get_images(self, row):
+        return [
+            {'id': image_id, 'image': self.image_url(image_name)}
+            for image_id, image_name in row['images']
+        ]
+
+    def to_dict(self, row):
+        # only the requested fields are computed
+        return {name: self.getters[name](row) for name in self.field_names}
+
+    def to_representation(self, product: Product):
+        row = {
+            'id': product.id,
+            'name': product.name,
+            'unit_price': product.unit_price,
+            'collection_id': product.collection_id,
+        }
+        price = pricing.price_from_annotations(product)
+        if price is not None:
+            row['price'] = price
+        if 'images' in self.field_names:
+            # the images come from prefetch_related('productimage_set')
+            row['images'] = [
+                (image.id, image.image.name) for image in product.productimage_set.all()
+            ]
+        if 'collection' in self.expand:
+            row['collection_title'] = product.collection.title
+        return self.to_dict(row)
+
+    def values_to_representation(self, queryset):
+        # no model instances at all: one query for the products as tuples,
+        # one query for the images of all products on the page
+        columns = ['id', 'name', 'unit_price', 'collection_id']
+        if 'collection' in self.expand:
+            columns.append('collection__title')
+        keys = ['id', 'name', 'unit_price', 'collection_id', 'collection_title']
+        rows = [dict(zip(keys, values)) for values in queryset.values_list(*columns)]
+
+        if 'images' in self.field_names:
+            images = defaultdict(list)
+            image_rows = ProductImage.objects\
+                .filter(product_id__in=[row['id'] for row in rows])\
+                .order_by('id')\
+                .values_list('product_id', 'id', 'image')
+            for product_id, image_id, image_name in image_rows:
+                images[product_id].append((image_id, image_name))
+            for row in rows:
+                row['images'] = images[row['id']]
+        return [self.to_dict(row) for row in rows]
+
+    @property
+    def data(self):
+        if self.many:
+            return [self.to_representation(product) for product in self.instance]
+        return self.to_representation(self.instance)
 
 
 class ProductSerializerForItem(serializers.ModelSerializer):
@@ -227,6 +470,15 @@ class ReviewSerializer(serializers.ModelSerializer):
         return Review.objects.create(product=product, **validated_data)
 
 
+# a row of the change log, see store/change_log.py
+class CatalogChangeSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = CatalogChange
+        fields = ['offset', 'kind', 'action', 'object_id', 'product_id', 'created_at']
+
+    offset = serializers.IntegerField(source='id')
+
+
 class CartItemSerializer(serializers.ModelSerializer):
     class Meta:
         model = CartItem
@@ -238,20 +490,62 @@ class CartItemSerializer(serializers.ModelSerializer):
     )
 
     def calculate_total_price(self, item: CartItem):
-        return item.product.unit_price * item.quantity
+        # return item.product.unit_price * item.quantity
+        # the line of the cart quote, see CartSerializer.get_quote
+        lines = self.context.get('cart_lines', {})
+        if item.id in lines:
+            return lines[item.id].total_price
+        return pricing.get_price_book().line(
+            item.product_id, item.product.unit_price, item.quantity,
+        ).total_price
 
 
-class CartSerializer(serializers.ModelSerializer):
+class CartSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     items = CartItemSerializer(many=True, read_only=True, source='cartitem_set')
     id = serializers.UUIDField(read_only=True)
+    # after the discounts, before tax
     total_price = serializers.SerializerMethodField()
+    total_discount = serializers.SerializerMethodField()
+    total_tax = serializers.SerializerMethodField()
+    total_price_with_tax = serializers.SerializerMethodField()
+
+    # def get_total_price(self, cart: Cart):
+    #     prices = [
+    #         item.quantity * item.product.unit_price
+    #         for item in cart.cartitem_set.all()
+    #     ]
+    #     return sum(prices)
+
+    def get_quote(self, cart: Cart):
+        # the whole cart is priced once, the items and the totals read the quote
+        quotes = self.context.setdefault('cart_quotes', {})
+        if cart.id not in quotes:
+            if not hasattr(self, 'price_book'):
+                self.price_book = pricing.get_price_book()
+            items = list(cart.cartitem_set.all())
+            quote = self.price_book.quote(items)
+            quotes[cart.id] = quote
+            self.context.setdefault('cart_lines', {}).update(
+                (item.id, line) for item, line in zip(items, quote.lines)
+            )
+        return quotes[cart.id]
+
+    def to_representation(self, cart: Cart):
+        if 'items' in self.fields:
+            self.get_quote(cart)
+        return super().to_representation(cart)
 
     def get_total_price(self, cart: Cart):
-        prices = [
-            item.quantity * item.product.unit_price
-            for item in cart.cartitem_set.all()
-        ]
-        return sum(prices)
+        return self.get_quote(cart).total_price
+
+    def get_total_discount(self, cart: Cart):
+        return self.get_quote(cart).discount
+
+    def get_total_tax(self, cart: Cart):
+        return self.get_quote(cart).tax
+
+    def get_total_price_with_tax(self, cart: Cart):
+        return self.get_quote(cart).total_price_with_tax
 
     class Meta:
         model = Cart
@@ -259,6 +553,9 @@ class CartSerializer(serializers.ModelSerializer):
                   'created_at',
                   'items',
                   'total_price',
+                  'total_discount',
+                  'total_tax',
+                  'total_price_with_tax',
                   ]
         # read_only_fields = ['id']
 
@@ -306,6 +603,8 @@ class CartItemSerializerForCreate(serializers.ModelSerializer):
             # get or filter doesn't distinguish between object and object_pk
             # create does
             self.instance = instance
+        # a redis counter for products/trending/, no database write
+        trending.record(trending.CART_ADDS, product_id)
         # returning the result here gets the right result on the browsable api
         return self.instance
 
@@ -354,7 +653,9 @@ class OrderItemSerializer(serializers.ModelSerializer):
     #     return item.product.unit_price * item.quantity
 
 
-class OrderSerializer(serializers.ModelSerializer):
+class OrderSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    expandable_fields = {'customer': CustomerSerializer}
+
     items = OrderItemSerializer(many=True, read_only=True, source='orderitem_set')
 
     class Meta:
@@ -397,13 +698,16 @@ class OrderSerializerForCreate(serializers.Serializer):
             cart_id = self.validated_data['cart_id']
             cart_items = CartItem.objects\
                 .filter(cart_id=cart_id).select_related('product')
+            # the price after the discounts, like the cart shows it
+            quote = pricing.get_price_book().quote(cart_items)
             order_items = []
-            for item in cart_items:
+            for item, line in zip(cart_items, quote.lines):
                 order_item = OrderItem(
                     order=order,
                     product=item.product,
                     quantity=item.quantity,
-                    unit_price=item.product.unit_price,
+                    # unit_price=item.product.unit_price,
+                    unit_price=line.price.effective_price,
                 )
                 order_items.append(order_item)
             OrderItem.objects.bulk_create(order_items)
@@ -2,4 +2,7 @@
 from django.dispatch import Signal
 
 order_created = Signal()
+# bulk_create and bulk_update don't send post_save,
+# sent with created=[products] and updated=[products] after a bulk write
+products_bulk_saved = Signal()
 # a signal is simply an instance of the Signal class
\ No newline at end of file
@@ -1,8 +1,11 @@
 from django.conf import settings
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
 from django.dispatch import receiver
 
-from store.models import Customer
+from store import autocomplete, caching, change_log, pricing, search, stats
+from store.models import Customer, Product, ProductImage, Collection, Review, DeletedProduct, Cart, \
+    Promotion, CatalogChange
+from store.signals import products_bulk_saved
 
 
 
@@ -20,4 +23,256 @@ def create_customer_for_new_user(sender, **kwargs):
 
 
 # this function is executed unless import to the apps.py in the config class
-# and overwrites the ready method
\ No newline at end of file
+# and overwrites the ready method
+
+
+# bump the versions of the cached product responses,
+# the handlers are connected to both post_save and post_delete
+@receiver([post_save, post_delete], sender=Product)
+def bump_product_versions(sender, **kwargs):
+    product = kwargs['instance']
+    names = {
+        'catalog',
+        f'product:{product.id}',
+        f'collection:{product.collection_id}',
+        # the product moved out of this collection
+        f'collection:{product.get_loaded_value("collection_id")}',
+    }
+    caching.bump_versions_on_commit(*names)
+
+
+@receiver([post_save, post_delete], sender=ProductImage)
+def bump_product_image_versions(sender, **kwargs):
+    image = kwargs['instance']
+    collection_id = Product.objects\
+        .filter(id=image.product_id)\
+        .values_list('collection_id', flat=True)\
+        .first()
+    names = ['catalog', f'product:{image.product_id}']
+    if collection_id is not None:
+        names.append(f'collection:{collection_id}')
+    caching.bump_versions_on_commit(*names)
+
+
+@receiver([post_save, post_delete], sender=Collection)
+def bump_collection_versions(sender, **kwargs):
+    collection = kwargs['instance']
+    caching.bump_versions_on_commit('catalog', f'collection:{collection.id}')
+
+
+@receiver([post_save, post_delete], sender=Review)
+def bump_review_versions(sender, **kwargs):
+    review = kwargs['instance']
+    caching.bump_versions_on_commit(f'reviews:{review.product_id}')
+
+
+# the database full text indexes are maintained by the database,
+# the in-memory index is updated after the commit, see store/search.py
+@receiver(post_save, sender=Product)
+def index_product(sender, **kwargs):
+    search.get_backend().index_product(kwargs['instance'])
+
+
+@receiver(post_delete, sender=Product)
+def remove_product_from_index(sender, **kwargs):
+    search.get_backend().remove_product(kwargs['instance'].id)
+
+
+# keep the product statistics on the collections up to date
+@receiver(post_save, sender=Product)
+def update_collection_stats_on_save(sender, **kwargs):
+    product = kwargs['instance']
+    if kwargs['created']:
+        stats.product_added(product.collection_id, product.unit_price)
+        return
+    old_collection_id = product.get_loaded_value('collection_id')
+    if old_collection_id != product.collection_id:
+        # moved to another collection
+        stats.product_removed(old_collection_id)
+        stats.product_added(product.collection_id, product.unit_price)
+    else:
+        stats.product_changed(
+            product.collection_id,
+            product.unit_price,
+            product.get_loaded_value('unit_price'),
+        )
+
+
+@receiver(post_delete, sender=Product)
+def update_collection_stats_on_delete(sender, **kwargs):
+    stats.product_removed(kwargs['instance'].collection_id)
+
+
+# the tombstones of the product changes endpoint, see store/sync.py
+@receiver(post_delete, sender=Product)
+def record_deleted_product(sender, **kwargs):
+    product = kwargs['instance']
+    DeletedProduct.objects.create(
+        product_id=product.id,
+        collection_id=product.collection_id,
+    )
+
+
+# the autocomplete index only has the product names and collection titles
+@receiver(post_save, sender=Product)
+def update_autocomplete_product(sender, **kwargs):
+    product = kwargs['instance']
+    if kwargs['created'] or product.get_loaded_value('name') != product.name:
+        autocomplete.index_changed(autocomplete.PRODUCT, product.id, product.name)
+
+
+@receiver(post_delete, sender=Product)
+def remove_autocomplete_product(sender, **kwargs):
+    autocomplete.index_changed(autocomplete.PRODUCT, kwargs['instance'].id)
+
+
+@receiver(post_save, sender=Collection)
+def update_autocomplete_collection(sender, **kwargs):
+    collection = kwargs['instance']
+    autocomplete.index_changed(autocomplete.COLLECTION, collection.id, collection.title)
+
+
+@receiver(post_delete, sender=Collection)
+def remove_autocomplete_collection(sender, **kwargs):
+    autocomplete.index_changed(autocomplete.COLLECTION, kwargs['instance'].id)
+
+
+# a new object can have an id that was asked for before it existed,
+# the next product id for example, it must not stay a cached 404
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=Collection)
+@receiver(post_save, sender=Cart)
+def clear_missing_on_create(sender, **kwargs):
+    if kwargs['created']:
+        kind = sender._meta.model_name
+        caching.clear_missing_on_commit(kind, kwargs['instance'].pk)
+
+
+# what the post_save handlers above do, for the products of a bulk write
+# (store/bulk_writes.py), once for all products
+@receiver(products_bulk_saved)
+def update_after_bulk_save(sender, created, updated, **kwargs):
+    products = created + updated
+    collection_ids = {product.collection_id for product in products}
+    collection_ids.update(product.get_loaded_value('collection_id') for product in updated)
+    stats.rebuild(collection_ids)
+    caching.bump_versions_on_commit(
+        'catalog',
+        *(f'collection:{collection_id}' for collection_id in collection_ids),
+        *(f'product:{product.id}' for product in updated),
+    )
+
+    # MySQL doesn't return the ids of bulk inserts
+    complete = all(product.id is not None for product in created)
+    search.get_backend().index_products(
+        [product for product in products if product.id is not None], complete=complete,
+    )
+    changes = []
+    for product in created:
+        if product.id is not None:
+            caching.clear_missing_on_commit('product', product.id)
+            changes.append((autocomplete.PRODUCT, product.id, product.name))
+    for product in updated:
+        if product.get_loaded_value('name') != product.name:
+            changes.append((autocomplete.PRODUCT, product.id, product.name))
+    if changes or not complete:
+        autocomplete.index_changed_many(changes, complete=complete)
+
+
+# the discounts of store/pricing.py and the prices in the cached responses
+def bump_promotion_versions(product_ids):
+    collection_ids = Product.objects\
+        .filter(id__in=product_ids)\
+        .values_list('collection_id', flat=True)\
+        .distinct()
+    caching.bump_versions_on_commit(
+        pricing.VERSION,
+        'catalog',
+        *(f'product:{product_id}' for product_id in product_ids),
+        *(f'collection:{collection_id}' for collection_id in collection_ids),
+    )
+
+
+@receiver(post_save, sender=Promotion)
+@receiver(pre_delete, sender=Promotion)
+def bump_versions_on_promotion_change(sender, **kwargs):
+    # pre_delete, the products of the promotion are gone after the delete
+    product_ids = list(
+        Product.promotions.through.objects
+        .filter(promotion_id=kwargs['instance'].id)
+        .values_list('product_id', flat=True)
+    )
+    bump_promotion_versions(product_ids)
+
+
+@receiver(m2m_changed, sender=Product.promotions.through)
+def bump_versions_on_product_promotions_change(sender, **kwargs):
+    if kwargs['action'] not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if kwargs['reverse']:
+        # promotion.product_set.add(...), pk_set are product ids
+        product_ids = list(kwargs['pk_set'] or [])
+        if kwargs['action'] == 'pre_clear':
+            product_ids = list(kwargs['instance'].product_set.values_list('id', flat=True))
+    else:
+        product_ids = [kwargs['instance'].id]
+    bump_promotion_versions(product_ids)
+
+
+# the change log of store/change_log.py, one row per saved or deleted object
+def saved_action(kwargs):
+    if kwargs['created']:
+        return CatalogChange.ACTION_CREATED
+    return CatalogChange.ACTION_UPDATED
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def log_product_change(sender, **kwargs):
+    product = kwargs['instance']
+    action = saved_action(kwargs) if 'created' in kwargs else CatalogChange.ACTION_DELETED
+    change_log.record(CatalogChange.KIND_PRODUCT, action, product.id, product.id)
+
+
+@receiver(post_save, sender=Collection)
+@receiver(post_delete, sender=Collection)
+def log_collection_change(sender, **kwargs):
+    collection = kwargs['instance']
+    action = saved_action(kwargs) if 'created' in kwargs else CatalogChange.ACTION_DELETED
+    change_log.record(CatalogChange.KIND_COLLECTION, action, collection.id)
+
+
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+def log_product_image_change(sender, **kwargs):
+    image = kwargs['instance']
+    action = saved_action(kwargs) if 'created' in kwargs else CatalogChange.ACTION_DELETED
+    change_log.record(CatalogChange.KIND_PRODUCT_IMAGE, action, image.id, image.product_id)
+
+
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def log_review_change(sender, **kwargs):
+    review = kwargs['instance']
+    action = saved_action(kwargs) if 'created' in kwargs else CatalogChange.ACTION_DELETED
+    change_log.record(CatalogChange.KIND_REVIEW, action, review.id, review.product_id)
+
+
+@receiver(products_bulk_saved)
+def log_bulk_product_changes(sender, created, updated, **kwargs):
+    changes = [
+        change_log.change(CatalogChange.KIND_PRODUCT, CatalogChange.ACTION_CREATED, product.id, product.id)
+        for product in created if product.id is not None
+    ]
+    changes += [
+        change_log.change(CatalogChange.KIND_PRODUCT, CatalogChange.ACTION_UPDATED, product.id, product.id)
+        for product in updated
+    ]
+    # no ids from bulk inserts on MySQL (and SQLite before Django 4),
+    # the consumers read the collections of these products again
+    collection_ids = {product.collection_id for product in created if product.id is None}
+    changes += [
+        change_log.change(CatalogChange.KIND_COLLECTION, CatalogChange.ACTION_UPDATED, collection_id)
+        for collection_id in sorted(collection_ids)
+    ]
+    change_log.record_many(changes)
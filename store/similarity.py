@@ -0,0 +1,167 @@
+import json
+from collections import Counter
+
+import numpy as np
+from scipy import sparse
+
+from store import caching
+from store.models import Product
+from store.search import tokenize
+
+# similar products by their text: products/<id>/similar/
+#
+# for products without orders, store/recommendations.py has nothing to say.
+# build_similar (a nightly celery task, store/tasks.py, or
+# `manage.py build_similar_products`) reads the name and description of every
+# product and builds the TF-IDF matrix, a row per product, a column per word:
+#   tf      1 + log(count), the words of the name count NAME_WEIGHT times
+#   idf     log((1 + products) / (1 + products with the word)) + 1
+# the rows are scaled to length 1, the dot product of two rows is the cosine
+# similarity of the two products. X @ X.T would be products x products floats,
+# the rows are multiplied a block at a time instead, BLOCK_CELLS floats per
+# block, and only the TOP_K most similar of each row are kept.
+# the ids are written to one key per product, the similar action reads only
+# that key:
+#   store:similar:42            [17, 5, 8, ...]
+# products added after the build have no similar products until the next build.
+#
+# with a cache that is not django_redis (tests, local development)
+# the results are kept in the memory of the process instead.
+
+TOP_K = 20
+
+NAME_WEIGHT = 3
+
+# the size of the similarity block in floats, 16M float32 are 64MB
+BLOCK_CELLS = 16 * 1024 * 1024
+
+# the products written to redis in one pipeline
+WRITE_BATCH_SIZE = 1000
+
+KEY = 'store:similar:{}'
+
+
+def term_counts(name, description):
+    counts = Counter()
+    for token in tokenize(name):
+        counts[token] += NAME_WEIGHT
+    counts.update(tokenize(description))
+    return counts
+
+
+def tfidf_matrix(documents):
+    # documents: a Counter of words per product
+    # returns the sparse matrix, a row per document, the rows have length 1
+    vocabulary = {}
+    rows, columns, values = [], [], []
+    for row, counts in enumerate(documents):
+        for word, count in counts.items():
+            rows.append(row)
+            columns.append(vocabulary.setdefault(word, len(vocabulary)))
+            values.append(count)
+    shape = (len(documents), len(vocabulary))
+    if not vocabulary:
+        return sparse.csr_matrix(shape, dtype=np.float32)
+    matrix = sparse.csr_matrix(
+        (np.array(values, dtype=np.float32), (np.array(rows), np.array(columns))),
+        shape=shape,
+    )
+    matrix.data = 1 + np.log(matrix.data)
+    document_frequency = np.bincount(matrix.indices, minlength=shape[1])
+    idf = np.log((1 + shape[0]) / (1 + document_frequency)) + 1
+    matrix = matrix @ sparse.diags(idf.astype(np.float32))
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sparse.diags(1 / norms).astype(np.float32) @ matrix
+
+
+def top_neighbors(matrix, k=TOP_K, block_cells=BLOCK_CELLS):
+    # yields (row, [the rows most similar to it, the most first]) for every row,
+    # the rows without a common word are left out
+    count = matrix.shape[0]
+    k = min(k, count - 1)
+    if k <= 0:
+        for row in range(count):
+            yield row, []
+        return
+    block_size = max(1, block_cells // count)
+    transposed = matrix.T.tocsc()
+    for start in range(0, count, block_size):
+        end = min(start + block_size, count)
+        scores = (matrix[start:end] @ transposed).toarray()
+        # not similar to itself
+        scores[np.arange(end - start), np.arange(start, end)] = 0
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+        order = np.argsort(-candidate_scores, axis=1, kind='stable')
+        candidates = np.take_along_axis(candidates, order, axis=1)
+        candidate_scores = np.take_along_axis(candidate_scores, order, axis=1)
+        for offset in range(end - start):
+            similar = candidates[offset][candidate_scores[offset] > 0]
+            yield start + offset, similar.tolist()
+
+
+class RedisStore:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def save_many(self, neighbors):
+        pipeline = self.connection.pipeline(transaction=False)
+        for product_id, similar_ids in neighbors.items():
+            pipeline.set(KEY.format(product_id), json.dumps(similar_ids))
+        pipeline.execute()
+
+    def get(self, product_id):
+        value = self.connection.get(KEY.format(product_id))
+        return json.loads(value) if value else []
+
+
+class LocalStore:
+    def __init__(self):
+        self.neighbors = {}
+
+    def save_many(self, neighbors):
+        self.neighbors.update(neighbors)
+
+    def get(self, product_id):
+        return self.neighbors.get(product_id, [])
+
+
+_store = None
+
+
+def get_store():
+    global _store
+    if _store is None:
+        _store = caching.redis_or_local(RedisStore, LocalStore)
+    return _store
+
+
+def similar(product_id, limit=TOP_K):
+    # the ids of the products most similar to this product, the most first
+    return get_store().get(product_id)[:limit]
+
+
+def build_similar():
+    # returns the number of products
+    ids = []
+    documents = []
+    products = Product.objects\
+        .order_by()\
+        .values_list('id', 'name', 'description')\
+        .iterator(chunk_size=2000)
+    for product_id, name, description in products:
+        ids.append(product_id)
+        documents.append(term_counts(name, description))
+    if not ids:
+        return 0
+
+    store = get_store()
+    batch = {}
+    for row, similar_rows in top_neighbors(tfidf_matrix(documents)):
+        batch[ids[row]] = [ids[similar_row] for similar_row in similar_rows]
+        if len(batch) >= WRITE_BATCH_SIZE:
+            store.save_many(batch)
+            batch = {}
+    store.save_many(batch)
+    return len(ids)
@@ -0,0 +1,268 @@
+import gzip
+import io
+import json
+import os
+import shutil
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.test import RequestFactory
+from django.urls import reverse
+from django.utils._os import safe_join
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework.request import Request
+from rest_framework.utils.encoders import JSONEncoder
+
+from store.models import Collection, DeletedProduct, Product
+from store.paginations import ProductPageNumberPagination
+from store.serializers import CollectionSerializer, CompiledProductSerializer
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# a static copy of the read-only catalog api under SNAPSHOT_ROOT,
+# served by catalog_snapshot in store/views.py as store/catalog/<path>
+#
+#   catalog/collections.json                            collections/
+#   catalog/collections/<id>.json                       collections/<id>/
+#   catalog/collections/<id>/products/<page>.json       products/?collection_id=<id>&page=<page>
+#   catalog/products/<id>.json                          products/<id>/
+#
+# the same json as the api, every file with a .gz and .br next to it,
+# the view sends the compressed file the client accepts.
+#
+# the first build renders everything, the next builds only
+#   - the details of the products with last_updated_at after the last build
+#   - the pages of the collections with products_updated_at after the last build,
+#     store/stats.py sets it for every product added, changed, moved or removed
+#   - the collections, a few files
+# and delete the details of the products deleted since (DeletedProduct).
+# images and promotions don't change last_updated_at, --full renders everything.
+#
+# the view reads the files of every request, an incremental build is served
+# as soon as it's written, a removed file is a 404. WhiteNoise (STATIC_ROOT)
+# would only serve the files it found when the web process started.
+#
+# the files are on the local disk of the server that builds them. on a
+# server with a persistent disk (provision.sh) the build runs there, from cron
+# or by hand. on heroku every dyno has its own disk, a release phase or
+# worker dyno can't write the files of the web dynos: bin/post_compile runs a
+# full build in the build step, the files are part of the slug and as fresh
+# as the last deploy.
+
+DIRECTORY = 'catalog'
+MANIFEST = 'manifest.json'
+
+PAGE_SIZE = ProductPageNumberPagination.page_size
+
+# gzip and brotli are not worth it for tiny files
+MIN_COMPRESS_SIZE = 200
+
+# changes saved while the previous build was reading are rendered again
+OVERLAP = timedelta(seconds=60)
+
+# the compressed files the view can send, the smallest first
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+def find_file(path, accept_encoding, root=None):
+    # the file of store/catalog/<path> as (file path, content encoding or None),
+    # None when there is no such file
+    directory = os.path.join(root or settings.SNAPSHOT_ROOT, DIRECTORY)
+    try:
+        full_path = safe_join(directory, path)
+    except SuspiciousFileOperation:
+        return None
+    if not full_path.endswith('.json') or not os.path.isfile(full_path):
+        return None
+    accepted = {item.split(';')[0].strip() for item in accept_encoding.split(',')}
+    for encoding, suffix in ENCODINGS:
+        if encoding in accepted and os.path.isfile(full_path + suffix):
+            return full_path + suffix, encoding
+    return full_path, None
+
+
+def gzip_compress(content):
+    # gzip.compress has no mtime argument before python 3.8,
+    # mtime=0: the same content gives the same file
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', mtime=0) as file:
+        file.write(content)
+    return buffer.getvalue()
+
+
+class SnapshotBuilder:
+    def __init__(self, base_url, root=None, stdout=None):
+        self.root = os.path.join(root or settings.SNAPSHOT_ROOT, DIRECTORY)
+        # http://host/store/catalog/manifest.json -> http://host/store/catalog
+        manifest_url = reverse('catalog-snapshot', kwargs={'path': MANIFEST})
+        self.catalog_url = base_url.rstrip('/') + manifest_url[:-len(MANIFEST) - 1]
+        self.request = self.make_request(base_url)
+        self.encoder = JSONEncoder()
+        self.stdout = stdout
+        self.files_written = 0
+
+    def make_request(self, base_url):
+        # the absolute urls in the json are built from this request
+        scheme, _, host = base_url.partition('://')
+        request = RequestFactory().get(
+            '/', secure=scheme == 'https', HTTP_HOST=host.rstrip('/'),
+        )
+        return Request(request)
+
+    def log(self, message):
+        if self.stdout is not None:
+            self.stdout.write(message)
+
+    # files
+
+    def path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    def url(self, *parts):
+        return '/'.join([self.catalog_url, *parts])
+
+    def write(self, data, *parts):
+        # write to a temporary file and rename,
+        # a file is never served half written
+        path = self.path(*parts)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        content = self.encoder.encode(data).encode()
+        variants = [(path, content)]
+        if len(content) >= MIN_COMPRESS_SIZE:
+            variants.append((path + '.gz', gzip_compress(content)))
+            if brotli is not None:
+                variants.append((path + '.br', brotli.compress(content)))
+        for variant_path, variant_content in variants:
+            temp_path = variant_path + '.tmp'
+            with open(temp_path, 'wb') as file:
+                file.write(variant_content)
+            os.replace(temp_path, variant_path)
+        self.files_written += 1
+
+    def remove(self, *parts):
+        path = self.path(*parts)
+        for variant_path in (path, path + '.gz', path + '.br'):
+            if os.path.exists(variant_path):
+                os.remove(variant_path)
+
+    def read_manifest(self):
+        try:
+            with open(self.path(MANIFEST)) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    # rendering
+
+    def product_serializer(self, **kwargs):
+        return CompiledProductSerializer(context={'request': self.request}, **kwargs)
+
+    def render_collections(self):
+        collections = list(Collection.objects.order_by('id'))
+        data = CollectionSerializer(collections, many=True, context={'request': self.request}).data
+        self.write(data, 'collections.json')
+        for item in data:
+            self.write(item, 'collections', f'{item["id"]}.json')
+
+        # the collections that no longer exist
+        ids = {str(item['id']) for item in data}
+        directory = self.path('collections')
+        for name in os.listdir(directory):
+            collection_id = name.split('.')[0]
+            if collection_id not in ids:
+                full_path = os.path.join(directory, name)
+                if os.path.isdir(full_path):
+                    shutil.rmtree(full_path)
+                else:
+                    os.remove(full_path)
+        return [item['id'] for item in data]
+
+    def render_collection_pages(self, collection_id):
+        # the pages of products/?collection_id=<id>&page=<n>, ordered by name
+        products = Product.objects.filter(collection_id=collection_id).order_by('name', 'id')
+        ids = list(products.values_list('id', flat=True))
+        page_count = max(1, -(-len(ids) // PAGE_SIZE))
+        serializer = self.product_serializer()
+        for page in range(1, page_count + 1):
+            page_ids = ids[(page - 1) * PAGE_SIZE:page * PAGE_SIZE]
+            self.write({
+                'count': len(ids),
+                'next': self.url('collections', str(collection_id), 'products', f'{page + 1}.json')
+                if page < page_count else None,
+                'previous': self.url('collections', str(collection_id), 'products', f'{page - 1}.json')
+                if page > 1 else None,
+                'results': serializer.values_to_representation(products.filter(id__in=page_ids)),
+            }, 'collections', str(collection_id), 'products', f'{page}.json')
+
+        # the pages after the last page from a previous build
+        directory = self.path('collections', str(collection_id), 'products')
+        for name in os.listdir(directory):
+            page = name.split('.')[0]
+            if page.isdigit() and int(page) > page_count:
+                os.remove(os.path.join(directory, name))
+
+    def render_product_details(self, products):
+        # in id batches, like exports.iter_products,
+        # returns the ids of the rendered products
+        serializer = self.product_serializer()
+        last_id = 0
+        ids = set()
+        while True:
+            batch = products.filter(id__gt=last_id).order_by('id')[:1000]
+            rows = serializer.values_to_representation(batch)
+            if not rows:
+                return ids
+            for row in rows:
+                self.write(row, 'products', f'{row["id"]}.json')
+                ids.add(row['id'])
+            last_id = rows[-1]['id']
+
+    def remove_other_products(self, ids):
+        # after a full build, the files of products deleted at any time
+        directory = self.path('products')
+        for name in os.listdir(directory):
+            product_id = name.split('.')[0]
+            if product_id.isdigit() and int(product_id) not in ids:
+                os.remove(os.path.join(directory, name))
+
+    def build(self, full=False):
+        started_at = timezone.now()
+        manifest = None if full else self.read_manifest()
+        since = None
+        if manifest is not None:
+            since = parse_datetime(manifest['built_at']) - OVERLAP
+
+        os.makedirs(self.path('collections'), exist_ok=True)
+        os.makedirs(self.path('products'), exist_ok=True)
+
+        collection_ids = self.render_collections()
+        if since is not None:
+            collection_ids = list(
+                Collection.objects
+                .filter(products_updated_at__gte=since)
+                .values_list('id', flat=True)
+            )
+        for collection_id in collection_ids:
+            self.render_collection_pages(collection_id)
+        self.log(f'Rendered the product pages of {len(collection_ids)} collections')
+
+        products = Product.objects.all()
+        if since is not None:
+            products = products.filter(last_updated_at__gte=since)
+            deleted_ids = DeletedProduct.objects\
+                .filter(deleted_at__gte=since)\
+                .values_list('product_id', flat=True)
+            for product_id in deleted_ids:
+                self.remove('products', f'{product_id}.json')
+        ids = self.render_product_details(products)
+        if since is None:
+            self.remove_other_products(ids)
+        self.log(f'Rendered {len(ids)} products')
+
+        self.write({'built_at': started_at.isoformat()}, MANIFEST)
+        return self.files_written
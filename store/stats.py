@@ -0,0 +1,102 @@
+from django.db.models import F, Value, Subquery, Count, Min, Max
+from django.db.models.functions import Coalesce, Least, Greatest, Now
+
+from store.models import Collection, Product
+
+# product statistics stored on the collection:
+# product_count, min_unit_price, max_unit_price, products_updated_at
+#
+# instead of counting the products of every collection on every request,
+# each product change updates only the collection(s) it belongs to:
+#   added     count + 1, the price can only widen the range: LEAST/GREATEST
+#   removed   count - 1, the price range is read again from the products
+#             of the collection (MIN/MAX over the collection_id index)
+# the rebuild_collection_stats command recomputes everything.
+
+
+def _min_price(collection_id):
+    return Subquery(
+        Product.objects
+        .filter(collection_id=collection_id)
+        .order_by('unit_price')
+        .values('unit_price')[:1]
+    )
+
+
+def _max_price(collection_id):
+    return Subquery(
+        Product.objects
+        .filter(collection_id=collection_id)
+        .order_by('-unit_price')
+        .values('unit_price')[:1]
+    )
+
+
+def product_added(collection_id, unit_price):
+    Collection.objects.filter(id=collection_id).update(
+        product_count=F('product_count') + 1,
+        # the min and max are null for an empty collection
+        min_unit_price=Least(Coalesce('min_unit_price', Value(unit_price)), Value(unit_price)),
+        max_unit_price=Greatest(Coalesce('max_unit_price', Value(unit_price)), Value(unit_price)),
+        products_updated_at=Now(),
+    )
+
+
+def product_removed(collection_id):
+    Collection.objects.filter(id=collection_id, product_count__gt=0).update(
+        product_count=F('product_count') - 1,
+        min_unit_price=_min_price(collection_id),
+        max_unit_price=_max_price(collection_id),
+        products_updated_at=Now(),
+    )
+
+
+def product_changed(collection_id, unit_price, old_unit_price):
+    # the product stays in the collection
+    if unit_price == old_unit_price:
+        Collection.objects.filter(id=collection_id).update(
+            products_updated_at=Now(),
+        )
+        return
+    # the old price may have been the min or the max
+    Collection.objects.filter(id=collection_id).update(
+        min_unit_price=_min_price(collection_id),
+        max_unit_price=_max_price(collection_id),
+        products_updated_at=Now(),
+    )
+
+
+def rebuild(collection_ids=None):
+    # one GROUP BY over the products, one bulk update of the collections
+    collections = Collection.objects.all()
+    products = Product.objects.all()
+    if collection_ids is not None:
+        collections = collections.filter(id__in=collection_ids)
+        products = products.filter(collection_id__in=collection_ids)
+
+    stats = {
+        row['collection_id']: row
+        for row in products
+        .order_by()
+        .values('collection_id')
+        .annotate(
+            count=Count('id'),
+            min_unit_price=Min('unit_price'),
+            max_unit_price=Max('unit_price'),
+            updated_at=Max('last_updated_at'),
+        )
+    }
+
+    collections = list(collections.only('id'))
+    for collection in collections:
+        row = stats.get(collection.id, {})
+        collection.product_count = row.get('count', 0)
+        collection.min_unit_price = row.get('min_unit_price')
+        collection.max_unit_price = row.get('max_unit_price')
+        collection.products_updated_at = row.get('updated_at')
+    Collection.objects.bulk_update(
+        collections,
+        ['product_count', 'min_unit_price', 'max_unit_price', 'products_updated_at'],
+        batch_size=500,
+    )
+    return len(collections)
@@ -0,0 +1,119 @@
+import base64
+import binascii
+import json
+from datetime import datetime, timedelta
+
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from store.models import DeletedProduct
+
+# delta sync of the catalog: products/changes/?updated_since=<timestamp>
+#
+# the changed products are read in (last_updated_at, id) order,
+# the deleted products in (deleted_at, id) order from the DeletedProduct
+# tombstones written by the post_delete handler.
+# each page continues after the last row of the previous page
+# (WHERE (last_updated_at, id) > (t, id) ORDER BY last_updated_at, id LIMIT n),
+# a range scan of store_prod_updated_idx, InnoDB indexes end with the primary key.
+# the cursor holds both positions, a consumer keeps the cursor of the last page
+# and sends it next time to get only what changed since.
+#
+# last_updated_at is set when the product is saved, not when the transaction
+# commits, a product saved in a long transaction can show up behind the cursor.
+# consumers that can't miss a change start again a few seconds before.
+#
+# the tombstones are kept for RETENTION (prune below, scheduled in
+# CELERY_BEAT_SCHEDULE). a consumer whose last sync is older than that can
+# miss deletions, it has to sync everything again (updated_since=0) and drop
+# the products that are not in the result.
+
+PAGE_SIZE = 100
+
+RETENTION = timedelta(days=30)
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def parse_timestamp(value):
+    # ISO 8601 (2024-05-01T12:00:00Z) or seconds since the epoch
+    try:
+        timestamp = parse_datetime(value)
+    except ValueError:
+        timestamp = None
+    if timestamp is None:
+        try:
+            return datetime.fromtimestamp(float(value), tz=timezone.utc)
+        except (ValueError, OverflowError, OSError):
+            raise InvalidCursor('updated_since must be an ISO 8601 timestamp or seconds since the epoch')
+    if timezone.is_naive(timestamp):
+        timestamp = timezone.make_aware(timestamp, timezone.utc)
+    return timestamp
+
+
+def encode_cursor(positions):
+    # {'products': [timestamp, id], 'deleted': [timestamp, id]}
+    data = {
+        name: [timestamp.isoformat(), row_id]
+        for name, (timestamp, row_id) in positions.items()
+    }
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return {
+            name: (parse_timestamp(data[name][0]), int(data[name][1]))
+            for name in ('products', 'deleted')
+        }
+    except (binascii.Error, ValueError, KeyError, TypeError, IndexError):
+        raise InvalidCursor('Invalid cursor')
+
+
+def start_positions(updated_since):
+    # id 0: everything at or after the timestamp
+    return {'products': (updated_since, 0), 'deleted': (updated_since, 0)}
+
+
+def after(field, position):
+    timestamp, row_id = position
+    return Q(**{f'{field}__gt': timestamp}) | Q(**{field: timestamp, 'id__gt': row_id})
+
+
+def get_changes(products, positions, page_size=None):
+    # products: the product queryset of the view (prefetches, sparse fields)
+    # returns the changed products, the deleted ids, the positions
+    # after this page and whether there are more rows
+    page_size = page_size or PAGE_SIZE
+    changed = list(
+        products
+        .filter(after('last_updated_at', positions['products']))
+        .order_by('last_updated_at', 'id')[:page_size + 1]
+    )
+    deleted = list(
+        DeletedProduct.objects
+        .filter(after('deleted_at', positions['deleted']))
+        .order_by('deleted_at', 'id')
+        .values_list('deleted_at', 'id', 'product_id')[:page_size + 1]
+    )
+    has_more = len(changed) > page_size or len(deleted) > page_size
+    changed = changed[:page_size]
+    deleted = deleted[:page_size]
+
+    positions = dict(positions)
+    if changed:
+        positions['products'] = (changed[-1].last_updated_at, changed[-1].id)
+    if deleted:
+        positions['deleted'] = deleted[-1][:2]
+    return changed, [product_id for _, _, product_id in deleted], positions, has_more
+
+
+def prune(now=None):
+    # returns the number of deleted tombstones
+    expired_before = (now or timezone.now()) - RETENTION
+    deleted, _ = DeletedProduct.objects.filter(deleted_at__lt=expired_before).delete()
+    return deleted
@@ -0,0 +1,29 @@
+from celery import shared_task
+
+from store import change_log, popularity, recommendations, similarity, sync
+
+
+# scheduled in CELERY_BEAT_SCHEDULE
+@shared_task
+def update_product_popularity():
+    return popularity.update_popularity()
+
+
+@shared_task
+def prune_catalog_changes():
+    return change_log.prune()
+
+
+@shared_task
+def prune_deleted_products():
+    return sync.prune()
+
+
+@shared_task
+def update_related_products():
+    return recommendations.update_related()
+
+
+@shared_task
+def build_similar_products():
+    return similarity.build_similar()
@@ -1,8 +1,11 @@
 # fixtures we define here will be automatically loaded when it's referenced in
 # the test_func parameter and return the result to the parameter
 import pytest
+from django.core.cache import cache
 from rest_framework.test import APIClient
 
+from store import list_snapshot, trending
+
 # here we define fixtures that we can use across test modules.
 
 # not pytest.fixture()
@@ -22,3 +25,23 @@ def authenticate(client):
     def do_authenticate(is_staff=False):
         return client.force_authenticate(user=User(is_staff=is_staff))
     return do_authenticate
+
+
+# cached responses and versions must not leak from one test to another
+@pytest.fixture(autouse=True)
+def clear_cache():
+    cache.clear()
+    yield
+    cache.clear()
+
+
+# the trending counters of the process, when the cache is not redis
+@pytest.fixture(autouse=True)
+def clear_trending_counters(monkeypatch):
+    monkeypatch.setattr(trending, '_counters', None)
+
+
+# the product list snapshot of the process, built from the database of a test
+@pytest.fixture(autouse=True)
+def clear_list_snapshot(monkeypatch):
+    monkeypatch.setattr(list_snapshot, '_snapshot', None)
@@ -0,0 +1,154 @@
+from decimal import Decimal
+
+import pytest
+from model_bakery import baker
+from rest_framework import status
+
+from core.models import User
+from store.models import Cart, CartItem, Customer, Order, OrderItem, Promotion
+
+
+@pytest.mark.django_db
+class TestRetrieveCart:
+    def test_if_fields_given_returns_only_these_fields(self, client):
+        # Arrange
+        cart = baker.make(Cart)
+        # Act
+        response = client.get(f'/store/carts/{cart.id}/?fields=id,created_at')
+        # Assert
+        assert response.status_code == status.HTTP_200_OK
+        assert set(response.data) == {'id', 'created_at'}
+
+    def test_if_items_not_requested_items_are_not_queried(
+            self, client, django_assert_num_queries):
+        # Arrange
+        cart = baker.make(Cart)
+        baker.make(CartItem, cart=cart, quantity=2)
+        # Act
+        with django_assert_num_queries(1):
+            response = client.get(f'/store/carts/{cart.id}/?fields=id')
+        # Assert
+        assert response.data == {'id': str(cart.id)}
+
+    def test_if_only_totals_requested_items_are_prefetched(
+            self, client, django_assert_num_queries):
+        # Arrange
+        cart = baker.make(Cart)
+        baker.make(CartItem, cart=cart, quantity=2, _quantity=3)
+        # read the discounts before counting
+        client.get(f'/store/carts/{cart.id}/?fields=total_tax')
+        # Act
+        # the cart, the items, the products
+        with django_assert_num_queries(3):
+            response = client.get(f'/store/carts/{cart.id}/?fields=total_tax')
+        # Assert
+        assert set(response.data) == {'total_tax'}
+
+    def test_returns_items_and_total_price(self, client):
+        # Arrange
+        cart = baker.make(Cart)
+        item = baker.make(CartItem, cart=cart, quantity=2, product__unit_price=5)
+        # Act
+        response = client.get(f'/store/carts/{cart.id}/')
+        # Assert
+        assert response.data['items'][0]['id'] == item.id
+        assert response.data['total_price'] == 10
+
+    def test_if_cart_missing_repeated_miss_is_cached(self, client, django_assert_num_queries):
+        # Arrange
+        url = '/store/carts/6c5a1d8e-7b1f-4a51-9a57-0f1b1b1b1b1b/'
+        client.get(url)
+        # Act
+        with django_assert_num_queries(0):
+            response = client.get(url)
+        # Assert
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+    def test_totals_apply_discounts_and_tax(self, client):
+        # Arrange
+        cart = baker.make(Cart)
+        item = baker.make(CartItem, cart=cart, quantity=3, product__unit_price=Decimal('10'))
+        item.product.promotions.add(baker.make(Promotion, discount=0.2))
+        # Act
+        response = client.get(f'/store/carts/{cart.id}/')
+        # Assert
+        assert response.data['items'][0]['total_price'] == Decimal('24.00')
+        assert response.data['total_price'] == Decimal('24.00')
+        assert response.data['total_discount'] == Decimal('6.00')
+        assert response.data['total_tax'] == Decimal('2.40')
+        assert response.data['total_price_with_tax'] == Decimal('26.40')
+
+
+@pytest.mark.django_db
+class TestCreateOrder:
+    def test_order_items_have_the_discounted_price(self, client):
+        # Arrange
+        user = baker.make(User)
+        client.force_authenticate(user=user)
+        cart = baker.make(Cart)
+        item = baker.make(CartItem, cart=cart, quantity=1, product__unit_price=Decimal('10'))
+        item.product.promotions.add(baker.make(Promotion, discount=0.2))
+        # Act
+        response = client.post('/store/orders/', {'cart_id': str(cart.id)})
+        # Assert
+        assert response.status_code == status.HTTP_201_CREATED
+        assert OrderItem.objects.get(order_id=response.data['id']).unit_price == Decimal('8.00')
+
+
+@pytest.mark.django_db
+class TestListOrders:
+    @pytest.fixture(autouse=True)
+    def admin(self, authenticate):
+        authenticate(is_staff=True)
+
+    def make_orders(self, count):
+        # a customer is created with every user, see store/signals/handlers.py
+        orders = []
+        for _ in range(count):
+            customer = Customer.objects.get(user=baker.make(User))
+            order = baker.make(Order, customer=customer)
+            baker.make(OrderItem, order=order, _quantity=2)
+            orders.append(order)
+        return orders
+
+    def test_if_items_are_not_requested_they_are_not_prefetched(
+            self, client, django_assert_num_queries):
+        # Arrange
+        self.make_orders(3)
+        # Act
+        # the count and the orders
+        with django_assert_num_queries(2):
+            response = client.get('/store/orders/?fields=id,placed_at')
+        # Assert
+        assert response.status_code == status.HTTP_200_OK
+        assert [set(order) for order in response.data['results']] == [{'id', 'placed_at'}] * 3
+
+    def test_if_customer_is_expanded_it_is_joined(self, client, django_assert_num_queries):
+        # Arrange
+        orders = self.make_orders(3)
+        # Act
+        # the count, the orders with their customers, the items, their products
+        with django_assert_num_queries(4):
+            response = client.get('/store/orders/?expand=customer')
+        # Assert
+        assert response.status_code == status.HTTP_200_OK
+        customers = {order['id']: order['customer'] for order in response.data['results']}
+        assert customers == {
+            order.id: {
+                'id': order.customer.id,
+                'user_id': order.customer.user_id,
+                'phone_number': order.customer.phone_number,
+                'birthday': order.customer.birthday,
+                'membership': order.customer.membership,
+            }
+            for order in orders
+        }
+        assert all(len(order['items']) == 2 for order in response.data['results'])
+
+    def test_if_customer_is_not_expanded_returns_its_id(self, client):
+        # Arrange
+        order = self.make_orders(1)[0]
+        # Act
+        response = client.get(f'/store/orders/{order.id}/?fields=id,customer')
+        # Assert
+        assert response.data == {'id': order.id, 'customer': order.customer.id}
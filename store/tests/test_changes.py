@@ -0,0 +1,168 @@
+from datetime import timedelta
+
+import pytest
+from django.utils import timezone
+from model_bakery import baker
+from rest_framework import status
+
+from store import bulk_writes, change_log
+from store.models import CatalogChange, Collection, Product, ProductImage, Review
+
+
+def changes_of(response):
+    return [
+        (change['kind'], change['action'], change['object_id'], change['product_id'])
+        for change in response.data['changes']
+    ]
+
+
+@pytest.mark.django_db
+class TestCatalogChangesPermissions:
+    def test_if_user_is_anonymous_returns_401(self, client):
+        # Act
+        response = client.get('/store/changes/?timeout=0')
+        # Assert
+        assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+    def test_if_user_is_not_admin_returns_403(self, client, authenticate):
+        # Arrange
+        authenticate()
+        # Act
+        response = client.get('/store/changes/?timeout=0')
+        # Assert
+        assert response.status_code == status.HTTP_403_FORBIDDEN
+
+
+@pytest.mark.django_db
+class TestCatalogChanges:
+    @pytest.fixture(autouse=True)
+    def admin(self, authenticate):
+        authenticate(is_staff=True)
+
+    def test_saves_and_deletes_are_logged_in_order(self, client):
+        # Arrange
+        offset = change_log.head_offset()
+        collection = baker.make(Collection)
+        product = baker.make(Product, collection=collection)
+        review = baker.make(Review, product=product)
+        product.name = 'b'
+        product.save()
+        review_id = review.id
+        # Act
+        review.delete()
+        response = client.get(f'/store/changes/?offset={offset}&timeout=0')
+        # Assert
+        assert response.status_code == status.HTTP_200_OK
+        assert changes_of(response) == [
+            ('collection', 'created', collection.id, None),
+            ('product', 'created', product.id, product.id),
+            ('review', 'created', review_id, product.id),
+            ('product', 'updated', product.id, product.id),
+            ('review', 'deleted', review_id, product.id),
+        ]
+        assert response.data['offset'] == response.data['changes'][-1]['offset']
+
+    def test_continue_from_offset(self, client):
+        # Arrange
+        product = baker.make(Product)
+        offset = client.get('/store/changes/?offset=0&timeout=0').data['offset']
+        image = baker.make(ProductImage, product=product)
+        # Act
+        response = client.get(f'/store/changes/?offset={offset}&timeout=0')
+        # Assert
+        assert changes_of(response) == [('product_image', 'created', image.id, product.id)]
+
+    def test_without_offset_starts_at_the_last_change(self, client):
+        # Arrange
+        baker.make(Product)
+        # Act
+        response = client.get('/store/changes/?timeout=0')
+        # Assert
+        assert response.data['changes'] == []
+        assert response.data['offset'] == change_log.head_offset()
+
+    def test_long_poll_times_out_without_changes(self, client, monkeypatch):
+        # Arrange
+        monkeypatch.setattr(change_log, 'POLL_INTERVAL', 0.01)
+        offset = change_log.head_offset()
+        # Act
+        response = client.get(f'/store/changes/?offset={offset}&timeout=1')
+        # Assert
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data == {'changes': [], 'offset': offset}
+
+    def test_changes_after_a_recent_gap_are_held_back(self):
+        # Arrange
+        offset = change_log.head_offset()
+        first, second = [
+            change_log.change(CatalogChange.KIND_PRODUCT, CatalogChange.ACTION_UPDATED, index)
+            for index in range(2)
+        ]
+        first.save()
+        # the second change is still in a transaction
+        second.id = first.id + 2
+        second.save()
+        # Act
+        changes, held_back = change_log.read(offset)
+        # Assert
+        assert [change.id for change in changes] == [first.id]
+        assert held_back
+
+    def test_changes_after_an_old_gap_are_returned(self):
+        # Arrange
+        offset = change_log.head_offset()
+        first = baker.make(CatalogChange, object_id=1)
+        second = baker.make(CatalogChange, id=first.id + 2, object_id=2)
+        CatalogChange.objects.filter(id=second.id).update(
+            created_at=timezone.now() - change_log.GAP_TIMEOUT * 2,
+        )
+        # Act
+        changes, held_back = change_log.read(offset)
+        # Assert
+        assert [change.id for change in changes] == [first.id, second.id]
+        assert not held_back
+
+    def test_if_offset_was_pruned_returns_410(self, client):
+        # Arrange
+        first, old = baker.make(CatalogChange, _quantity=2, object_id=1)
+        CatalogChange.objects.filter(id__in=[first.id, old.id]).update(
+            created_at=timezone.now() - change_log.RETENTION - timedelta(hours=1),
+        )
+        baker.make(CatalogChange, _quantity=2, object_id=2)
+        # Act
+        pruned = change_log.prune()
+        response = client.get(f'/store/changes/?offset={first.id}&timeout=0')
+        # Assert
+        assert pruned == 2
+        assert response.status_code == status.HTTP_410_GONE
+        assert response.data['oldest_offset'] == old.id
+
+    def test_if_offset_is_invalid_returns_400(self, client):
+        # Act
+        response = client.get('/store/changes/?offset=abc')
+        # Assert
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+    def test_bulk_writes_are_logged(self, client):
+        # Arrange
+        collection = baker.make(Collection)
+        product = baker.make(Product, collection=collection)
+        offset = change_log.head_offset()
+        context = {'request': None, 'collections': {collection.id: collection}}
+        # Act
+        created = bulk_writes.create_products(
+            [{'name': 'a', 'unit_price': 1, 'inventory': 1, 'collection': collection.id}],
+            context,
+        )
+        bulk_writes.update_products([{'id': product.id, 'unit_price': 7}], context)
+        response = client.get(f'/store/changes/?offset={offset}&timeout=0')
+        # Assert
+        if created[0].id is None:
+            # no ids from bulk inserts, the collection changed
+            first_change = ('collection', 'updated', collection.id, None)
+        else:
+            first_change = ('product', 'created', created[0].id, created[0].id)
+        assert changes_of(response) == [
+            first_change,
+            ('product', 'updated', product.id, product.id),
+        ]
@@ -1,4 +1,7 @@
+from io import StringIO
+
 import pytest
+from django.core.management import call_command
 from model_bakery import baker
 from rest_framework import status
 from rest_framework.test import APIClient
@@ -23,7 +26,7 @@ from core.models import User
 # or
 # the argument client is always referring to client object since it's a constant
 # the second understanding is correct
-from store.models import Collection
+from store.models import Collection, Product
 
 
 @pytest.fixture
@@ -92,6 +95,65 @@ class TestRetrieveCollection:
         assert response.data['id'] == collection.id
         assert response.data['title'] == collection.title
 
+    def test_if_etag_matches_returns_304(self, client):
+        # arrange
+        collection = baker.make(Collection)
+        etag = client.get(f'/store/collections/{collection.id}/')['ETag']
+        # act
+        response = client.get(
+            f'/store/collections/{collection.id}/', HTTP_IF_NONE_MATCH=etag
+        )
+        assert response.status_code == status.HTTP_304_NOT_MODIFIED
+
+    def test_if_collection_missing_repeated_miss_is_cached(
+            self, client, django_assert_num_queries):
+        # arrange
+        client.get('/store/collections/999/')
+        # act
+        with django_assert_num_queries(0):
+            response = client.get('/store/collections/999/')
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+@pytest.mark.django_db
+class TestCollectionStats:
+    def test_stats_follow_product_changes(self):
+        # Arrange
+        first, second = baker.make(Collection, _quantity=2)
+        cheap = baker.make(Product, collection=first, unit_price=5)
+        baker.make(Product, collection=first, unit_price=20)
+        # Act
+        cheap.collection = second
+        cheap.save()
+        # Assert
+        first.refresh_from_db()
+        second.refresh_from_db()
+        assert (first.product_count, first.min_unit_price, first.max_unit_price) == (1, 20, 20)
+        assert (second.product_count, second.min_unit_price, second.max_unit_price) == (1, 5, 5)
+
+    def test_if_last_product_is_deleted_stats_are_empty(self):
+        # Arrange
+        collection = baker.make(Collection)
+        product = baker.make(Product, collection=collection)
+        # Act
+        product.delete()
+        # Assert
+        collection.refresh_from_db()
+        assert collection.product_count == 0
+        assert collection.min_unit_price is None
+
+    def test_rebuild_command_recomputes_stats(self):
+        # Arrange
+        collection = baker.make(Collection)
+        baker.make(Product, collection=collection, unit_price=3, _quantity=3)
+        Collection.objects.update(product_count=0)
+        # Act
+        call_command('rebuild_collection_stats', stdout=StringIO())
+        # Assert
+        collection.refresh_from_db()
+        assert collection.product_count == 3
+        assert collection.max_unit_price == 3
+
 
 
 
@@ -0,0 +1,1394 @@
+import gzip
+import json
+from io import StringIO
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+import numpy as np
+import pytest
+from django.core.cache import cache
+from django.core.management import call_command, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from model_bakery import baker
+from rest_framework import status
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from core.models import User
+from store import autocomplete, caching, exports, list_snapshot, popularity, pricing, recommendations, search, \
+    similarity, snapshots, sync, trending
+from store.models import Collection, Product, ProductImage, DeletedProduct, Order, OrderItem, Promotion
+from store.serializers import ProductSerializer, CompiledProductSerializer, ProductSerializerForCreate
+from store.paginations import ProductCursorPagination
+from store.management.commands import benchmark_product_queries
+from store.views import ProductViewSet
+
+
+@pytest.fixture
+def create_products():
+    def do_create_products(count, **kwargs):
+        collection = baker.make(Collection)
+        kwargs.setdefault('collection', collection)
+        return baker.make(Product, _quantity=count, **kwargs)
+    return do_create_products
+
+
+@pytest.mark.django_db
+class TestListProducts:
+    def test_cursor_pages_cover_all_products_once(self, client, create_products):
+        # Arrange
+        # the same name and price for every product, only id breaks the ties
+        products = create_products(45, name='a', unit_price=10)
+        # Act
+        ids = []
+        url = '/store/products/?ordering=-unit_price'
+        while url is not None:
+            response = client.get(url)
+            assert response.status_code == status.HTTP_200_OK
+            ids += [product['id'] for product in response.data['results']]
+            url = response.data['next']
+        # Assert
+        assert ids == sorted((product.id for product in products), reverse=True)
+
+    def test_cursor_previous_link_returns_previous_page(self, client, create_products):
+        # Arrange
+        create_products(45)
+        first_page = client.get('/store/products/?ordering=name').data
+        second_page = client.get(first_page['next']).data
+        # Act
+        response = client.get(second_page['previous'])
+        # Assert
+        assert response.data['results'] == first_page['results']
+
+    def test_if_page_is_given_returns_page_number_pagination(self, client, create_products):
+        # Arrange
+        create_products(25)
+        # Act
+        response = client.get('/store/products/?page=2')
+        # Assert
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data['count'] == 25
+        assert len(response.data['results']) == 5
+
+
+@pytest.mark.django_db
+class TestCachedProducts:
+    def test_list_is_served_from_cache(self, client, create_products, django_assert_num_queries):
+        # Arrange
+        product = create_products(1)[0]
+        url = f'/store/products/?collection_id={product.collection_id}'
+        client.get(url)
+        # Act
+        with django_assert_num_queries(0):
+            response = client.get(url)
+        # Assert
+        assert response.data['results'][0]['id'] == product.id
+
+    def test_if_product_changes_list_is_not_stale(
+            self, client, create_products, django_capture_on_commit_callbacks):
+        # Arrange
+        product = create_products(1)[0]
+        url = f'/store/products/?collection_id={product.collection_id}'
+        client.get(url)
+        # Act
+        with django_capture_on_commit_callbacks(execute=True):
+            product.name = 'changed'
+            product.save()
+        response = client.get(url)
+        # Assert
+        assert response.data['results'][0]['title'] == 'changed'
+
+    def test_if_product_changes_detail_is_not_stale(
+            self, client, create_products, django_capture_on_commit_callbacks):
+        # Arrange
+        product = create_products(1)[0]
+        client.get(f'/store/products/{product.id}/')
+        # Act
+        with django_capture_on_commit_callbacks(execute=True):
+            product.unit_price = 99
+            product.save()
+        response = client.get(f'/store/products/{product.id}/')
+        # Assert
+        assert response.data['price'] == 99
+
+    def test_if_collection_changes_expanded_detail_is_not_stale(
+            self, client, create_products, django_capture_on_commit_callbacks):
+        # Arrange
+        product = create_products(1)[0]
+        url = f'/store/products/{product.id}/?expand=collection'
+        client.get(url)
+        # Act
+        with django_capture_on_commit_callbacks(execute=True):
+            product.collection.title = 'renamed'
+            product.collection.save()
+        response = client.get(url)
+        # Assert
+        assert response.data['collection']['title'] == 'renamed'
+
+
+@pytest.fixture
+def price_book():
+    # the discounts are read once per process and promotions version,
+    # read them before counting the queries of a request
+    return pricing.get_price_book()
+
+
+@pytest.fixture
+def search_backend(monkeypatch):
+    # the database full text indexes only see committed rows,
+    # the tests use a fresh in-memory index
+    backend = search.InMemoryBackend()
+    monkeypatch.setattr(search, '_backend', backend)
+    return backend
+
+
+@pytest.mark.django_db
+class TestSearchProducts:
+    def test_results_are_ordered_by_relevance(self, client, search_backend):
+        # Arrange
+        collection = baker.make(Collection)
+        in_description = baker.make(
+            Product, collection=collection, name='Cheese', description='goes with bread'
+        )
+        in_name = baker.make(
+            Product, collection=collection, name='Bread Rolls', description='fresh'
+        )
+        baker.make(Product, collection=collection, name='Milk', description='fresh')
+        # Act
+        response = client.get('/store/products/?search=brea')
+        # Assert
+        ids = [product['id'] for product in response.data['results']]
+        assert ids == [in_name.id, in_description.id]
+
+    def test_filtered_matches_below_the_top_results_are_found(self, client, search_backend, monkeypatch):
+        # Arrange
+        monkeypatch.setattr(search_backend, 'MAX_RESULTS', 2)
+        collection, other = baker.make(Collection, _quantity=2)
+        baker.make(Product, collection=collection, name='Bread', description='bread', _quantity=3)
+        match = baker.make(Product, collection=other, name='Cheese', description='bread')
+        # Act
+        response = client.get(f'/store/products/?search=bread&collection_id={other.id}')
+        # Assert
+        assert [product['id'] for product in response.data['results']] == [match.id]
+
+    def test_index_is_updated_when_product_is_saved(
+            self, client, search_backend, create_products, django_capture_on_commit_callbacks):
+        # Arrange
+        product = create_products(1, name='Apple')[0]
+        client.get('/store/products/?search=apple')
+        # Act
+        with django_capture_on_commit_callbacks(execute=True):
+            product.name = 'Orange'
+            product.save()
+        response = client.get('/store/products/?search=orange&ordering=name')
+        # Assert
+        assert [item['id'] for item in response.data['results']] == [product.id]
+        assert search_backend.score(['apple']) == {}
+
+    def test_index_is_not_updated_before_commit(self, search_backend, create_products):
+        # Arrange
+        product = create_products(1, name='Apple')[0]
+        search_backend.build()
+        # Act
+        product.name = 'Orange'
+        product.save()
+        # Assert
+        assert search_backend.score(['orange']) == {}
+
+    def test_if_other_worker_saved_index_is_rebuilt(
+            self, search_backend, create_products, monkeypatch, django_capture_on_commit_callbacks):
+        # Arrange
+        monkeypatch.setattr(search, 'VERSION_CHECK_INTERVAL', 0)
+        product = create_products(1, name='Apple')[0]
+        search_backend.build()
+        # the signal handlers update the backend of the other worker
+        other_worker = search.InMemoryBackend()
+        monkeypatch.setattr(search, '_backend', other_worker)
+        # Act
+        with django_capture_on_commit_callbacks(execute=True):
+            product.name = 'Orange'
+            product.save()
+        # Assert
+        assert list(search_backend.score(['orange'])) == [product.id]
+
+    def test_mysql_short_words_and_stopwords_are_not_required_by_the_index(self):
+        # Arrange
+        backend = search.MySQLFullTextBackend()
+        # Act
+        against = backend.search(Product.objects.all(), 'the tv stand').query.annotations[search.RANK_FIELD]
+        # Assert
+        assert against.params == ('+stand*',)
+
+    def test_mysql_short_words_only_search_with_like(self, create_products):
+        # Arrange
+        backend = search.MySQLFullTextBackend()
+        tv, stand = create_products(2)
+        Product.objects.filter(id=tv.id).update(name='TV', description='')
+        Product.objects.filter(id=stand.id).update(name='Stand', description='')
+        # Act
+        results = backend.search(Product.objects.all(), 'tv')
+        # Assert
+        assert [product.id for product in results] == [tv.id]
+
+
+@pytest.mark.django_db
+class TestCompiledProductSerializer:
+    @pytest.fixture
+    def products(self):
+        collection = baker.make(Collection)
+        prices = [Decimal('1'), Decimal('9.99'), Decimal('10.05'), Decimal('1234.56')]
+        products = [
+            baker.make(Product, collection=collection, unit_price=price)
+            for price in prices
+        ]
+        baker.make(ProductImage, product=products[0], image='store/images/a.jpg')
+        baker.make(ProductImage, product=products[0], image='store/images/b c.jpg')
+        return Product.objects\
+            .select_related('collection')\
+            .prefetch_related('productimage_set')\
+            .order_by('id')
+
+    @pytest.fixture
+    def context(self):
+        return {'request': APIRequestFactory().get('/store/products/')}
+
+    def test_output_is_the_same_as_product_serializer(self, products, context):
+        # Arrange
+        expected = JSONRenderer().render(
+            ProductSerializer(products, many=True, context=context).data
+        )
+        # Act
+        result = JSONRenderer().render(
+            CompiledProductSerializer(products, many=True, context=context).data
+        )
+        # Assert
+        assert result == expected
+
+    def test_values_output_is_the_same_as_product_serializer(self, products, context):
+        # Arrange
+        expected = JSONRenderer().render(
+            ProductSerializer(products, many=True, context=context).data
+        )
+        # Act
+        result = JSONRenderer().render(
+            CompiledProductSerializer(context=context).values_to_representation(products)
+        )
+        # Assert
+        assert result == expected
+
+    def test_detail_is_the_same_as_product_serializer(self, products, context):
+        # Arrange
+        product = products[0]
+        expected = JSONRenderer().render(ProductSerializer(product, context=context).data)
+        # Act
+        result = JSONRenderer().render(CompiledProductSerializer(product, context=context).data)
+        # Assert
+        assert result == expected
+
+
+@pytest.mark.django_db
+class TestBulkRetrieveProducts:
+    def test_returns_products_in_requested_order_and_missing_ids(
+            self, client, create_products, price_book, django_assert_num_queries):
+        # Arrange
+        first, second = create_products(2)
+        missing_id = second.id + 100
+        # Act
+        # one query for the products, one for the images
+        with django_assert_num_queries(2):
+            response = client.get(
+                f'/store/products/bulk/?ids={second.id},{missing_id},{first.id}'
+            )
+        # Assert
+        assert response.status_code == status.HTTP_200_OK
+        assert [product['id'] for product in response.data['results']] == [second.id, first.id]
+        assert response.data['missing'] == [missing_id]
+
+    def test_if_ids_are_invalid_returns_400(self, client):
+        # Act
+        response = client.get('/store/products/bulk/?ids=1,a')
+        # Assert
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.mark.django_db
+class TestConditionalGetProducts:
+    def test_if_etag_matches_returns_304(self, client, create_products):
+        # Arrange
+        product = create_products(1)[0]
+        etag = client.get(f'/store/products/{product.id}/')['ETag']
+        # Act
+        response = client.get(f'/store/products/{product.id}/', HTTP_IF_NONE_MATCH=etag)
+        # Assert
+        assert response.status_code == status.HTTP_304_NOT_MODIFIED
+
+    def test_if_product_changes_returns_200(
+            self, client, create_products, django_capture_on_commit_callbacks):
+        # Arrange
+        product = create_products(1)[0]
+        url = f'/store/products/?collection_id={product.collection_id}'
+        etag = client.get(url)['ETag']
+        with django_capture_on_commit_callbacks(execute=True):
+            product.save()
+        # Act
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        # Assert
+        assert response.status_code == status.HTTP_200_OK
+        assert response['ETag'] != etag
+        assert response.has_header('Last-Modified')
+
+    def test_if_expanded_collection_changes_returns_200(
+            self, client, create_products, django_capture_on_commit_callbacks):
+        # Arrange
+        product = create_products(1)[0]
+        url = f'/store/products/{product.id}/?expand=collection'
+        etag = client.get(url)['ETag']
+        with django_capture_on_commit_callbacks(execute=True):
+            product.collection.save()
+        # Act
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        # Assert
+        assert response.status_code == status.HTTP_200_OK
+
+
+@pytest.mark.django_db
+class TestProductFacets:
+    def test_returns_collection_and_price_counts_in_one_query(
+            self, client, django_assert_num_queries):
+        # Arrange
+        bread, milk = baker.make(Collection, _quantity=2)
+        baker.make(Product, collection=bread, unit_price=5, _quantity=2)
+        baker.make(Product, collection=bread, unit_price=30)
+        baker.make(Product, collection=milk, unit_price=2000)
+        # Act
+        with django_assert_num_queries(1):
+            response = client.get('/store/products/facets/?max_price=100')
+        # Assert
+        assert response.data['count'] == 3
+        assert response.data['collections'] == [
+            {'id': bread.id, 'title': bread.title, 'count': 3}
+        ]
+        prices = {item['min']: item['count'] for item in response.data['prices']}
+        assert prices[0] == 2
+        assert prices[25] == 1
+        assert prices[1000] == 0
+
+
+@pytest.mark.django_db
+class TestExportProducts:
+    def test_if_user_is_anonymous_returns_401(self, client):
+        # Act
+        response = client.get('/store/products/export/')
+        # Assert
+        assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+    def test_if_user_is_not_admin_returns_403(self, client, authenticate):
+        # Arrange
+        authenticate()
+        # Act
+        response = client.get('/store/products/export/')
+        # Assert
+        assert response.status_code == status.HTTP_403_FORBIDDEN
+
+    def test_ndjson_has_one_line_per_product(self, client, authenticate, create_products, monkeypatch):
+        # Arrange
+        authenticate(is_staff=True)
+        # several batches
+        monkeypatch.setattr(exports, 'CHUNK_SIZE', 2)
+        products = create_products(5)
+        baker.make(ProductImage, product=products[0], image='store/images/a.jpg')
+        # Act
+        response = client.get('/store/products/export/')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        # Assert
+        rows = [json.loads(line) for line in lines]
+        assert [row['id'] for row in rows] == sorted(product.id for product in products)
+        assert rows[0]['images'] == ['http://testserver/media/store/images/a.jpg']
+
+    def test_csv_has_header_and_one_row_per_product(self, client, authenticate, create_products):
+        # Arrange
+        authenticate(is_staff=True)
+        create_products(3)
+        # Act
+        response = client.get('/store/products/export/?output=csv')
+        # Assert
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        assert response['Content-Type'] == 'text/csv'
+        assert lines[0].startswith('id,name,slug')
+        assert len(lines) == 4
+
+
+@pytest.mark.django_db
+class TestSparseFieldsProducts:
+    def test_if_fields_given_returns_only_these_fields(self, client, create_products):
+        # Arrange
+        product = create_products(1)[0]
+        # Act
+        response = client.get(f'/store/products/{product.id}/?fields=id,title')
+        # Assert
+        assert response.data == {'id': product.id, 'title': product.name}
+
+    def test_if_images_not_requested_images_are_not_queried(
+            self, client, create_products, price_book, django_assert_num_queries):
+        # Arrange
+        product = create_products(1)[0]
+        baker.make(ProductImage, product=product, image='store/images/a.jpg')
+        # Act
+        # the product query only
+        with django_assert_num_queries(1):
+            response = client.get(f'/store/products/{product.id}/?fields=id,price')
+        # Assert
+        assert set(response.data) == {'id', 'price'}
+
+    def test_if_expanded_collection_not_requested_collection_is_not_queried(
+            self, client, create_products, price_book, django_assert_num_queries):
+        # Arrange
+        product = create_products(1)[0]
+        # Act
+        # the product query only
+        with django_assert_num_queries(1):
+            response = client.get(f'/store/products/{product.id}/?fields=id&expand=collection')
+        # Assert
+        assert response.data == {'id': product.id}
+
+    def test_if_collection_expanded_returns_collection_object(self, client, create_products):
+        # Arrange
+        product = create_products(1)[0]
+        # Act
+        response = client.get(
+            f'/store/products/?collection_id={product.collection_id}'
+            '&fields=id,collection&expand=collection'
+        )
+        # Assert
+        assert response.data['results'] == [{
+            'id': product.id,
+            'collection': {'id': product.collection_id, 'title': product.collection.title},
+        }]
+
+    def test_fields_are_part_of_the_cache_key(self, client, create_products):
+        # Arrange
+        product = create_products(1)[0]
+        client.get(f'/store/products/{product.id}/?fields=id')
+        # Act
+        response = client.get(f'/store/products/{product.id}/')
+        # Assert
+        assert 'title' in response.data
+
+
+@pytest.mark.django_db
+class TestProductChanges:
+    @pytest.fixture
+    def products(self, create_products):
+        # updated one after the other, a minute apart
+        products = create_products(5)
+        start = datetime(2024, 5, 1, 12, tzinfo=timezone.utc)
+        for index, product in enumerate(products):
+            Product.objects.filter(id=product.id)\
+                .update(last_updated_at=start + timedelta(minutes=index))
+        return products
+
+    def test_returns_products_updated_since(self, client, products):
+        # Act
+        response = client.get('/store/products/changes/?updated_since=2024-05-01T12:02:00Z')
+        # Assert
+        assert response.status_code == status.HTTP_200_OK
+        assert [product['id'] for product in response.data['results']] == \
+            [product.id for product in products[2:]]
+        assert response.data['next'] is None
+
+    def test_pages_continue_after_the_last_product(self, client, products, monkeypatch):
+        # Arrange
+        monkeypatch.setattr(sync, 'PAGE_SIZE', 2)
+        # Act
+        ids = []
+        url = '/store/products/changes/?updated_since=2024-05-01T00:00:00Z'
+        while url is not None:
+            data = client.get(url).data
+            ids += [product['id'] for product in data['results']]
+            url = data['next']
+        # Assert
+        assert ids == [product.id for product in products]
+
+    def test_cursor_returns_only_later_changes(self, client, products):
+        # Arrange
+        cursor = client.get('/store/products/changes/?updated_since=0').data['cursor']
+        products[0].name = 'changed'
+        products[0].save()
+        # Act
+        response = client.get(f'/store/products/changes/?cursor={cursor}')
+        # Assert
+        assert [product['title'] for product in response.data['results']] == ['changed']
+
+    def test_returns_deleted_product_ids(self, client, products):
+        # Arrange
+        cursor = client.get('/store/products/changes/?updated_since=0').data['cursor']
+        product_id = products[1].id
+        products[1].delete()
+        # Act
+        response = client.get(f'/store/products/changes/?cursor={cursor}')
+        # Assert
+        assert response.data['results'] == []
+        assert response.data['deleted'] == [product_id]
+        assert DeletedProduct.objects.filter(product_id=product_id).exists()
+
+    def test_prune_deletes_only_expired_tombstones(self):
+        # Arrange
+        old, recent = baker.make(DeletedProduct, _quantity=2)
+        DeletedProduct.objects.filter(id=old.id).update(
+            deleted_at=datetime.now(timezone.utc) - sync.RETENTION - timedelta(hours=1),
+        )
+        # Act
+        pruned = sync.prune()
+        # Assert
+        assert pruned == 1
+        assert list(DeletedProduct.objects.values_list('id', flat=True)) == [recent.id]
+
+    @pytest.mark.parametrize('query', ['', '?updated_since=yesterday', '?cursor=abc'])
+    def test_if_since_is_invalid_returns_400(self, client, query):
+        # Act
+        response = client.get(f'/store/products/changes/{query}')
+        # Assert
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.fixture
+def autocomplete_index(monkeypatch):
+    index = autocomplete.AutocompleteIndex()
+    monkeypatch.setattr(autocomplete, '_index', index)
+    return index
+
+
+@pytest.mark.django_db
+class TestAutocompleteProducts:
+    def test_returns_products_and_collections_by_word_prefix(self, client, autocomplete_index):
+        # Arrange
+        collection = baker.make(Collection, title='Bakery')
+        bread = baker.make(Product, name='White Bread', collection=collection)
+        baker.make(Product, name='Milk', collection=collection)
+        autocomplete_index.build()
+        # Act
+        response = client.get('/store/products/autocomplete/?search=b')
+        # Assert
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data == {
+            'products': [{'id': bread.id, 'title': 'White Bread'}],
+            'collections': [{'id': collection.id, 'title': 'Bakery'}],
+        }
+
+    def test_does_not_query_the_database(
+            self, client, autocomplete_index, django_assert_num_queries):
+        # Arrange
+        baker.make(Product, name='White Bread')
+        autocomplete_index.build()
+        # Act
+        with django_assert_num_queries(0):
+            response = client.get('/store/products/autocomplete/?search=white br')
+        # Assert
+        assert [product['title'] for product in response.data['products']] == ['White Bread']
+
+    def test_first_word_matches_come_first(self, autocomplete_index):
+        # Arrange
+        baker.make(Product, name='Soft Apple Pie')
+        baker.make(Product, name='Apple Juice')
+        autocomplete_index.build()
+        # Act
+        result = autocomplete_index.suggest('app')
+        # Assert
+        assert [product['title'] for product in result['products']] == \
+            ['Apple Juice', 'Soft Apple Pie']
+
+    def test_saved_and_deleted_products_update_the_index(
+            self, autocomplete_index, django_capture_on_commit_callbacks):
+        # Arrange
+        product = baker.make(Product, name='Bread')
+        autocomplete_index.build()
+        # Act
+        with django_capture_on_commit_callbacks(execute=True):
+            product.name = 'Butter'
+            product.save()
+            baker.make(Product, name='Brie')
+        renamed = autocomplete_index.suggest('b')
+        with django_capture_on_commit_callbacks(execute=True):
+            product.delete()
+        deleted = autocomplete_index.suggest('b')
+        # Assert
+        assert [item['title'] for item in renamed['products']] == ['Brie', 'Butter']
+        assert [item['title'] for item in deleted['products']] == ['Brie']
+
+    def test_if_version_changed_index_is_rebuilt(self, autocomplete_index, monkeypatch):
+        # Arrange
+        autocomplete_index.build()
+        # saved by another worker, the on_commit handler of this one doesn't run
+        baker.make(Product, name='Bagel')
+        caching.bump_version(autocomplete.VERSION)
+        monkeypatch.setattr(autocomplete, 'VERSION_CHECK_INTERVAL', 0)
+        # Act
+        result = autocomplete_index.suggest('bag')
+        # Assert
+        assert [item['title'] for item in result['products']] == ['Bagel']
+
+
+@pytest.mark.django_db
+class TestMissingProducts:
+    def test_repeated_miss_does_not_query_the_database(
+            self, client, django_assert_num_queries):
+        # Arrange
+        client.get('/store/products/999/')
+        # Act
+        with django_assert_num_queries(0):
+            response = client.get('/store/products/999/')
+        # Assert
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+    def test_if_product_created_it_is_found(
+            self, client, create_products, django_capture_on_commit_callbacks):
+        # Arrange
+        client.get('/store/products/999/')
+        # Act
+        with django_capture_on_commit_callbacks(execute=True):
+            create_products(1, id=999)
+        response = client.get('/store/products/999/')
+        # Assert
+        assert response.status_code == status.HTTP_200_OK
+
+
+@pytest.fixture
+def trending_counters(monkeypatch):
+    counters = trending.LocalCounters()
+    monkeypatch.setattr(trending, '_counters', counters)
+    return counters
+
+
+@pytest.mark.django_db
+class TestTrendingProducts:
+    def test_returns_most_viewed_and_added_to_cart(
+            self, client, create_products, trending_counters):
+        # Arrange
+        popular, other = create_products(2)
+        for _ in range(3):
+            client.get(f'/store/products/{popular.id}/')
+        client.get(f'/store/products/{other.id}/')
+        cart = client.post('/store/carts/').data
+        client.post(
+            f'/store/carts/{cart["id"]}/items/',
+            {'product_id': other.id, 'quantity': 2},
+        )
+        # Act
+        response = client.get('/store/products/trending/?window=24h')
+        # Assert
+        assert response.status_code == status.HTTP_200_OK
+        assert [(item['id'], item['count']) for item in response.data['views']] == \
+            [(popular.id, 3), (other.id, 1)]
+        assert [(item['id'], item['count']) for item in response.data['cart_adds']] == \
+            [(other.id, 1)]
+
+    def test_cached_views_are_counted(self, client, create_products, trending_counters):
+        # Arrange
+        product = create_products(1)[0]
+        client.get(f'/store/products/{product.id}/')
+        # Act
+        client.get(f'/store/products/{product.id}/')
+        # Assert
+        assert trending_counters.top(trending.VIEWS, '1h', 10) == [(product.id, 2)]
+
+    def test_old_buckets_are_not_in_the_window(self, trending_counters, monkeypatch):
+        # Arrange
+        now = 1_700_000_000
+        monkeypatch.setattr(trending.time, 'time', lambda: now - 2 * 60 * 60)
+        trending_counters.record(trending.VIEWS, 1)
+        monkeypatch.setattr(trending.time, 'time', lambda: now)
+        trending_counters.record(trending.VIEWS, 2)
+        # Act
+        result = trending_counters.top(trending.VIEWS, '1h', 10)
+        # Assert
+        assert result == [(2, 1)]
+
+    @pytest.mark.parametrize('param, limit', [('0', 1), ('-5', 10), ('1000', 50)])
+    def test_limit_is_clamped(self, client, monkeypatch, param, limit):
+        # Arrange
+        limits = []
+        monkeypatch.setattr(trending, 'top', lambda event, window, limit: limits.append(limit) or [])
+        # Act
+        response = client.get(f'/store/products/trending/?limit={param}')
+        # Assert
+        assert response.status_code == status.HTTP_200_OK
+        assert set(limits) == {limit}
+
+    def test_if_window_is_invalid_returns_400(self, client):
+        # Act
+        response = client.get('/store/products/trending/?window=1y')
+        # Assert
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.mark.django_db
+class TestProductPopularity:
+    @pytest.fixture(autouse=True)
+    def settled(self, monkeypatch):
+        monkeypatch.setattr(popularity, 'SETTLE_SECONDS', 0)
+
+    def sell(self, product, quantity):
+        # the customer is created with the user
+        customer = baker.make(User).customer
+        order = baker.make(Order, customer=customer)
+        baker.make(OrderItem, order=order, product=product, quantity=quantity)
+
+    def test_adds_only_new_order_items(self, create_products):
+        # Arrange
+        product = create_products(1)[0]
+        self.sell(product, 2)
+        popularity.update_popularity()
+        self.sell(product, 3)
+        # Act
+        popularity.update_popularity()
+        # Assert
+        product.refresh_from_db()
+        assert product.popularity == 5
+
+    def test_if_order_is_not_settled_it_is_counted_later(self, create_products, monkeypatch):
+        # Arrange
+        product = create_products(1)[0]
+        self.sell(product, 2)
+        monkeypatch.setattr(popularity, 'SETTLE_SECONDS', 60)
+        popularity.update_popularity()
+        monkeypatch.setattr(popularity, 'SETTLE_SECONDS', 0)
+        # Act
+        popularity.update_popularity()
+        # Assert
+        product.refresh_from_db()
+        assert product.popularity == 2
+
+    def test_products_can_be_ordered_by_popularity(self, client, create_products):
+        # Arrange
+        products = create_products(3)
+        self.sell(products[1], 5)
+        self.sell(products[2], 1)
+        popularity.update_popularity()
+        # Act
+        response = client.get('/store/products/?ordering=-popularity')
+        # Assert
+        assert [product['id'] for product in response.data['results']] == \
+            [products[1].id, products[2].id, products[0].id]
+
+    def test_only_lists_ordered_by_popularity_are_invalidated(
+            self, client, create_products, django_capture_on_commit_callbacks):
+        # Arrange
+        products = create_products(2)
+        client.get('/store/products/?ordering=-popularity')
+        catalog_version = caching.get_version('catalog')
+        self.sell(products[1], 5)
+        # Act
+        with django_capture_on_commit_callbacks(execute=True):
+            popularity.update_popularity()
+        response = client.get('/store/products/?ordering=-popularity')
+        # Assert
+        assert response.data['results'][0]['id'] == products[1].id
+        assert caching.get_version('catalog') == catalog_version
+
+
+@pytest.fixture
+def related_store(monkeypatch):
+    store = recommendations.LocalStore()
+    monkeypatch.setattr(recommendations, '_store', store)
+    monkeypatch.setattr(recommendations, 'SETTLE_SECONDS', 0)
+    return store
+
+
+@pytest.mark.django_db
+class TestRelatedProducts:
+    def order(self, *products):
+        customer = baker.make(User).customer
+        order = baker.make(Order, customer=customer)
+        for product in products:
+            baker.make(OrderItem, order=order, product=product, quantity=1)
+
+    def test_co_occurrences_count_orders_with_both_products(self):
+        # Act
+        product_ids, other_ids, counts = recommendations.co_occurrences(
+            np.array([1, 1, 1, 2, 2, 3]), np.array([10, 20, 20, 10, 20, 30]),
+        )
+        # Assert
+        assert sorted(zip(product_ids.tolist(), other_ids.tolist(), counts.tolist())) == \
+            [(10, 20, 2), (20, 10, 2)]
+
+    def test_most_ordered_together_first(self, client, create_products, related_store):
+        # Arrange
+        bread, butter, jam, milk = create_products(4)
+        self.order(bread, butter, jam)
+        self.order(bread, butter)
+        self.order(jam, milk)
+        recommendations.update_related()
+        # Act
+        response = client.get(f'/store/products/{bread.id}/related/')
+        # Assert
+        assert response.status_code == status.HTTP_200_OK
+        assert [product['id'] for product in response.data] == [butter.id, jam.id]
+
+    def test_adds_only_new_orders(self, create_products, related_store):
+        # Arrange
+        bread, butter, jam = create_products(3)
+        self.order(bread, jam)
+        recommendations.update_related()
+        self.order(bread, butter)
+        self.order(bread, butter)
+        # Act
+        changed = recommendations.update_related()
+        # Assert
+        assert changed == 2
+        assert related_store.counts[bread.id] == {butter.id: 2, jam.id: 1}
+        assert recommendations.related(bread.id) == [butter.id, jam.id]
+
+    def test_if_product_does_not_exist_returns_404(self, client, related_store):
+        # Act
+        response = client.get('/store/products/999/related/')
+        # Assert
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+@pytest.fixture
+def similar_store(monkeypatch):
+    store = similarity.LocalStore()
+    monkeypatch.setattr(similarity, '_store', store)
+    return store
+
+
+@pytest.mark.django_db
+class TestSimilarProducts:
+    def test_blocks_find_the_same_neighbors(self):
+        # Arrange
+        documents = [
+            similarity.term_counts(name, '')
+            for name in ['red apple', 'green apple', 'red wine', 'white wine', 'bread']
+        ]
+        matrix = similarity.tfidf_matrix(documents)
+        # Act
+        blocked = dict(similarity.top_neighbors(matrix, k=2, block_cells=5))
+        whole = dict(similarity.top_neighbors(matrix, k=2))
+        # Assert
+        assert blocked == whole
+        # red and apple are as rare
+        assert set(blocked[0]) == {1, 2}
+        assert blocked[4] == []
+
+    def test_most_similar_first(self, client, create_products, similar_store):
+        # Arrange
+        apple, green_apple, wine, bread = create_products(
+            4,
+            name=iter(['Red apple', 'Green apple', 'Red wine', 'Bread']),
+            description=iter(['A crisp apple', 'A crisp apple', 'A dry wine', '']),
+        )
+        call_command('build_similar_products', stdout=StringIO())
+        # Act
+        response = client.get(f'/store/products/{apple.id}/similar/?limit=1')
+        # Assert
+        assert response.status_code == status.HTTP_200_OK
+        assert [product['id'] for product in response.data] == [green_apple.id]
+        assert similarity.similar(bread.id) == []
+
+    def test_if_product_does_not_exist_returns_404(self, client, similar_store):
+        # Act
+        response = client.get('/store/products/999/similar/')
+        # Assert
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+@pytest.mark.django_db
+class TestListSnapshot:
+    @pytest.fixture
+    def catalog(self, monkeypatch):
+        monkeypatch.setattr(ProductCursorPagination, 'page_size', 4)
+        collections = baker.make(Collection, _quantity=2)
+        # names and prices with duplicates, the id decides between them
+        return [
+            baker.make(
+                Product,
+                name=f'Product {index % 7}',
+                unit_price=Decimal(10 + index % 5 * 5),
+                collection=collections[index % 2],
+            )
+            for index in range(21)
+        ]
+
+    def walk(self, client, url):
+        # the ids of all pages with next, then of all pages back with previous
+        forward = []
+        response = client.get(url)
+        while True:
+            forward.append([product['id'] for product in response.data['results']])
+            if response.data['next'] is None:
+                break
+            response = client.get(response.data['next'])
+        backward = []
+        while response.data['previous'] is not None:
+            response = client.get(response.data['previous'])
+            backward.append([product['id'] for product in response.data['results']])
+        return forward, backward
+
+    @pytest.mark.parametrize('query', [
+        '',
+        '?ordering=-name',
+        '?ordering=unit_price',
+        '?ordering=-unit_price&min_price=15&max_price=25',
+        '?ordering=-last_updated_at',
+        '?collection_id={collection_id}&ordering=unit_price',
+        '?collection_id={collection_id}&max_price=19.99',
+    ])
+    def test_pages_are_the_pages_of_the_database(self, client, catalog, monkeypatch, query):
+        # Arrange
+        url = '/store/products/' + query.format(collection_id=catalog[0].collection_id)
+        from_snapshot = self.walk(client, url)
+        assert list_snapshot._snapshot is not None
+        cache.clear()
+        monkeypatch.setattr(ProductViewSet, 'list_snapshot', False)
+        # Act
+        from_database = self.walk(client, url)
+        # Assert
+        assert from_snapshot == from_database
+        assert len(from_snapshot[0]) > 1
+
+    def test_snapshot_is_rebuilt_when_catalog_changes(
+            self, client, catalog, django_capture_on_commit_callbacks):
+        # Arrange
+        client.get('/store/products/?ordering=unit_price')
+        snapshot = list_snapshot._snapshot
+        client.get('/store/products/?ordering=-unit_price')
+        assert list_snapshot._snapshot is snapshot
+        product = catalog[-1]
+        # Act
+        with django_capture_on_commit_callbacks(execute=True):
+            product.unit_price = Decimal('1')
+            product.save()
+        response = client.get('/store/products/?ordering=unit_price')
+        # Assert
+        assert list_snapshot._snapshot is not snapshot
+        assert response.data['results'][0]['id'] == product.id
+
+    def test_other_filters_read_the_database(self, client, catalog):
+        # Arrange
+        request = APIRequestFactory().get('/store/products/?search=bread')
+        # Act
+        ids = list_snapshot.get_page_ids(Request(request), ('name', 'id'), None, False, 5)
+        # Assert
+        assert ids is None
+
+
+@pytest.mark.django_db
+class TestCatalogSnapshot:
+    @pytest.fixture
+    def build(self, tmp_path):
+        def do_build(full=False):
+            builder = snapshots.SnapshotBuilder('http://testserver', root=str(tmp_path))
+            builder.build(full=full)
+            return tmp_path / snapshots.DIRECTORY
+        return do_build
+
+    def test_files_have_the_same_json_as_the_api(self, client, build, create_products):
+        # Arrange
+        product = create_products(25)[0]
+        # Act
+        root = build()
+        # Assert
+        detail = json.loads((root / 'products' / f'{product.id}.json').read_text())
+        assert detail == json.loads(client.get(f'/store/products/{product.id}/').content)
+        page = json.loads(
+            (root / 'collections' / str(product.collection_id) / 'products' / '2.json').read_text()
+        )
+        api_page = json.loads(client.get(
+            f'/store/products/?collection_id={product.collection_id}&page=2'
+        ).content)
+        assert page['results'] == api_page['results']
+        assert page['count'] == 25
+        assert (root / 'collections.json').exists()
+
+    def test_large_files_are_gzipped(self, build, create_products):
+        # Arrange
+        product = create_products(20)[0]
+        # Act
+        root = build()
+        # Assert
+        path = root / 'collections' / str(product.collection_id) / 'products' / '1.json'
+        assert gzip.decompress((path.parent / '1.json.gz').read_bytes()) == path.read_bytes()
+
+    def test_next_build_renders_only_changed_products(self, build, create_products):
+        # Arrange
+        changed, unchanged = create_products(2)
+        root = build()
+        Product.objects.update(last_updated_at=datetime(2020, 1, 1, tzinfo=timezone.utc))
+        Collection.objects.update(products_updated_at=datetime(2020, 1, 1, tzinfo=timezone.utc))
+        (root / 'products' / f'{unchanged.id}.json').write_text('old')
+        changed.name = 'changed'
+        changed.save()
+        # Act
+        build()
+        # Assert
+        assert json.loads((root / 'products' / f'{changed.id}.json').read_text())['title'] == 'changed'
+        assert (root / 'products' / f'{unchanged.id}.json').read_text() == 'old'
+
+    def test_deleted_products_are_removed(self, build, create_products):
+        # Arrange
+        product = create_products(1)[0]
+        root = build()
+        product_id = product.id
+        product.delete()
+        # Act
+        build()
+        # Assert
+        assert not (root / 'products' / f'{product_id}.json').exists()
+
+    def test_view_serves_the_current_files(self, client, build, create_products, settings, tmp_path):
+        # Arrange
+        settings.SNAPSHOT_ROOT = str(tmp_path)
+        product = create_products(1)[0]
+        build()
+        product.name = 'changed'
+        product.save()
+        # Act
+        build()
+        response = client.get(f'/store/catalog/products/{product.id}.json')
+        # Assert
+        assert response.status_code == status.HTTP_200_OK
+        assert response['Content-Type'] == 'application/json'
+        assert json.loads(b''.join(response.streaming_content))['title'] == 'changed'
+
+    def test_view_sends_the_compressed_file_the_client_accepts(
+            self, client, build, create_products, settings, tmp_path):
+        # Arrange
+        settings.SNAPSHOT_ROOT = str(tmp_path)
+        product = create_products(20)[0]
+        root = build()
+        path = root / 'collections' / str(product.collection_id) / 'products' / '1.json'
+        # Act
+        response = client.get(
+            f'/store/catalog/collections/{product.collection_id}/products/1.json',
+            HTTP_ACCEPT_ENCODING='gzip, deflate',
+        )
+        # Assert
+        assert response['Content-Encoding'] == 'gzip'
+        assert gzip.decompress(b''.join(response.streaming_content)) == path.read_bytes()
+
+    def test_view_returns_404_for_removed_and_outside_files(
+            self, client, build, create_products, settings, tmp_path):
+        # Arrange
+        settings.SNAPSHOT_ROOT = str(tmp_path)
+        product = create_products(1)[0]
+        build()
+        product_id = product.id
+        product.delete()
+        build()
+        # Act
+        removed = client.get(f'/store/catalog/products/{product_id}.json')
+        outside = client.get('/store/catalog/../catalog/manifest.json.tmp')
+        # Assert
+        assert removed.status_code == status.HTTP_404_NOT_FOUND
+        assert outside.status_code == status.HTTP_404_NOT_FOUND
+
+
+# the command requests the pages from other threads,
+# they only see committed rows
+@pytest.mark.django_db(transaction=True)
+class TestWarmCaches:
+    def test_warmed_responses_are_served_from_cache(
+            self, client, create_products, django_assert_num_queries):
+        # Arrange
+        product = create_products(30)[0]
+        # Act
+        out = StringIO()
+        call_command(
+            'warm_caches', '--base-url', 'http://testserver', '--concurrency', '2', stdout=out,
+        )
+        # Assert
+        assert '0 failed' in out.getvalue()
+        first_page = client.get(f'/store/products/?collection_id={product.collection_id}')
+        with django_assert_num_queries(0):
+            client.get(f'/store/products/{product.id}/')
+            client.get(first_page.data['next'])
+            client.get('/store/products/facets/')
+
+    def test_warming_does_not_count_views(self, create_products, trending_counters):
+        # Arrange
+        product = create_products(1)[0]
+        trending_counters.record(trending.VIEWS, product.id)
+        # Act
+        call_command(
+            'warm_caches', '--base-url', 'http://testserver', '--concurrency', '2', stdout=StringIO(),
+        )
+        # Assert
+        assert trending_counters.top(trending.VIEWS, '1h', 10) == [(product.id, 1)]
+
+    def test_if_view_counts_fail_most_popular_are_warmed(
+            self, client, create_products, monkeypatch, django_assert_num_queries):
+        # Arrange
+        product = create_products(1)[0]
+
+        def top(*args):
+            raise ConnectionError('redis is down')
+        monkeypatch.setattr(trending, 'top', top)
+        # Act
+        out = StringIO()
+        err = StringIO()
+        call_command(
+            'warm_caches', '--base-url', 'http://testserver', '--concurrency', '2',
+            stdout=out, stderr=err,
+        )
+        # Assert
+        assert 'redis is down' in err.getvalue()
+        assert '0 failed' in out.getvalue()
+        with django_assert_num_queries(0):
+            client.get(f'/store/products/{product.id}/')
+
+    def test_if_warming_fails_command_does_not_fail(self, monkeypatch):
+        # Arrange
+        def fail(*args, **kwargs):
+            raise ConnectionError('database is down')
+        monkeypatch.setattr(Collection.objects, 'order_by', fail)
+        # Act
+        err = StringIO()
+        call_command('warm_caches', '--base-url', 'http://testserver', stderr=err)
+        # Assert
+        assert 'database is down' in err.getvalue()
+
+
+@pytest.mark.django_db
+class TestBenchmarkProductQueries:
+    def test_if_compare_without_seed_raises_and_keeps_the_indexes(self):
+        # Arrange
+        with connection.cursor() as cursor:
+            indexes = connection.introspection.get_constraints(cursor, Product._meta.db_table)
+        # Act
+        with pytest.raises(CommandError):
+            call_command('benchmark_product_queries', '--compare', stdout=StringIO())
+        # Assert
+        with connection.cursor() as cursor:
+            assert connection.introspection.get_constraints(cursor, Product._meta.db_table) == indexes
+
+    def test_seeds_and_times_every_query(self):
+        # Act
+        out = StringIO()
+        call_command(
+            'benchmark_product_queries', '--seed', '5', '--collections', '1', '--repeat', '1',
+            '--no-plans', stdout=out,
+        )
+        # Assert
+        assert 'Added 1 collections and 5 products' in out.getvalue()
+        assert Collection.objects.get(title='bench-0').product_count == 5
+        assert out.getvalue().count('median') == len(benchmark_product_queries.QUERIES)
+
+
+@pytest.mark.django_db
+class TestBulkWriteProducts:
+    @pytest.fixture(autouse=True)
+    def admin(self, authenticate):
+        authenticate(is_staff=True)
+
+    def test_creates_products_with_slugs(self, client):
+        # Arrange
+        collection = baker.make(Collection)
+        rows = [
+            {'name': f'p{index}', 'unit_price': 5, 'inventory': 3, 'collection': collection.id}
+            for index in range(3)
+        ]
+        # Act
+        response = client.post('/store/products/bulk/', rows, format='json')
+        # Assert
+        assert response.status_code == status.HTTP_201_CREATED
+        assert response.data['count'] == 3
+        assert sorted(Product.objects.values_list('slug', flat=True)) == \
+            ['p0-slug', 'p1-slug', 'p2-slug']
+        collection.refresh_from_db()
+        assert collection.product_count == 3
+
+    def test_if_a_row_is_invalid_returns_its_errors_and_writes_nothing(self, client):
+        # Arrange
+        collection = baker.make(Collection)
+        rows = [
+            {'name': 'a', 'unit_price': 5, 'inventory': 3, 'collection': collection.id},
+            {'name': 'b', 'unit_price': 0, 'inventory': 3, 'collection': 999},
+        ]
+        # Act
+        response = client.post('/store/products/bulk/', rows, format='json')
+        # Assert
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert [row['index'] for row in response.data['errors']] == [1]
+        assert set(response.data['errors'][0]['errors']) == {'unit_price', 'collection'}
+        assert not Product.objects.exists()
+
+    def test_updates_products_in_one_query(
+            self, client, create_products, django_assert_max_num_queries):
+        # Arrange
+        products = create_products(3, unit_price=5)
+        rows = [{'id': product.id, 'unit_price': 7} for product in products]
+        # Act
+        # products and collections, the update, the collection stats,
+        # the change log
+        with django_assert_max_num_queries(9):
+            response = client.patch('/store/products/bulk/', rows, format='json')
+        # Assert
+        assert response.status_code == status.HTTP_200_OK
+        assert set(Product.objects.values_list('unit_price', flat=True)) == {7}
+        assert products[0].name + '---slug' == Product.objects.get(id=products[0].id).slug
+
+    def test_if_id_is_unknown_returns_400(self, client):
+        # Act
+        response = client.patch('/store/products/bulk/', [{'id': 999, 'unit_price': 7}], format='json')
+        # Assert
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert response.data['errors'][0]['index'] == 0
+
+    @pytest.mark.parametrize('product_id', [[1], {'id': 1}, True, '1', None])
+    def test_if_id_is_not_an_int_returns_400(self, client, create_products, product_id):
+        # Arrange
+        product = create_products(1, unit_price=5)[0]
+        rows = [{'id': product.id, 'unit_price': 7}, {'id': product_id, 'unit_price': 7}]
+        # Act
+        response = client.patch('/store/products/bulk/', rows, format='json')
+        # Assert
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert [row['index'] for row in response.data['errors']] == [1]
+        assert 'id' in response.data['errors'][0]['errors']
+        assert Product.objects.get(id=product.id).unit_price == 5
+
+    def test_update_saves_once(self, create_products):
+        # Arrange
+        product = create_products(1)[0]
+        serializer = ProductSerializerForCreate(product, data={'unit_price': 7}, partial=True)
+        serializer.is_valid(raise_exception=True)
+        # Act
+        with CaptureQueriesContext(connection) as queries:
+            serializer.save()
+        # Assert
+        updates = [query for query in queries if query['sql'].startswith('UPDATE "store_product"')]
+        assert len(updates) == 1
+        assert Product.objects.get(id=product.id).slug == f'{product.name}---slug'
+
+
+@pytest.mark.django_db
+class TestPricing:
+    def test_best_discount_and_tax_are_rounded_to_cents(self):
+        # Arrange
+        product = baker.make(Product, unit_price=Decimal('9.99'))
+        product.promotions.add(
+            baker.make(Promotion, discount=0.1), baker.make(Promotion, discount=0.25),
+        )
+        # Act
+        price = pricing.get_price_book().price(product.id, product.unit_price)
+        # Assert
+        assert price.discount == Decimal('2.50')
+        assert price.effective_price == Decimal('7.49')
+        assert price.tax == Decimal('0.75')
+        assert price.price_with_tax == Decimal('8.24')
+
+    def test_product_shows_discount(self, client, create_products, django_capture_on_commit_callbacks):
+        # Arrange
+        product = create_products(1, unit_price=Decimal('20'))[0]
+        client.get(f'/store/products/{product.id}/')
+        # Act
+        with django_capture_on_commit_callbacks(execute=True):
+            product.promotions.add(baker.make(Promotion, discount=0.5))
+        response = client.get(f'/store/products/{product.id}/')
+        # Assert
+        assert response.data['discount'] == Decimal('10.00')
+        assert response.data['effective_price'] == Decimal('10.00')
+        assert response.data['price_with_tax'] == Decimal('11.00')
+
+    def test_if_promotion_changes_price_is_not_stale(
+            self, client, create_products, django_capture_on_commit_callbacks):
+        # Arrange
+        product = create_products(1, unit_price=Decimal('20'))[0]
+        promotion = baker.make(Promotion, discount=0.5)
+        product.promotions.add(promotion)
+        client.get(f'/store/products/{product.id}/')
+        # Act
+        with django_capture_on_commit_callbacks(execute=True):
+            promotion.discount = 0.25
+            promotion.save()
+        response = client.get(f'/store/products/{product.id}/')
+        # Assert
+        assert response.data['effective_price'] == Decimal('15.00')
+
+    def test_annotated_prices_are_the_prices_of_the_price_book(self):
+        # Arrange
+        product = baker.make(Product, unit_price=Decimal('9.99'))
+        product.promotions.add(
+            baker.make(Promotion, discount=0.1), baker.make(Promotion, discount=0.25),
+        )
+        other = baker.make(Product, unit_price=Decimal('12.34'))
+        # Act
+        annotated = pricing.annotate_prices(Product.objects.order_by('id'))
+        # Assert
+        book = pricing.get_price_book()
+        for item in annotated:
+            assert pricing.price_from_annotations(item) == book.price(item.id, item.unit_price)
+        assert [item.id for item in annotated] == [product.id, other.id]
+
+    def test_filter_by_price_with_tax(self, client, create_products):
+        # Arrange
+        cheap, middle, expensive = create_products(3, unit_price=iter(
+            [Decimal('5'), Decimal('20'), Decimal('40')]
+        ))
+        # 40 - 50% = 20, 22.00 with tax
+        expensive.promotions.add(baker.make(Promotion, discount=0.5))
+        # Act
+        response = client.get(
+            '/store/products/?min_price_with_tax=10&max_price_with_tax=22'
+        )
+        # Assert
+        assert response.status_code == status.HTTP_200_OK
+        assert {item['id'] for item in response.data['results']} == {middle.id, expensive.id}
+
+    def test_order_by_price_with_tax(self, client, create_products, monkeypatch):
+        # Arrange
+        monkeypatch.setattr(ProductCursorPagination, 'page_size', 2)
+        products = create_products(3, unit_price=iter(
+            [Decimal('30'), Decimal('20'), Decimal('25')]
+        ))
+        # 30 - 50% = 15, the cheapest after the discount
+        products[0].promotions.add(baker.make(Promotion, discount=0.5))
+        # Act
+        response = client.get('/store/products/?ordering=price_with_tax')
+        next_response = client.get(response.data['next'])
+        # Assert
+        ids = [item['id'] for item in response.data['results'] + next_response.data['results']]
+        assert ids == [products[0].id, products[1].id, products[2].id]
+        assert response.data['results'][0]['price_with_tax'] == Decimal('16.50')
+
+    @pytest.mark.parametrize('ordering', ['price_with_tax', '-price_with_tax'])
+    def test_pages_through_tied_prices_with_tax(self, client, create_products, monkeypatch, ordering):
+        # Arrange
+        monkeypatch.setattr(ProductCursorPagination, 'page_size', 2)
+        # 13.75 - 1.38 (1.375 rounded) = 12.37, + 1.24 (1.237 rounded) = 13.61,
+        # 13.609999999999999 with floats
+        products = create_products(5, unit_price=Decimal('13.75'))
+        for product in products:
+            product.promotions.add(baker.make(Promotion, discount=0.1))
+        # Act
+        ids = []
+        url = f'/store/products/?ordering={ordering}'
+        while url is not None and len(ids) <= len(products):
+            data = client.get(url).data
+            ids += [item['id'] for item in data['results']]
+            url = data['next']
+        previous_ids = []
+        url = data['previous']
+        while url is not None and len(previous_ids) <= len(products):
+            data = client.get(url).data
+            previous_ids = [item['id'] for item in data['results']] + previous_ids
+            url = data['previous']
+        # Assert
+        expected = sorted(product.id for product in products)
+        if ordering.startswith('-'):
+            expected.reverse()
+        assert ids == expected
+        assert previous_ids == expected[:-1]
+        assert data['results'][0]['price_with_tax'] == Decimal('13.61')
+
+    def test_facets_filter_by_price_with_tax(self, client, create_products):
+        # Arrange
+        create_products(2, unit_price=Decimal('10'))
+        create_products(1, unit_price=Decimal('50'))
+        # Act
+        response = client.get('/store/products/facets/?max_price_with_tax=11')
+        # Assert
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data['count'] == 2
@@ -0,0 +1,136 @@
+import logging
+import threading
+import time
+from collections import Counter, defaultdict
+
+from django.core.cache import cache
+
+from store import caching
+
+logger = logging.getLogger(__name__)
+
+# trending products: views and add-to-cart counts over the last hour and day
+#
+# every event is a ZINCRBY on a redis sorted set of the current time bucket,
+#   store:trending:views:300:5689344   product id -> views in that 5 minutes
+# a window is the union of its buckets (ZUNIONSTORE), 12 buckets of 5 minutes
+# for 1h, 24 buckets of an hour for 24h. each event goes to both bucket sizes
+# in one pipelined round trip, the buckets expire after the window.
+# nothing is written to the database on the request path.
+#
+# with a cache that is not django_redis (tests, local development)
+# the counters are kept in the memory of the process instead.
+
+VIEWS = 'views'
+CART_ADDS = 'cart_adds'
+EVENTS = [VIEWS, CART_ADDS]
+
+# window: (bucket seconds, number of buckets)
+WINDOWS = {
+    '1h': (5 * 60, 12),
+    '24h': (60 * 60, 24),
+}
+DEFAULT_WINDOW = '1h'
+
+# requests with this WSGI environ key set aren't counted as views,
+# the warm_caches command sets it. a client can't send it, only HTTP_ keys
+# come from the headers
+NOT_COUNTED = 'store.trending.not_counted'
+
+# the trending lists are computed at most every RESULT_TIMEOUT seconds
+RESULT_TIMEOUT = 30
+
+BUCKET_SIZES = [bucket_seconds for bucket_seconds, _ in WINDOWS.values()]
+# a bucket expires one bucket after its window
+BUCKET_EXPIRY = {
+    bucket_seconds: bucket_seconds * (count + 1)
+    for bucket_seconds, count in WINDOWS.values()
+}
+
+
+def bucket_key(event, bucket_seconds, bucket):
+    return f'store:trending:{event}:{bucket_seconds}:{bucket}'
+
+
+def window_keys(event, window, now=None):
+    bucket_seconds, count = WINDOWS[window]
+    current = int((now or time.time()) // bucket_seconds)
+    return [
+        bucket_key(event, bucket_seconds, bucket)
+        for bucket in range(current - count + 1, current + 1)
+    ]
+
+
+class RedisCounters:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def record(self, event, product_id, amount=1):
+        now = time.time()
+        pipeline = self.connection.pipeline(transaction=False)
+        for bucket_seconds in BUCKET_SIZES:
+            key = bucket_key(event, bucket_seconds, int(now // bucket_seconds))
+            pipeline.zincrby(key, amount, product_id)
+            pipeline.expire(key, BUCKET_EXPIRY[bucket_seconds])
+        pipeline.execute()
+
+    def top(self, event, window, limit):
+        keys = window_keys(event, window)
+        # the union of the buckets, kept for a moment and read once
+        union_key = f'store:trending:{event}:{window}:union'
+        pipeline = self.connection.pipeline(transaction=False)
+        pipeline.zunionstore(union_key, keys)
+        pipeline.zrevrange(union_key, 0, limit - 1, withscores=True)
+        pipeline.expire(union_key, RESULT_TIMEOUT)
+        _, rows, _ = pipeline.execute()
+        return [(int(member), int(score)) for member, score in rows]
+
+
+class LocalCounters:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # bucket key -> Counter of product ids,
+        # the old buckets are never removed, for tests and development only
+        self.buckets = defaultdict(Counter)
+
+    def record(self, event, product_id, amount=1):
+        now = time.time()
+        with self.lock:
+            for bucket_seconds in BUCKET_SIZES:
+                key = bucket_key(event, bucket_seconds, int(now // bucket_seconds))
+                self.buckets[key][product_id] += amount
+
+    def top(self, event, window, limit):
+        total = Counter()
+        with self.lock:
+            for key in window_keys(event, window):
+                total.update(self.buckets.get(key, {}))
+        return total.most_common(limit)
+
+
+_counters = None
+
+
+def get_counters():
+    global _counters
+    if _counters is None:
+        _counters = caching.redis_or_local(RedisCounters, LocalCounters)
+    return _counters
+
+
+def record(event, product_id, amount=1):
+    # a lost count is better than a failed request
+    try:
+        get_counters().record(event, product_id, amount)
+    except Exception:
+        logger.warning('Could not record the %s of product %s', event, product_id, exc_info=True)
+
+
+def top(event, window, limit):
+    # [(product id, count)], the most first
+    key = f'store:trending:top:{event}:{window}:{limit}'
+    result = cache.get(key)
+    if result is None:
+        result = get_counters().top(event, window, limit)
+        cache.set(key, result, RESULT_TIMEOUT)
+    return result
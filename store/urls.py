@@ -17,6 +17,7 @@ router.register('products', views.ProductViewSet, basename='product')
 router.register('carts', views.CartViewSet, basename='cart')
 router.register('customers', views.CustomerViewSet, basename='customer')
 router.register('orders', views.OrderViewSet, basename='order')
+router.register('changes', views.CatalogChangeViewSet, basename='catalog-change')
 # register the child routers
 # lookup='product' means /products/product_pk/
 # basename is used as the prefix to generate the names of the URL patterns
@@ -47,6 +48,7 @@ urlpatterns = [
     path('', include(router.urls)),
     path('', include(products_router.urls)),
     path('', include(carts_router.urls)),
+    path('catalog/<path:path>', views.catalog_snapshot, name='catalog-snapshot'),
 ]
 
 # print(repr(serializers.ProductSerializer()))
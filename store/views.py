@@ -1,11 +1,18 @@
 import http
+import os
+from urllib.parse import urlencode
 
+from django.core.cache import cache
+from django.db.models import Case, When, Value, IntegerField
 from django.db.models.aggregates import Count
 from django.shortcuts import render, get_object_or_404
-from django.http import HttpResponse
+from django.utils.decorators import method_decorator
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import http_date
+from django.views.static import was_modified_since
 from rest_framework import status
 from rest_framework.decorators import api_view, action
-from rest_framework.filters import SearchFilter, OrderingFilter
+from rest_framework.filters import OrderingFilter
 from rest_framework.generics import (
     ListCreateAPIView,
     RetrieveUpdateDestroyAPIView
@@ -19,16 +26,20 @@ from rest_framework.views import APIView
 from rest_framework.viewsets import ModelViewSet, GenericViewSet
 
 from core.serializers import UserSerializer
-from store.filters import ProductFilter
+from store import autocomplete, bulk_writes, caching, change_log, exports, pricing, recommendations, \
+    similarity, snapshots, sync, trending
+from store.filters import ProductFilter, ProductSearchFilter
 from store.models import Product, Collection, OrderItem, Review, Cart, CartItem, Customer, Order, ProductImage
-from store.paginations import ProductPageNumberPagination
+from store.paginations import ProductPageNumberPagination, ProductCursorPagination
 from store.permissions import IsAdminOrReadOnly, FullDjangoModelPermissions, ViewCustomerHistoryPermission
 from store.serializers import (
     ProductSerializer,
+    CompiledProductSerializer,
     CollectionSerializer,
     ProductSerializerForCreate,
     ReviewSerializer, CartSerializer, CartItemSerializer, CartItemSerializerForCreate, CartItemSerializerForUpdate,
-    CustomerSerializer, OrderSerializer, OrderSerializerForCreate, OrderSerializerForUpdate, ProductImageSerializer
+    CustomerSerializer, OrderSerializer, OrderSerializerForCreate, OrderSerializerForUpdate, ProductImageSerializer,
+    CatalogChangeSerializer,
 )
 
 from rest_framework.mixins import ListModelMixin, CreateModelMixin, RetrieveModelMixin, DestroyModelMixin, \
@@ -362,11 +373,88 @@ from django_filters.rest_framework import DjangoFilterBackend
 # views inside a single class
 # ModelViewSet: combines List, Create, Retrieve, Update, Destroy APIView
 
-class CollectionViewSet(ModelViewSet):
-    queryset = Collection.objects.annotate(
-        product_count=Count('product')
-    ).all()
+# ?fields=id,title,price and ?expand=collection
+# the requested fields and expansions go to the serializer context
+# (SparseFieldsMixin trims the serializer fields),
+# and the prefetches of fields that are not requested are skipped
+class SparseFieldsViewMixin:
+    # field name -> lookups to prefetch when the field is in the response
+    field_prefetches = {}
+    # expandable field name -> lookups to select_related when it's expanded
+    expand_select_related = {}
+
+    def get_query_param_list(self, name):
+        value = self.request.query_params.get(name, '')
+        return [item.strip() for item in value.split(',') if item.strip()]
+
+    def get_requested_fields(self):
+        # None means all fields
+        return self.get_query_param_list('fields') or None
+
+    def get_expanded_fields(self):
+        return self.get_query_param_list('expand')
+
+    def is_field_requested(self, name):
+        fields = self.get_requested_fields()
+        return fields is None or name in fields
+
+    def get_sparse_fields_context(self):
+        return {
+            'fields': self.get_requested_fields(),
+            'expand': self.get_expanded_fields(),
+        }
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context.update(self.get_sparse_fields_context())
+        return context
+
+    def prefetch_requested_fields(self, queryset):
+        for name, lookups in self.field_prefetches.items():
+            if self.is_field_requested(name):
+                queryset = queryset.prefetch_related(*lookups)
+        expanded = self.get_expanded_fields()
+        for name, lookups in self.expand_select_related.items():
+            if name in expanded and self.is_field_requested(name):
+                queryset = queryset.select_related(*lookups)
+        return queryset
+
+
+# a 404 for an id that was not found a moment ago comes from the cache,
+# see caching.MISSING_TIMEOUT
+class MissingCacheMixin:
+    # the kind of the object in the cache key, cleared by the signal handlers
+    missing_kind = None
+
+    def retrieve(self, request, *args, **kwargs):
+        pk = kwargs['pk']
+        if caching.is_missing(self.missing_kind, pk):
+            raise Http404
+        try:
+            return super().retrieve(request, *args, **kwargs)
+        except Http404:
+            caching.mark_missing(self.missing_kind, pk)
+            raise
+
+
+# 304 Not Modified for clients which already have the current version
+@method_decorator(
+    caching.conditional_get(caching.catalog_version, params=('page',)),
+    name='list',
+)
+@method_decorator(
+    caching.conditional_get(caching.collection_detail_version),
+    name='retrieve',
+)
+class CollectionViewSet(MissingCacheMixin, ModelViewSet):
+    # queryset = Collection.objects.annotate(
+    #     product_count=Count('product')
+    # ).all()
+    # product_count is a column of the collection now,
+    # maintained from the product signals, no join and group by
+    queryset = Collection.objects.all()
     serializer_class = CollectionSerializer
+    missing_kind = 'collection'
 
     permission_classes = [IsAdminOrReadOnly]
 
@@ -387,7 +475,7 @@ class CollectionViewSet(ModelViewSet):
         return super().destroy(request, *args, **kwargs)
 
 
-class ProductViewSet(ModelViewSet):
+class ProductViewSet(SparseFieldsViewMixin, MissingCacheMixin, ModelViewSet):
     # Class View defines
     # def setup(self, request, *args, **kwargs):
     #     """Initialize attributes shared by all view methods."""
@@ -397,7 +485,7 @@ class ProductViewSet(ModelViewSet):
     #     self.args = args
     #     self.kwargs = kwargs
 
-    filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
+    filter_backends = [DjangoFilterBackend, ProductSearchFilter, OrderingFilter]
     # with this filter backend, we only need to specify
     # what fields we want to use for filtering in the url+query string
 
@@ -407,10 +495,14 @@ class ProductViewSet(ModelViewSet):
 
     # SerachFilter is another filter backend
     search_fields = ['name', 'description']
+    # ProductSearchFilter searches the full text index of these fields
+    # and orders the results by relevance, see store/search.py
     # search is case insensitive, and records with the key word
     # inside the corresponding fields will show up
 
-    ordering_fields = ['unit_price', 'last_updated_at']
+    # popularity is the units sold, see store/popularity.py,
+    # price_with_tax is an annotation, see store/pricing.py
+    ordering_fields = ['unit_price', 'last_updated_at', 'name', 'popularity', 'price_with_tax']
     # query string ?ordering=-unit_price,last_updated_at
     # sort the results by unit_price descending, and last_updated_at ascending
 
@@ -425,15 +517,46 @@ class ProductViewSet(ModelViewSet):
     # instead of using page number, it uses limit and offset for pagination
     # take limit products and skip offset products, the offset starts from 0
 
-    pagination_class = ProductPageNumberPagination
+    # pagination_class = ProductPageNumberPagination
+
+    # cursor pagination by default, no COUNT(*) and no OFFSET scan,
+    # ?cursor=... to get the next or previous page
+    pagination_class = ProductCursorPagination
+    # the cursor pages of collections and price ranges from the arrays
+    # in the memory of the worker, see store/list_snapshot.py
+    list_snapshot = True
+
+    missing_kind = 'product'
+
+    @property
+    def paginator(self):
+        # clients that still need page numbers send ?page=n,
+        # they get the count, next and previous of the page number pagination
+        if not hasattr(self, '_paginator'):
+            page_query_param = ProductPageNumberPagination.page_query_param
+            if page_query_param in self.request.query_params:
+                self._paginator = ProductPageNumberPagination()
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
+
+    field_prefetches = {'images': ['productimage_set']}
+    expand_select_related = {'collection': ['collection']}
 
     def get_queryset(self):
         queryset = Product.objects.all()
 
         if self.request.method == 'GET':
-            queryset = Product.objects\
-                .select_related('collection')\
-                .prefetch_related('productimage_set')
+            # queryset = Product.objects\
+            #     .select_related('collection')\
+            #     .prefetch_related('productimage_set')
+            # the collection is only loaded for ?expand=collection,
+            # the hyperlink only needs collection_id,
+            # the images are only loaded when they are in ?fields=
+            queryset = self.prefetch_requested_fields(Product.objects.all())
+            # discount, effective_price and price_with_tax computed by the
+            # database, for ?min_price_with_tax= and ?ordering=price_with_tax
+            queryset = pricing.annotate_prices(queryset)
             # this queryset can support query by query string in the request
             # collection_id = self.request.query_params.get('collection_id')
             # # dict, using get method, if no key, return None
@@ -447,7 +570,312 @@ class ProductViewSet(ModelViewSet):
         return ProductSerializer
 
     def get_serializer_context(self):
-        return {'request': self.request}
+        return {'request': self.request, **self.get_sparse_fields_context()}
+
+    def get_serializer(self, *args, **kwargs):
+        # reading products goes through the compiled serializer,
+        # same output as ProductSerializer without the per-row field overhead
+        compiled_actions = ('list', 'retrieve', 'bulk', 'changes', 'trending', 'related', 'similar')
+        if self.request.method == 'GET' and self.action in compiled_actions:
+            kwargs.setdefault('context', self.get_serializer_context())
+            return CompiledProductSerializer(*args, **kwargs)
+        return super().get_serializer(*args, **kwargs)
+
+    # read-through cache for the product list and details,
+    # the keys contain version numbers bumped by the signal handlers
+    # when products, images or collections change, see store/caching.py
+    @method_decorator(caching.conditional_get(
+        caching.product_list_version, params=caching.PRODUCT_LIST_PARAMS,
+    ))
+    def list(self, request, *args, **kwargs):
+        key = caching.product_list_key(request)
+        data = cache.get(key)
+        if data is not None:
+            return Response(data)
+        response = super().list(request, *args, **kwargs)
+        cache.set(key, response.data, caching.RESPONSE_TIMEOUT)
+        return response
+
+    @method_decorator(caching.conditional_get(
+        caching.product_detail_version, params=caching.PRODUCT_DETAIL_PARAMS,
+    ))
+    def retrieve(self, request, *args, **kwargs):
+        key = caching.product_detail_key(request, kwargs['pk'])
+        data = cache.get(key)
+        if data is None:
+            data = super().retrieve(request, *args, **kwargs).data
+            cache.set(key, data, caching.RESPONSE_TIMEOUT)
+        # a redis counter for products/trending/, no database write
+        if not request.META.get(trending.NOT_COUNTED):
+            trending.record(trending.VIEWS, int(kwargs['pk']))
+        return Response(data)
+
+    # the most products a client can ask for in one bulk request
+    bulk_max_ids = 100
+
+    # products/bulk/?ids=1,5,9
+    # many products in one request and one query instead of
+    # one products/<id>/ request per product
+    @action(detail=False, methods=['GET'])
+    def bulk(self, request):
+        raw_ids = [value for value in request.query_params.get('ids', '').split(',') if value]
+        if not all(value.isdigit() for value in raw_ids):
+            return Response(
+                {"error": "ids must be a comma separated list of product ids"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        # keep the order of the request, without duplicates
+        ids = list(dict.fromkeys(int(value) for value in raw_ids))
+        if len(ids) > self.bulk_max_ids:
+            return Response(
+                {"error": f"At most {self.bulk_max_ids} ids can be requested at once"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        products = {
+            product.id: product
+            for product in self.get_queryset().filter(id__in=ids)
+        }
+        found = [products[product_id] for product_id in ids if product_id in products]
+        serializer = self.get_serializer(found, many=True)
+        return Response({
+            'results': serializer.data,
+            'missing': [product_id for product_id in ids if product_id not in products],
+        })
+
+    # products/bulk/ POST [{"name": ..., "unit_price": ..., ...}, ...]
+    # creates the products in batches in one transaction, see store/bulk_writes.py
+    @bulk.mapping.post
+    def bulk_create(self, request):
+        return self.bulk_write(request, bulk_writes.create_products, status.HTTP_201_CREATED)
+
+    # products/bulk/ PATCH [{"id": 1, "unit_price": ...}, ...]
+    # updates the given fields of the products, see store/bulk_writes.py
+    @bulk.mapping.patch
+    def bulk_update(self, request):
+        return self.bulk_write(request, bulk_writes.update_products, status.HTTP_200_OK)
+
+    def bulk_write(self, request, write, success_status):
+        rows = request.data
+        if not isinstance(rows, list) or not rows:
+            return Response(
+                {"error": "The body must be a list of products"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if len(rows) > bulk_writes.MAX_ROWS:
+            return Response(
+                {"error": f"At most {bulk_writes.MAX_ROWS} products can be written at once"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        try:
+            products = write(rows, bulk_writes.get_context(request))
+        except bulk_writes.BulkError as error:
+            return Response({'errors': error.errors}, status=status.HTTP_400_BAD_REQUEST)
+        # no ids after a bulk insert on MySQL
+        return Response({
+            'count': len(products),
+            'ids': [product.id for product in products if product.id is not None],
+        }, status=success_status)
+
+    # the bounds of the price buckets of the facets,
+    # the last bucket has no upper bound
+    facet_price_buckets = [0, 10, 25, 50, 100, 250, 500, 1000]
+
+    # products/facets/?search=bread&max_price=50
+    # the counts for the sidebar: products per collection and per price range,
+    # the same filters as the product list, one GROUP BY query
+    @action(detail=False, methods=['GET'])
+    def facets(self, request):
+        key = caching.product_facets_key(request)
+        data = cache.get(key)
+        if data is not None:
+            return Response(data)
+
+        bounds = self.facet_price_buckets
+        # the index of the price bucket of each product
+        bucket = Case(
+            *[
+                When(unit_price__lt=upper, then=Value(index))
+                for index, upper in enumerate(bounds[1:])
+            ],
+            default=Value(len(bounds) - 1),
+            output_field=IntegerField(),
+        )
+        rows = self.filter_queryset(pricing.annotate_prices(Product.objects.all()))\
+            .order_by()\
+            .annotate(price_bucket=bucket)\
+            .values('collection_id', 'collection__title', 'price_bucket')\
+            .annotate(count=Count('id'))
+
+        collections = {}
+        prices = [0] * len(bounds)
+        for row in rows:
+            collection = collections.setdefault(row['collection_id'], {
+                'id': row['collection_id'],
+                'title': row['collection__title'],
+                'count': 0,
+            })
+            collection['count'] += row['count']
+            prices[row['price_bucket']] += row['count']
+
+        data = {
+            'count': sum(prices),
+            'collections': sorted(
+                collections.values(), key=lambda item: (-item['count'], item['title'])
+            ),
+            'prices': [
+                {
+                    'min': lower,
+                    'max': bounds[index + 1] if index + 1 < len(bounds) else None,
+                    'count': prices[index],
+                }
+                for index, lower in enumerate(bounds)
+            ],
+        }
+        cache.set(key, data, caching.RESPONSE_TIMEOUT)
+        return Response(data)
+
+    # the default and the largest number of trending products
+    trending_limit = 10
+    trending_max_limit = 50
+
+    # products/trending/?window=24h
+    # the most viewed and the most added to cart products
+    # of the last hour (default) or day, see store/trending.py
+    @action(detail=False, methods=['GET'])
+    def trending(self, request):
+        window = request.query_params.get('window', trending.DEFAULT_WINDOW)
+        if window not in trending.WINDOWS:
+            return Response(
+                {"error": f"window must be one of {', '.join(trending.WINDOWS)}"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        limit = request.query_params.get('limit', '')
+        # at least 1, zrevrange(key, 0, limit - 1) returns the whole set for 0
+        limit = max(1, min(int(limit), self.trending_max_limit)) if limit.isdigit() else self.trending_limit
+
+        counts = {event: trending.top(event, window, limit) for event in trending.EVENTS}
+        ids = {product_id for rows in counts.values() for product_id, _ in rows}
+        products = {
+            product.id: product
+            for product in self.get_queryset().filter(id__in=ids)
+        }
+        serializer = self.get_serializer(list(products.values()), many=True)
+        data = {item['id']: item for item in serializer.data}
+
+        # deleted products are skipped
+        return Response({
+            'window': window,
+            **{
+                event: [
+                    {**data[product_id], 'count': count}
+                    for product_id, count in rows
+                    if product_id in data
+                ]
+                for event, rows in counts.items()
+            },
+        })
+
+    # products/<id>/related/?limit=5
+    # the products most often ordered together with this product,
+    # one redis read for the ids, see store/recommendations.py
+    @action(detail=True, methods=['GET'])
+    def related(self, request, pk):
+        return self.neighbor_products(request, pk, recommendations.related, recommendations.TOP_K)
+
+    # products/<id>/similar/?limit=5
+    # the products with the most similar name and description,
+    # one redis read for the ids, see store/similarity.py
+    @action(detail=True, methods=['GET'])
+    def similar(self, request, pk):
+        return self.neighbor_products(request, pk, similarity.similar, similarity.TOP_K)
+
+    def neighbor_products(self, request, pk, get_ids, max_limit):
+        # the products of get_ids(product id, limit) in that order
+        if not pk.isdigit():
+            raise Http404
+        limit = request.query_params.get('limit', '')
+        limit = min(int(limit), max_limit) if limit.isdigit() else max_limit
+        ids = get_ids(int(pk), limit)
+        # the product itself in the same query, for the 404
+        products = {
+            product.id: product
+            for product in self.get_queryset().filter(id__in=[int(pk), *ids])
+        }
+        if int(pk) not in products:
+            raise Http404
+        # deleted products are skipped
+        serializer = self.get_serializer(
+            [products[product_id] for product_id in ids if product_id in products], many=True,
+        )
+        return Response(serializer.data)
+
+    # products/autocomplete/?search=bre
+    # product names and collection titles starting with the prefix
+    # (or with a word starting with it) from the in-memory index,
+    # see store/autocomplete.py
+    @action(detail=False, methods=['GET'])
+    def autocomplete(self, request):
+        limit = request.query_params.get('limit', '')
+        limit = min(int(limit), autocomplete.MAX_LIMIT) if limit.isdigit() else autocomplete.LIMIT
+        return Response(autocomplete.get_index().suggest(
+            request.query_params.get('search', ''), limit,
+        ))
+
+    # products/changes/?updated_since=2024-05-01T12:00:00Z
+    # the products changed and the ids of the products deleted since then,
+    # a page at a time, the next page and the next sync continue from ?cursor=
+    @action(detail=False, methods=['GET'])
+    def changes(self, request):
+        try:
+            cursor = request.query_params.get('cursor')
+            updated_since = request.query_params.get('updated_since')
+            if cursor:
+                positions = sync.decode_cursor(cursor)
+            elif updated_since:
+                positions = sync.start_positions(sync.parse_timestamp(updated_since))
+            else:
+                raise sync.InvalidCursor('updated_since or cursor is required')
+        except sync.InvalidCursor as error:
+            return Response({"error": str(error)}, status=status.HTTP_400_BAD_REQUEST)
+
+        changed, deleted, positions, has_more = sync.get_changes(
+            self.get_queryset(), positions,
+        )
+        cursor = sync.encode_cursor(positions)
+        next_url = None
+        if has_more:
+            next_url = request.build_absolute_uri(
+                f'{request.path}?{urlencode({**request.query_params.dict(), "cursor": cursor})}'
+            )
+        return Response({
+            'results': self.get_serializer(changed, many=True).data,
+            'deleted': deleted,
+            'next': next_url,
+            # for the next sync when next is null
+            'cursor': cursor,
+        })
+
+    # products/export/?output=csv
+    # the whole catalog with collections and image urls, streamed,
+    # the response is written while the products are read in batches,
+    # admin users only: the export has the inventory of every product
+    @action(detail=False, methods=['GET'], permission_classes=[IsAdminUser])
+    def export(self, request):
+        # not ?format=, DRF uses it to choose the renderer
+        output = request.query_params.get('output', 'ndjson')
+        if output not in exports.FORMATS:
+            return Response(
+                {"error": f"output must be one of {', '.join(exports.FORMATS)}"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        lines, content_type = exports.FORMATS[output]
+        response = StreamingHttpResponse(
+            lines(exports.iter_products(request)),
+            content_type=content_type,
+        )
+        response['Content-Disposition'] = f'attachment; filename="products.{output}"'
+        return response
 
     # only admin users can modify products
     # anyone can retrieve a list of products
@@ -467,6 +895,88 @@ class ProductViewSet(ModelViewSet):
         return super().destroy(request, *args, **kwargs)
 
 
+# changes/?offset=1234&timeout=25
+# the changes of products, collections, images and reviews after the offset,
+# waits up to timeout seconds when there are none yet (long polling).
+# the consumer sends the offset of the response with the next request,
+# without an offset the feed starts at the last change, admin users only.
+# see store/change_log.py
+class CatalogChangeViewSet(GenericViewSet):
+    serializer_class = CatalogChangeSerializer
+    # the feed is for the internal consumers,
+    # a waiting request holds a web thread for up to the timeout
+    permission_classes = [IsAdminUser]
+
+    @staticmethod
+    def get_int_param(request, name, default, maximum):
+        value = request.query_params.get(name)
+        if value is None:
+            return default
+        if not value.isdigit():
+            raise ValueError(f'{name} must be a number')
+        return min(int(value), maximum)
+
+    def list(self, request):
+        try:
+            offset = self.get_int_param(request, 'offset', None, 2 ** 63)
+            limit = self.get_int_param(
+                request, 'limit', change_log.PAGE_SIZE, change_log.MAX_PAGE_SIZE,
+            ) or change_log.PAGE_SIZE
+            timeout = self.get_int_param(
+                request, 'timeout', change_log.DEFAULT_TIMEOUT, change_log.MAX_TIMEOUT,
+            )
+        except ValueError as error:
+            return Response({"error": str(error)}, status=status.HTTP_400_BAD_REQUEST)
+
+        if offset is None:
+            offset = change_log.head_offset()
+        try:
+            changes = change_log.wait(offset, limit, timeout)
+        except change_log.OffsetExpired as error:
+            return Response(
+                {"error": "The changes after this offset are no longer kept, "
+                          "read the catalog again and continue from oldest_offset",
+                 "oldest_offset": error.oldest_offset},
+                status=status.HTTP_410_GONE,
+            )
+        return Response({
+            'changes': self.get_serializer(changes, many=True).data,
+            # the offset of the next request
+            'offset': changes[-1].id if changes else offset,
+        })
+
+
+# catalog/products/42.json
+# the files of the last catalog snapshot build, see store/snapshots.py.
+# the file is looked up for every request, a build is served as soon as
+# it's written, with the compression the client accepts
+def catalog_snapshot(request, path):
+    found = snapshots.find_file(path, request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    if found is None:
+        raise Http404
+    file_path, encoding = found
+    try:
+        file = open(file_path, 'rb')
+    except FileNotFoundError:
+        # removed by a build meanwhile
+        raise Http404
+    stat = os.fstat(file.fileno())
+    if not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'), stat.st_mtime, stat.st_size):
+        file.close()
+        return HttpResponseNotModified()
+    response = FileResponse(file, content_type='application/json', filename=os.path.basename(path))
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    response['Vary'] = 'Accept-Encoding'
+    if encoding is not None:
+        response['Content-Encoding'] = encoding
+    return response
+
+
+@method_decorator(
+    caching.conditional_get(caching.review_version, params=('page',)),
+    name='list',
+)
+@method_decorator(caching.conditional_get(caching.review_version), name='retrieve')
 class ReviewViewSet(ModelViewSet):
     serializer_class = ReviewSerializer
 
@@ -487,16 +997,29 @@ class ReviewViewSet(ModelViewSet):
         return super().list(request, *args, **kwargs)
 
 
-class CartViewSet(CreateModelMixin,
+class CartViewSet(SparseFieldsViewMixin,
+                  MissingCacheMixin,
+                  CreateModelMixin,
                   RetrieveModelMixin,
                   DestroyModelMixin,
                   ListModelMixin,
                   GenericViewSet):
     serializer_class = CartSerializer
+    missing_kind = 'cart'
+
+    # the totals are computed from the items as well
+    field_prefetches = {
+        'items': ['cartitem_set__product'],
+        'total_price': ['cartitem_set__product'],
+        'total_discount': ['cartitem_set__product'],
+        'total_tax': ['cartitem_set__product'],
+        'total_price_with_tax': ['cartitem_set__product'],
+    }
 
     def get_queryset(self):
         if self.request.method == 'GET':
-            return Cart.objects.all().prefetch_related('cartitem_set__product')
+            # return Cart.objects.all().prefetch_related('cartitem_set__product')
+            return self.prefetch_requested_fields(Cart.objects.all())
         return Cart.objects.all()
 
 
@@ -576,7 +1099,8 @@ class CustomerViewSet(ModelViewSet):
         return Response('ok')
 
 
-class OrderViewSet(ListModelMixin,
+class OrderViewSet(SparseFieldsViewMixin,
+                   ListModelMixin,
                    CreateModelMixin,
                    RetrieveModelMixin,
                    UpdateModelMixin,
@@ -617,11 +1141,15 @@ class OrderViewSet(ListModelMixin,
         )
 
 
+    field_prefetches = {'items': ['orderitem_set__product']}
+    expand_select_related = {'customer': ['customer']}
+
     def get_queryset(self):
         user = self.request.user
         if user.is_staff:
             if self.request.method == 'GET':
-                return Order.objects.all().prefetch_related('orderitem_set__product')
+                # return Order.objects.all().prefetch_related('orderitem_set__product')
+                return self.prefetch_requested_fields(Order.objects.all())
             return Order.objects.all()
 
         # violates the command query separation
@@ -635,8 +1163,7 @@ class OrderViewSet(ListModelMixin,
         customer_id = Customer.objects.only('id').get(user_id=user.id)
 
         if self.request.method == 'GET':
-            return Order.objects.all() \
-                .prefetch_related('orderitem_set__product') \
+            return self.prefetch_requested_fields(Order.objects.all()) \
                 .filter(customer_id=customer_id)
         return Order.objects.all().filter(customer_id=customer_id)
 
@@ -178,6 +178,10 @@ MEDIA_URL = '/media/'
 # where the media files are stored in the file system
 # the full path to a folder on disk that contains user uploaded files
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+# the static copy of the catalog api (store/snapshots.py), not under STATIC_ROOT:
+# WhiteNoise would only see the files of the time the web process started,
+# store/catalog/<path> serves the current files
+SNAPSHOT_ROOT = os.path.join(BASE_DIR, 'snapshots')
 
 DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
 
@@ -256,7 +260,37 @@ CELERY_BEAT_SCHEDULE = {
         'args': ['Hello world'],
         'kwargs': {},
 
-    }
+    },
+    # add the new order items to Product.popularity
+    'update_product_popularity': {
+        'task': 'store.tasks.update_product_popularity',
+        # every 5 minutes
+        'schedule': 5 * 60,
+    },
+    # the change log keeps a week of changes
+    'prune_catalog_changes': {
+        'task': 'store.tasks.prune_catalog_changes',
+        # every hour
+        'schedule': 60 * 60,
+    },
+    # products/changes/ keeps the deleted product ids for 30 days
+    'prune_deleted_products': {
+        'task': 'store.tasks.prune_deleted_products',
+        # every day at 4:00
+        'schedule': crontab(hour=4, minute=0),
+    },
+    # count the products ordered together in the new orders
+    'update_related_products': {
+        'task': 'store.tasks.update_related_products',
+        # every 15 minutes
+        'schedule': 15 * 60,
+    },
+    # the products with similar names and descriptions
+    'build_similar_products': {
+        'task': 'store.tasks.build_similar_products',
+        # every night at 3:00
+        'schedule': crontab(hour=3, minute=0),
+    },
 }
 
 # # config redis as the caching backend
@@ -14,3 +14,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'storefront.settings.dev')
 
 application = get_wsgi_application()
+
+# build the in-memory autocomplete index when the worker starts,
+# not on the first request
+from store import autocomplete  # noqa: E402
+
+autocomplete.get_index().build()